@@ -0,0 +1,245 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+
+from salud import percentil
+
+class GestorArtefactos:
+    """
+    Capturas de pantalla por trabajo bajo un directorio administrado.
+    Política (ARTIFACT_POLICY): 'never', 'on-failure' (por defecto) o 'always'.
+    Las capturas se toman en JPEG, se escriben a disco fuera del event loop y el
+    directorio se rota por tamaño total y antigüedad.
+    """
+    POLITICAS = ("never", "on-failure", "always")
+
+    def __init__(self):
+        self.directorio = os.getenv("ARTIFACT_DIR", "artefactos")
+        self.politica = os.getenv("ARTIFACT_POLICY", "on-failure")
+        if self.politica not in self.POLITICAS:
+            self.politica = "on-failure"
+        self.calidad_jpeg = int(os.getenv("ARTIFACT_JPEG_QUALITY", "60"))
+        self.max_bytes = int(float(os.getenv("ARTIFACT_MAX_MB", "200")) * 1024 * 1024)
+        self.max_edad_s = float(os.getenv("ARTIFACT_MAX_AGE_H", "24")) * 3600
+        # Región opcional "x,y,ancho,alto" para no codificar la página completa
+        clip = os.getenv("ARTIFACT_CLIP")
+        self.clip = dict(zip(("x", "y", "width", "height"), map(float, clip.split(",")))) if clip else None
+        os.makedirs(self.directorio, exist_ok=True)
+
+    def ruta(self, job_id: str, nombre: str, extension: str = "jpg") -> str:
+        """Ruta única por trabajo: <dir>/<job_id>/<timestamp>_<nombre>.<ext>."""
+        return os.path.join(self.directorio, job_id, f"{int(time.time() * 1000)}_{nombre}.{extension}")
+
+    def debe_capturar(self, fallo: bool) -> bool:
+        if self.politica == "always":
+            return True
+        return self.politica == "on-failure" and fallo
+
+    async def capturar(self, page, job_id: str, nombre: str, fallo: bool = False, obligatorio: bool = False, clip=None):
+        """
+        Toma una captura según la política. Con obligatorio=True (ej: comprobantes de envío)
+        se captura siempre. Retorna la ruta escrita o None.
+        """
+        if not (obligatorio or self.debe_capturar(fallo)):
+            return None
+        try:
+            contenido = await page.screenshot(type="jpeg", quality=self.calidad_jpeg, clip=clip or self.clip)
+        except Exception as e:
+            print(f"[{job_id}] No se pudo capturar '{nombre}': {e}")
+            return None
+
+        path = self.ruta(job_id, nombre)
+        await asyncio.to_thread(self._escribir, path, contenido)
+        return path
+
+    def _escribir(self, path: str, contenido: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(contenido)
+        self.rotar()
+
+    def rotar(self):
+        """Borra artefactos más antiguos que max_edad y luego los más viejos hasta quedar bajo max_bytes."""
+        ahora = time.time()
+        archivos = []
+        for raiz, dirs, nombres in os.walk(self.directorio):
+            # Las carpetas ocultas (.trazas_tmp) son buffers de ejecuciones en curso, no artefactos
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for nombre in nombres:
+                path = os.path.join(raiz, nombre)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if ahora - st.st_mtime > self.max_edad_s:
+                    self._borrar(path)
+                else:
+                    archivos.append((st.st_mtime, st.st_size, path))
+
+        total = sum(tamano for _, tamano, _ in archivos)
+        for _, tamano, path in sorted(archivos):
+            if total <= self.max_bytes:
+                break
+            self._borrar(path)
+            total -= tamano
+
+        # Limpiar carpetas de trabajos vacías
+        for raiz, dirs, nombres in os.walk(self.directorio, topdown=False):
+            if os.path.relpath(raiz, self.directorio).startswith("."):
+                continue
+            if not dirs and not nombres:
+                try:
+                    os.rmdir(raiz)
+                except OSError:
+                    pass
+
+    def _borrar(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class GestorTrazas:
+    """
+    Trazas de Playwright opcionales (TRACE_MODE=on-failure) sin capturas de pantalla y con
+    snapshots de DOM, en cada contexto que crea el scraper. La traza se corta en un tramo por
+    paso y solo se guardan los últimos TRACE_MAX_TRAMOS en un buffer temporal: se descartan si
+    el flujo termina bien y se persisten en la carpeta del trabajo si falla.
+
+    El costo real de trazar no está en las llamadas a la API de tracing sino en que cada
+    acción de la página captura snapshots. Para medirlo, una fracción TRACE_CONTROL de los
+    contextos corre sin traza (grupo de control) y se compara la duración mediana de punta a
+    punta de cada flujo con y sin traza.
+    """
+
+    def __init__(self, gestor: GestorArtefactos):
+        self.gestor = gestor
+        self.habilitado = os.getenv("TRACE_MODE", "off") == "on-failure"
+        self.max_tramos = int(os.getenv("TRACE_MAX_TRAMOS", "6"))
+        self.control = float(os.getenv("TRACE_CONTROL", "0.1"))
+        self.directorio_tmp = os.path.join(gestor.directorio, ".trazas_tmp")
+        self.contextos = {}
+        # Duración de cada contexto (creación → cierre) por flujo, con y sin traza
+        self.duraciones = {}
+        self.stats = {"ejecuciones": 0, "persistidas": 0, "contextos_trazados": 0, "contextos_control": 0, "tiempo_api_s": 0.0}
+
+    async def iniciar(self, context, flujo: str):
+        if not self.habilitado:
+            return
+        inicio = time.monotonic()
+        trazado = random.random() >= self.control
+        if trazado:
+            await context.tracing.start(screenshots=False, snapshots=True, sources=False)
+            await context.tracing.start_chunk(title="inicio")
+            self.contextos[id(context)] = {"tramos": deque(), "n": 0, "api_s": time.monotonic() - inicio}
+            self.stats["contextos_trazados"] += 1
+        else:
+            self.stats["contextos_control"] += 1
+        context.on("close", lambda _: self._cerrado(context, flujo, inicio, trazado))
+
+    def _cerrado(self, context, flujo: str, inicio: float, trazado: bool):
+        """Al cerrarse el contexto: registra su duración y descarta lo que quedó en el buffer."""
+        datos = self.duraciones.setdefault(flujo, {"con_traza": deque(maxlen=100), "sin_traza": deque(maxlen=100)})
+        datos["con_traza" if trazado else "sin_traza"].append(time.monotonic() - inicio)
+        estado = self.contextos.pop(id(context), None)
+        if estado:
+            self.stats["tiempo_api_s"] += estado["api_s"]
+            if estado["tramos"]:
+                asyncio.get_running_loop().run_in_executor(None, self._descartar, list(estado["tramos"]))
+
+    async def paso(self, context, nombre: str):
+        """Cierra el tramo actual en el buffer y abre uno nuevo para el paso 'nombre'."""
+        estado = self.contextos.get(id(context))
+        if not estado:
+            return
+        t0 = time.monotonic()
+        try:
+            await self._cerrar_tramo(context, estado)
+            await context.tracing.start_chunk(title=nombre)
+        except Exception as e:
+            print(f"No se pudo rotar la traza: {e}")
+        estado["api_s"] += time.monotonic() - t0
+
+    async def resultado(self, context, job_id: str, fallo: bool):
+        """Fin de un flujo: persiste el buffer si hubo fallo, si no lo descarta. La traza sigue activa."""
+        estado = self.contextos.get(id(context))
+        if not estado:
+            return None
+        t0 = time.monotonic()
+        destino = None
+        try:
+            if fallo:
+                await self._cerrar_tramo(context, estado)
+                destino = await asyncio.to_thread(self._persistir, list(estado["tramos"]), job_id)
+                self.stats["persistidas"] += 1
+            else:
+                await context.tracing.stop_chunk()
+                await asyncio.to_thread(self._descartar, list(estado["tramos"]))
+            estado["tramos"].clear()
+            await context.tracing.start_chunk(title="continuacion")
+        except Exception as e:
+            print(f"[{job_id}] No se pudo cerrar la traza: {e}")
+
+        estado["api_s"] += time.monotonic() - t0
+        self.stats["ejecuciones"] += 1
+        return destino
+
+    async def detener(self, context):
+        estado = self.contextos.get(id(context))
+        if not estado:
+            return
+        try:
+            await context.tracing.stop()
+        except Exception:
+            pass
+
+    def resumen(self) -> dict:
+        overhead = {}
+        for flujo, datos in self.duraciones.items():
+            con, sin = percentil(datos["con_traza"], 50), percentil(datos["sin_traza"], 50)
+            overhead[flujo] = {
+                "muestras_con_traza": len(datos["con_traza"]),
+                "muestras_sin_traza": len(datos["sin_traza"]),
+                "mediana_con_traza_s": round(con, 2) if con is not None else None,
+                "mediana_sin_traza_s": round(sin, 2) if sin is not None else None,
+                # Sin muestras de ambos grupos no hay con qué comparar
+                "overhead_s": round(con - sin, 2) if con is not None and sin is not None else None,
+            }
+        return {
+            "habilitado": self.habilitado,
+            "fraccion_control": self.control,
+            **self.stats,
+            "tiempo_api_s": round(self.stats["tiempo_api_s"], 3),
+            "overhead_por_flujo": overhead,
+        }
+
+    async def _cerrar_tramo(self, context, estado):
+        os.makedirs(self.directorio_tmp, exist_ok=True)
+        estado["n"] += 1
+        path = os.path.join(self.directorio_tmp, f"{id(context)}_{estado['n']}.zip")
+        await context.tracing.stop_chunk(path=path)
+        estado["tramos"].append(path)
+        # Buffer acotado: el tramo más antiguo se descarta
+        while len(estado["tramos"]) > self.max_tramos:
+            self.gestor._borrar(estado["tramos"].popleft())
+
+    def _persistir(self, tramos, job_id: str):
+        carpeta = os.path.join(self.gestor.directorio, job_id)
+        os.makedirs(carpeta, exist_ok=True)
+        for i, path in enumerate(tramos):
+            try:
+                os.replace(path, os.path.join(carpeta, f"traza_{i:02d}.zip"))
+            except OSError:
+                continue
+        self.gestor.rotar()
+        return carpeta
+
+    def _descartar(self, tramos):
+        for path in tramos:
+            self.gestor._borrar(path)
+
+# Instancias globales para ser usadas por los scrapers
+artefactos = GestorArtefactos()
+trazas = GestorTrazas(artefactos)
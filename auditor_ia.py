@@ -1,11 +1,91 @@
 import os
+import asyncio
+import random
+import time
+from collections import deque
 import httpx
 import json
 
+from salud import Circuito, CircuitoAbierto, percentil
+
+# Llamadas simultáneas al proxy de IA; el resto espera su turno en orden de llegada
+AI_MAX_CONCURRENCIA = int(os.getenv("AI_MAX_CONCURRENCIA", "4"))
+# Reintentos ante 429/5xx o errores de red, con espera exponencial y jitter
+AI_REINTENTOS = int(os.getenv("AI_REINTENTOS", "2"))
+AI_BACKOFF_BASE_S = float(os.getenv("AI_BACKOFF_BASE_S", "1"))
+# Circuito: tras N llamadas fallidas seguidas se rechaza de inmediato durante AI_CIRCUITO_ABIERTO_S
+AI_CIRCUITO_FALLOS = int(os.getenv("AI_CIRCUITO_FALLOS", "5"))
+AI_CIRCUITO_ABIERTO_S = float(os.getenv("AI_CIRCUITO_ABIERTO_S", "30"))
+
+class ErrorReintentable(Exception):
+    pass
+
 class AuditorIA:
     def __init__(self):
         self.api_url = os.getenv("AI_API_URL", "https://recuperadora-api-ia-free.nojauc.easypanel.host/v1/chat/completions")
         self.api_key = os.getenv("AI_API_KEY", "mi_proxy_secreto")
+        self.circuito = Circuito("proxy IA", AI_CIRCUITO_FALLOS, AI_CIRCUITO_ABIERTO_S)
+        self._cupos = None
+        self.en_cola = 0
+        self.esperas = deque(maxlen=200)
+        self.stats = {"reintentos": 0}
+
+    async def _completar(self, payload: dict, headers: dict, timeout: float) -> str:
+        """
+        POST al proxy respetando el límite de concurrencia (cola FIFO), con reintentos ante
+        429/5xx y el circuito: si el proxy está caído se falla de inmediato sin encolar.
+        """
+        self.circuito.verificar()
+        if self._cupos is None:
+            self._cupos = asyncio.Semaphore(AI_MAX_CONCURRENCIA)
+        llegada = time.monotonic()
+        self.en_cola += 1
+        try:
+            await self._cupos.acquire()
+        finally:
+            self.en_cola -= 1
+        self.esperas.append(time.monotonic() - llegada)
+        inicio = time.monotonic()
+        try:
+            async with httpx.AsyncClient(timeout=timeout) as client:
+                for intento in range(AI_REINTENTOS + 1):
+                    try:
+                        response = await client.post(self.api_url, json=payload, headers=headers)
+                        if response.status_code == 429 or response.status_code >= 500:
+                            raise ErrorReintentable(f"HTTP {response.status_code}")
+                        response.raise_for_status()
+                        contenido = response.json()['choices'][0]['message']['content']
+                        self.circuito.exito(time.monotonic() - inicio)
+                        return contenido
+                    except (ErrorReintentable, httpx.TransportError) as e:
+                        if intento == AI_REINTENTOS:
+                            raise
+                        espera = AI_BACKOFF_BASE_S * 2 ** intento * random.uniform(0.5, 1.5)
+                        retry_after = response.headers.get("retry-after") if isinstance(e, ErrorReintentable) else None
+                        if retry_after and retry_after.isdigit():
+                            espera = max(espera, min(float(retry_after), 30))
+                        self.stats["reintentos"] += 1
+                        print(f"[IA] {e}, reintento {intento + 1}/{AI_REINTENTOS} en {espera:.1f}s")
+                        await asyncio.sleep(espera)
+        except httpx.HTTPStatusError:
+            # 4xx: el proxy responde, el problema es la solicitud (no abre el circuito)
+            self.circuito.exito()
+            raise
+        except Exception:
+            self.circuito.fallo(time.monotonic() - inicio)
+            raise
+        finally:
+            self._cupos.release()
+
+    def resumen(self) -> dict:
+        p95 = percentil(self.esperas, 95)
+        return {
+            **self.circuito.resumen(),
+            **self.stats,
+            "en_cola": self.en_cola,
+            "max_concurrencia": AI_MAX_CONCURRENCIA,
+            "espera_cola_p95_s": round(p95, 2) if p95 is not None else None,
+        }
     
     async def analizar_f29(self, data_scouting: dict):
         """
@@ -47,13 +127,9 @@ Tu objetivo es que la automatización sea útil y ahorre dinero al cliente."""
         }
 
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(self.api_url, json=payload, headers=headers)
-                response.raise_for_status()
-                result = response.json()
-                
-                # Extraer la respuesta de la IA
-                return result['choices'][0]['message']['content']
+            return await self._completar(payload, headers, timeout=30.0)
+        except CircuitoAbierto as e:
+            return f"El Auditor IA no está disponible en este momento ({e})."
         except Exception as e:
             return f"Error al conectar con el Auditor IA: {str(e)}"
 
@@ -73,10 +149,9 @@ Tu objetivo es que la automatización sea útil y ahorre dinero al cliente."""
         }
 
         try:
-            async with httpx.AsyncClient(timeout=40.0) as client:
-                response = await client.post(self.api_url, json=payload, headers=headers)
-                response.raise_for_status()
-                return response.json()['choices'][0]['message']['content']
+            return await self._completar(payload, headers, timeout=40.0)
+        except CircuitoAbierto as e:
+            return f"El Auditor IA no está disponible en este momento ({e})."
         except Exception as e:
             return f"Error en el chat: {str(e)}"
 
@@ -0,0 +1,278 @@
+import asyncio
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+# Extractor de un código F29 dentro de un frame. Recibe {c, estrategia}: si estrategia es
+# null prueba las tres en orden ('input', 'label', 'td'); si no, solo la indicada.
+# Retorna {valor, estrategia} o null.
+JS_EXTRAER_CODIGO_F29 = """({c, estrategia}) => {
+    const cleanNum = (str) => {
+        if (!str) return null;
+        const cleaned = str.replace(/[^0-9]/g, '');
+        return cleaned.length > 0 ? parseInt(cleaned).toString() : null;
+    };
+
+    // 1. Prioridad: Input con ID o Name que contenga el código
+    const porInput = () => {
+        const input = document.getElementById('valCode' + c) ||
+                      document.getElementById('code' + c) ||
+                      document.querySelector(`input[id*="${c}"]`) ||
+                      document.querySelector(`input[name*="${c}"]`);
+
+        if (input && input.value && cleanNum(input.value)) return input.value;
+        return null;
+    };
+
+    // 2. Búsqueda por "Label" o Celda que contenga el código (Regex)
+    // Buscamos algo como "[504]" o "504:" o "(504)" en el texto
+    const porLabel = () => {
+        const etiquetas = 'td, span, div, b, label';
+        const elements = Array.from(document.querySelectorAll(etiquetas));
+        const regex = new RegExp('(\\\\[|\\\\(|^|\\\\s)' + c + '(\\\\]|\\\\)|:|\\\\s|$)');
+
+        // El primer elemento más interno que contiene el código, no los contenedores que lo
+        // envuelven (misma regla que _por_label en la extracción desde snapshots)
+        const labelEl = elements.find(el => regex.test(el.innerText) &&
+            !Array.from(el.querySelectorAll(etiquetas)).some(h => regex.test(h.innerText)));
+
+        if (labelEl) {
+            // Si la celda misma tiene el número largo (ej: "504: 28.500.956")
+            if (cleanNum(labelEl.innerText) && cleanNum(labelEl.innerText).length > c.length) {
+                return labelEl.innerText;
+            }
+
+            // Si no, buscar en la fila o alrededores
+            const container = labelEl.closest('tr') || labelEl.closest('div.row') || labelEl.parentElement;
+            if (container) {
+                // Buscar input en el contenedor
+                const inCont = container.querySelector('input');
+                if (inCont && inCont.value && cleanNum(inCont.value)) return inCont.value;
+
+                // Buscar cualquier número largo en las celdas hermanas
+                const siblings = Array.from(container.querySelectorAll('td, div, span'));
+                for (let s of siblings.reverse()) {
+                    const val = cleanNum(s.innerText);
+                    if (val && val !== c) return s.innerText;
+                }
+            }
+        }
+        return null;
+    };
+
+    // ESTRATEGIA 3: Estructura de Tabla Simple (TD con código -> Sibling TD con valor)
+    // Común en vistas de resumen/propuesta
+    const porTd = () => {
+        const tds = Array.from(document.querySelectorAll('td'));
+        // Buscamos celda que tenga el código (ej: "538" o "[538]")
+        const codeTd = tds.find(td => td.innerText.includes('[' + c + ']') || td.innerText.trim() == c);
+
+        if (codeTd) {
+            // Buscar en las celdas siguientes de la misma fila
+            let sibling = codeTd.nextElementSibling;
+            while (sibling) {
+                const txt = sibling.innerText;
+                // Si tiene un número y NO es solo el código (evitar falsos positivos si el código se repite)
+                // Y es suficientemente largo o tiene formato moneda
+                if (cleanNum(txt) && cleanNum(txt) != c) {
+                    return txt;
+                }
+                sibling = sibling.nextElementSibling;
+            }
+        }
+        return null;
+    };
+
+    const estrategias = {input: porInput, label: porLabel, td: porTd};
+    const orden = estrategia ? [estrategia] : ['input', 'label', 'td'];
+    for (const nombre of orden) {
+        const valor = estrategias[nombre]();
+        if (valor) return {valor: valor, estrategia: nombre};
+    }
+    return null;
+}"""
+
+# Firma estructural de un frame: ruta de la URL y patrón de ids de inputs (sin dígitos),
+# estable entre periodos y contribuyentes para un mismo diseño de formulario.
+JS_FIRMA_FRAME = """() => {
+    const ids = Array.from(document.querySelectorAll('input[id]'))
+        .map(el => el.id.replace(/[0-9]+/g, '#'));
+    return location.pathname + location.hash.split('?')[0] + '|' + Array.from(new Set(ids)).sort().join(',');
+}"""
+
+
+def url_frame(url: str) -> str:
+    """URL de frame sin query string, para comparar frames entre ejecuciones."""
+    return url.split("?")[0]
+
+
+def limpiar_valor(valor: str):
+    """'$ 1.234.567' -> 1234567; None si no es un monto válido."""
+    val_limpio = valor.replace(".", "").replace("$", "").replace(",", "").strip()
+    return int(val_limpio) if val_limpio.isdigit() else None
+
+
+class MemoExtraccion:
+    """
+    Recuerda, por huella de diseño del formulario, en qué frame y con qué estrategia
+    se encontró cada código, para probar esa combinación primero en las siguientes
+    ejecuciones. Lleva estadísticas de aciertos.
+    """
+
+    def __init__(self):
+        self.layouts = {}
+        self.stats = {"aciertos": 0, "fallos_memo": 0, "busquedas_completas": 0}
+
+    async def huella(self, paginas) -> str:
+        """Huella del diseño a partir de los frames de 'paginas' (las del formulario, sin otras pestañas)."""
+        firmas = []
+        for p in paginas:
+            for frame in p.frames:
+                try:
+                    firmas.append(await frame.evaluate(JS_FIRMA_FRAME))
+                except Exception:
+                    continue
+        return hashlib.sha1("\n".join(sorted(firmas)).encode()).hexdigest()[:16]
+
+    def pista(self, huella: str, codigo: str):
+        return self.layouts.get(huella, {}).get(codigo)
+
+    def recordar(self, huella: str, codigo: str, frame_url: str, estrategia: str):
+        self.layouts.setdefault(huella, {})[codigo] = {"frame": url_frame(frame_url), "estrategia": estrategia}
+
+    def olvidar(self, huella: str, codigo: str):
+        self.layouts.get(huella, {}).pop(codigo, None)
+
+    def resumen(self) -> dict:
+        intentos = self.stats["aciertos"] + self.stats["fallos_memo"]
+        return {
+            **self.stats,
+            "layouts_conocidos": len(self.layouts),
+            "tasa_acierto": round(self.stats["aciertos"] / intentos, 3) if intentos else 0.0,
+        }
+
+# Instancia global compartida por todos los scrapers del proceso
+memo_extraccion = MemoExtraccion()
+
+
+# --- EXTRACCIÓN SIN NAVEGADOR (snapshots de DOM procesados en un pool de procesos) ---
+
+# Copia el valor actual de cada input al atributo 'value' para que quede en el HTML serializado
+JS_FIJAR_VALORES_INPUT = """() => {
+    document.querySelectorAll('input').forEach(i => i.setAttribute('value', i.value || ''));
+}"""
+
+_pool = None
+
+
+def _limpiar_num(texto):
+    """Equivalente a cleanNum del extractor JS: solo dígitos, sin ceros a la izquierda."""
+    digitos = re.sub(r"[^0-9]", "", texto or "")
+    return str(int(digitos)) if digitos else None
+
+
+def _por_input(tree, c):
+    candidatos = [
+        tree.xpath(f'//*[@id="valCode{c}"]'),
+        tree.xpath(f'//*[@id="code{c}"]'),
+        tree.xpath(f'//input[contains(@id, "{c}")]'),
+        tree.xpath(f'//input[contains(@name, "{c}")]'),
+    ]
+    for encontrados in candidatos:
+        if encontrados:
+            valor = encontrados[0].get("value")
+            return valor if _limpiar_num(valor) else None
+    return None
+
+
+def _por_label(tree, c):
+    regex = re.compile(r"(\[|\(|^|\s)" + c + r"(\]|\)|:|\s|$)")
+    etiquetas = ("td", "span", "div", "b", "label")
+    coincidencias = [el for el in tree.iter(*etiquetas) if regex.search(el.text_content())]
+    # El primer elemento más interno que contiene el código (no los contenedores que lo
+    # envuelven), en orden de documento: la misma regla que porLabel en JS_EXTRAER_CODIGO_F29
+    internos = [el for el in coincidencias
+                if not any(regex.search(h.text_content()) for h in el.iterdescendants(*etiquetas))]
+    if not internos:
+        return None
+    label = internos[0]
+    texto = label.text_content()
+    if _limpiar_num(texto) and len(_limpiar_num(texto)) > len(c) and limpiar_valor(texto) is not None:
+        return texto
+
+    container = next(label.iterancestors("tr"), None)
+    if container is None:
+        container = label.getparent()
+    if container is None:
+        return None
+    for inp in container.iter("input"):
+        if _limpiar_num(inp.get("value")):
+            return inp.get("value")
+    for s in reversed(list(container.iter("td", "div", "span"))):
+        val = _limpiar_num(s.text_content())
+        if val and val != c:
+            return s.text_content()
+    return None
+
+
+def _por_td(tree, c):
+    for td in tree.iter("td"):
+        texto = td.text_content()
+        if f"[{c}]" in texto or texto.strip() == c:
+            for sibling in td.itersiblings():
+                val = _limpiar_num(sibling.text_content())
+                if val and val != c:
+                    return sibling.text_content()
+            return None
+    return None
+
+
+def extraer_codigos_html(url: str, html: str, codigos) -> dict:
+    """
+    Aplica las estrategias input/label/td sobre el HTML de un frame (en un proceso del pool).
+    Retorna {codigo: {"valor": int, "frame": url, "estrategia": str}} con los códigos encontrados.
+    """
+    import lxml.html
+    try:
+        tree = lxml.html.fromstring(html)
+    except Exception:
+        return {}
+    encontrados = {}
+    for c in codigos:
+        for nombre, estrategia in (("input", _por_input), ("label", _por_label), ("td", _por_td)):
+            valor = limpiar_valor(estrategia(tree, c) or "")
+            if valor is not None:
+                encontrados[c] = {"valor": valor, "frame": url_frame(url), "estrategia": nombre}
+                break
+    return encontrados
+
+
+async def capturar_snapshots(paginas) -> list:
+    """HTML de cada frame de las pestañas del formulario ('paginas'), leído una sola vez."""
+    snapshots = []
+    for p in paginas:
+        for frame in p.frames:
+            try:
+                await frame.evaluate(JS_FIJAR_VALORES_INPUT)
+                snapshots.append((frame.url, await frame.content()))
+            except Exception:
+                continue
+    return snapshots
+
+
+async def extraer_en_pool(snapshots, codigos) -> dict:
+    """Procesa los snapshots en paralelo; ante códigos repetidos gana el primer frame (mismo orden que en el navegador)."""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=int(os.getenv("EXTRACCION_WORKERS") or os.cpu_count() or 2))
+    loop = asyncio.get_running_loop()
+    parciales = await asyncio.gather(*[
+        loop.run_in_executor(_pool, extraer_codigos_html, url, html, list(codigos))
+        for url, html in snapshots
+    ])
+    resultado = {}
+    for parcial in parciales:
+        for codigo, info in parcial.items():
+            resultado.setdefault(codigo, info)
+    return resultado
@@ -0,0 +1,174 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from rcv_modelo import ResumenRCV
+
+HISTORIAL_DB = os.getenv("HISTORIAL_DB", "historial.db")
+
+MESES = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
+
+# Formularios guardados
+F29 = "F29"                      # declaración presentada (histórico)
+F29_PROPUESTA = "F29_PROPUESTA"  # formulario/propuesta del periodo en curso
+RCV_COMPRA = "RCV_COMPRA"
+RCV_VENTA = "RCV_VENTA"
+
+
+def normalizar_rut(rut: str) -> str:
+    return rut.replace(".", "").replace("-", "").upper()
+
+
+def periodo_clave(anio, mes):
+    """('2025', 'Marzo' | '03' | 3) -> '2025-03'; None si no se puede interpretar."""
+    if not anio or not mes:
+        return None
+    mes = str(mes).strip()
+    if mes.isdigit():
+        numero = int(mes)
+    else:
+        nombres = [m.lower() for m in MESES]
+        if mes.lower() not in nombres:
+            return None
+        numero = nombres.index(mes.lower()) + 1
+    if not 1 <= numero <= 12:
+        return None
+    return f"{int(anio):04d}-{numero:02d}"
+
+
+def periodo_desde_texto(texto: str):
+    """Busca 'Marzo 2025' / 'Marzo de 2025' / '03-2025' en un texto de la página del SII."""
+    if not texto:
+        return None
+    for i, nombre in enumerate(MESES):
+        m = re.search(rf"{nombre}\D{{0,4}}(\d{{4}})", texto, re.IGNORECASE)
+        if m:
+            return periodo_clave(m.group(1), i + 1)
+    m = re.search(r"\b(\d{1,2})[-/](\d{4})\b", texto)
+    return periodo_clave(m.group(2), m.group(1)) if m else None
+
+
+def periodo_en_texto(texto: str, periodo: str) -> bool:
+    """¿El texto muestra el periodo 'AAAA-MM' ('Marzo 2025', 'Marzo de 2025', '03/2025', '2025-03')?"""
+    if not texto or not periodo:
+        return False
+    anio, mm = periodo.split("-")
+    nombre = MESES[int(mm) - 1]
+    patrones = [rf"{nombre}\s+(de\s+)?{anio}", rf"\b{mm}\s*[-/]\s*{anio}\b", rf"\b{anio}\s*[-/]?\s*{mm}\b"]
+    return any(re.search(p, texto, re.IGNORECASE) for p in patrones)
+
+
+def rango_periodos(desde: str, hasta: str) -> list:
+    """('2024-11', '2025-02') -> [('2024', 'Noviembre'), ..., ('2025', 'Febrero')]."""
+    anio, mes = (int(x) for x in desde.split("-"))
+    anio_fin, mes_fin = (int(x) for x in hasta.split("-"))
+    if not (1 <= mes <= 12 and 1 <= mes_fin <= 12):
+        raise ValueError("Mes fuera de rango")
+    periodos = []
+    while (anio, mes) <= (anio_fin, mes_fin):
+        periodos.append((str(anio), MESES[mes - 1]))
+        mes += 1
+        if mes > 12:
+            mes, anio = 1, anio + 1
+    return periodos
+
+
+class HistorialSII:
+    """
+    Almacén SQLite de todo lo extraído del SII, una fila por (RUT, periodo, formulario)
+    con los datos en JSON. Cada nueva extracción reemplaza la anterior del mismo periodo.
+    """
+
+    def __init__(self, path: str = HISTORIAL_DB):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _conexion(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS extracciones (
+                    rut TEXT NOT NULL,
+                    periodo TEXT NOT NULL,
+                    formulario TEXT NOT NULL,
+                    datos TEXT NOT NULL,
+                    fuente TEXT,
+                    actualizado REAL NOT NULL,
+                    PRIMARY KEY (rut, periodo, formulario)
+                )
+            """)
+            self._conn.commit()
+        return self._conn
+
+    def guardar(self, rut: str, periodo: str, formulario: str, datos: dict, fuente: str = None):
+        """Guarda (o reemplaza) una extracción. Un error del historial nunca interrumpe el scraping."""
+        if not periodo:
+            return
+        try:
+            with self._lock:
+                conn = self._conexion()
+                conn.execute(
+                    "INSERT OR REPLACE INTO extracciones (rut, periodo, formulario, datos, fuente, actualizado) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (normalizar_rut(rut), periodo, formulario, json.dumps(datos, ensure_ascii=False), fuente, time.time())
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"[{rut}] ⚠️ No se pudo guardar {formulario} {periodo} en el historial: {e}")
+
+    def obtener(self, rut: str, periodo: str, formulario: str):
+        """{'datos', 'fuente', 'actualizado'} o None si no hay nada guardado."""
+        with self._lock:
+            fila = self._conexion().execute(
+                "SELECT datos, fuente, actualizado FROM extracciones WHERE rut = ? AND periodo = ? AND formulario = ?",
+                (normalizar_rut(rut), periodo, formulario)
+            ).fetchone()
+        if fila is None:
+            return None
+        return {"datos": json.loads(fila[0]), "fuente": fila[1], "actualizado": fila[2]}
+
+    def invalidar(self, rut: str, periodo: str, formulario: str):
+        """Borra una extracción guardada (p. ej. una lectura que resultó incompleta)."""
+        try:
+            with self._lock:
+                conn = self._conexion()
+                conn.execute(
+                    "DELETE FROM extracciones WHERE rut = ? AND periodo = ? AND formulario = ?",
+                    (normalizar_rut(rut), periodo, formulario)
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"[{rut}] ⚠️ No se pudo invalidar {formulario} {periodo} en el historial: {e}")
+
+    def periodos(self, rut: str, formulario: str) -> list:
+        with self._lock:
+            filas = self._conexion().execute(
+                "SELECT periodo FROM extracciones WHERE rut = ? AND formulario = ? ORDER BY periodo",
+                (normalizar_rut(rut), formulario)
+            ).fetchall()
+        return [f[0] for f in filas]
+
+    def guardar_f29(self, rut: str, periodo: str, codigos: dict, propuesta: bool = False, fuente: str = None):
+        self.guardar(rut, periodo, F29_PROPUESTA if propuesta else F29, codigos, fuente)
+
+    def f29(self, rut: str, periodo: str, propuesta: bool = False):
+        """Mapa de códigos F29 guardado para el periodo, o None."""
+        entrada = self.obtener(rut, periodo, F29_PROPUESTA if propuesta else F29)
+        return entrada["datos"] if entrada else None
+
+    def guardar_rcv(self, resumen: ResumenRCV, periodo: str = None, fuente: str = None):
+        formulario = RCV_VENTA if resumen.operacion == "venta" else RCV_COMPRA
+        self.guardar(resumen.rut, periodo or resumen.periodo, formulario, resumen.to_dict(), fuente)
+
+    def rcv(self, rut: str, periodo: str, operacion: str = "compra"):
+        """ResumenRCV guardado para el periodo, o None."""
+        entrada = self.obtener(rut, periodo, RCV_VENTA if operacion == "venta" else RCV_COMPRA)
+        return ResumenRCV.desde_dict(entrada["datos"]) if entrada else None
+
+# Instancia global compartida por todos los scrapers del proceso
+historial = HistorialSII()
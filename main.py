@@ -1,15 +1,27 @@
-﻿from fastapi import FastAPI, HTTPException, BackgroundTasks, Header, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse
+﻿from fastapi import FastAPI, HTTPException, BackgroundTasks, Header, WebSocket, WebSocketDisconnect, Request
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from typing import Optional, List
 import os
 import uuid
+import time
+import math
 import asyncio
 import json
 from datetime import datetime, timedelta, timezone
-from scraper import SIIScraper
+from scraper import SIIScraper, PlazoAgotado
 from scraper_anual import SIIScraperAnual
 from auditor_ia import auditor
+from artefactos import trazas
+from extraccion_f29 import memo_extraccion
+from recursos import memoria, cancelaciones, MemoriaInsuficiente, MEMORY_QUEUE_TIMEOUT_S
+from pool_navegadores import pool_navegadores
+from salud import salud_sii, tiempos_pasos, CircuitoAbierto
+from historial import rango_periodos
+from sii_http import COLUMNAS_BHE, CredencialesInvalidas, verificar_no_rechazado
+from rcv_modelo import (iterar_detalle_csv, stream_ndjson, stream_csv, filas_periodo_rcv,
+                        COLUMNAS_ANUALES, EscritorXlsx, EscritorParquet)
 
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -27,6 +39,36 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("shutdown")
+async def cerrar_pool_navegadores():
+    await pool_navegadores.cerrar()
+
+@app.exception_handler(CredencialesInvalidas)
+async def credenciales_invalidas_handler(request, exc: CredencialesInvalidas):
+    return JSONResponse(status_code=401, content={"detail": f"Credenciales SII rechazadas: {exc}"})
+
+@app.exception_handler(MemoriaInsuficiente)
+async def memoria_insuficiente_handler(request, exc: MemoriaInsuficiente):
+    # Sin presupuesto de memoria para otro navegador: el cliente puede reintentar más tarde
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(int(MEMORY_QUEUE_TIMEOUT_S))}
+    )
+
+@app.exception_handler(CircuitoAbierto)
+async def circuito_abierto_handler(request, exc: CircuitoAbierto):
+    # El SII está degradado: se responde al instante en vez de esperar sus timeouts
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"SII degradado: {exc}", "host": exc.nombre},
+        headers={"Retry-After": str(max(1, math.ceil(exc.reintentar_en)))}
+    )
+
+@app.exception_handler(PlazoAgotado)
+async def plazo_agotado_handler(request, exc: PlazoAgotado):
+    return JSONResponse(status_code=504, content={"detail": str(exc), "paso": exc.paso, "pasos_mas_lentos": exc.pasos})
+
 # --- HELPER PARA LOGS CON HORA CHILE ---
 def get_chile_time():
     return datetime.now(timezone(timedelta(hours=-3))).strftime("%Y-%m-%d %H:%M:%S")
@@ -57,12 +99,35 @@ manager = ConnectionManager()
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
     scraper_instance = None
+    task = None
+    calentamiento = None
+    latido = None
+    sesion_tomada = asyncio.Event()
+    sesion_lista = asyncio.Event()  # el precalentamiento terminó su login y la sesión sigue abierta
+
+    # Definir callback para el scraper
+    async def scraper_logger(msg, log_type="info"):
+        await manager.send_personal_message({
+            "type": "log",
+            "text": msg,
+            "log_type": log_type
+        }, websocket)
+
     try:
         while True:
             data = await websocket.receive_text()
             command_data = json.loads(data)
             
-            if command_data.get("command") == "start_live_scout":
+            if command_data.get("command") == "prewarm":
+                # Login especulativo apenas se conocen RUT/clave, antes de que el usuario pulse iniciar
+                if scraper_instance is None:
+                    scraper_instance = SIIScraper(
+                        command_data.get("rut"), command_data.get("clave"),
+                        log_callback=scraper_logger, prioridad="interactiva"
+                    )
+                    calentamiento = asyncio.create_task(precalentar_sesion(scraper_instance, websocket, sesion_tomada, sesion_lista))
+
+            elif command_data.get("command") == "start_live_scout":
                 rut = command_data.get("rut")
                 clave = command_data.get("clave")
                 
@@ -72,23 +137,42 @@ async def websocket_endpoint(websocket: WebSocket):
                     "log_type": "info"
                 }, websocket)
 
-                # Definir callback para el scraper
-                async def scraper_logger(msg, log_type="info"):
-                    await manager.send_personal_message({
-                        "type": "log",
-                        "text": msg,
-                        "log_type": log_type
-                    }, websocket)
-
-                # Instanciar y ejecutar
-                scraper_instance = SIIScraper(rut, clave, log_callback=scraper_logger)
+                # Instanciar y ejecutar (reutilizando la sesión precalentada si es del mismo RUT)
+                # Un scouting anterior en curso se corta: dos no pueden manejar la misma pestaña
+                if task and not task.done():
+                    task.cancel()
+                    try:
+                        await task
+                    except BaseException:
+                        pass
+                if scraper_instance and (scraper_instance.rut, scraper_instance.clave) == (rut, clave):
+                    if sesion_lista.is_set() and not sesion_tomada.is_set():
+                        stats_precalentado["usadas"] += 1
+                    sesion_tomada.set()
+                else:
+                    if calentamiento:
+                        calentamiento.cancel()
+                    if scraper_instance:
+                        await scraper_instance.close_session()
+                    scraper_instance = SIIScraper(rut, clave, log_callback=scraper_logger, prioridad="interactiva")
                 
+                # Cada inicio es un trabajo nuevo aunque reutilice el scraper de la conexión
+                scraper_instance.salud_verificada = False
+                try:
+                    verificar_salud_sii("live", scraper_instance)
+                except CircuitoAbierto as e:
+                    await manager.send_personal_message({"type": "log", "text": f"⚠️ SII degradado, intenta más tarde: {e}", "log_type": "error"}, websocket)
+                    continue
+
                 mes = command_data.get("mes")
                 anio = command_data.get("anio")
                 
                 # Ejecutar en background para no bloquear el loop de lectura de WS
                 # Usamos asyncio.create_task para que corra "en paralelo"
                 task = asyncio.create_task(run_live_scout(scraper_instance, websocket, mes, anio))
+                if latido:
+                    latido.cancel()
+                latido = asyncio.create_task(mantener_sesion_viva(scraper_instance, websocket, task))
                 SESSIONS[rut] = {"scraper": scraper_instance, "task": task}
 
             elif command_data.get("command") == "confirm_f29_submission":
@@ -96,6 +180,9 @@ async def websocket_endpoint(websocket: WebSocket):
                 banco = command_data.get("banco")
                 if rut in SESSIONS:
                     scraper = SESSIONS[rut]["scraper"]
+                    # El envío usa la sesión de inmediato: ya no hace falta renovarla
+                    if latido:
+                        latido.cancel()
                     # Nota: AquÃ­ necesitarÃ­amos la instancia de 'page' activa.
                     # Por simplicidad en este MVP, asumimos que navigate_to_f29 dejÃ³ el browser abierto.
                     # En una versiÃ³n pro, pasarÃ­amos la pÃ¡gina.
@@ -105,8 +192,69 @@ async def websocket_endpoint(websocket: WebSocket):
 
     except WebSocketDisconnect:
         manager.disconnect(websocket)
+        for pendiente in (calentamiento, latido):
+            if pendiente and not pendiente.done():
+                pendiente.cancel()
+        # Nadie espera ya el resultado: se corta el agente (navegador y llamada a la IA)
+        if task and not task.done():
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
         if scraper_instance:
              await scraper_instance.close_session()
+             if SESSIONS.get(scraper_instance.rut, {}).get("scraper") is scraper_instance:
+                 del SESSIONS[scraper_instance.rut]
+
+async def precalentar_sesion(scraper, websocket, sesion_tomada: asyncio.Event, sesion_lista: asyncio.Event):
+    """
+    Reserva un contexto del pool y hace login por adelantado. Si nadie inicia el agente
+    dentro de LIVE_PRECALENTADO_IDLE_S, la sesión se libera para no retener el navegador.
+    """
+    stats_precalentado["iniciadas"] += 1
+    try:
+        await scraper.precalentar()
+    except CredencialesInvalidas as e:
+        await manager.send_personal_message({"type": "log", "text": f"❌ Credenciales SII rechazadas: {e}", "log_type": "error"}, websocket)
+        return
+    except Exception as e:
+        # El inicio real reintentará el login por su cuenta
+        print(f"[{scraper.rut}] No se pudo precalentar la sesión: {e}")
+        return
+    sesion_lista.set()
+    try:
+        await asyncio.wait_for(sesion_tomada.wait(), LIVE_PRECALENTADO_IDLE_S)
+    except asyncio.TimeoutError:
+        stats_precalentado["expiradas"] += 1
+        print(f"[{scraper.rut}] Sesión precalentada sin usar tras {LIVE_PRECALENTADO_IDLE_S:.0f}s, liberando navegador.")
+        sesion_lista.clear()
+        await scraper.close_session()
+
+async def mantener_sesion_viva(scraper, websocket, scout):
+    """
+    Mientras el formulario F29 espera la confirmación del usuario, renueva la sesión del SII
+    cada SII_KEEPALIVE_S e informa al cliente si sigue vigente, para que el envío final no
+    tenga que repetir la navegación. Solo corre si el scouting dejó el formulario listo; se
+    cancela al confirmar el envío y, si la confirmación no llega en SII_KEEPALIVE_MAX_S, deja
+    de renovar y libera el navegador.
+    """
+    await asyncio.wait({scout})
+    if scout.cancelled() or scout.exception() or not scout.result():
+        return
+    limite = time.monotonic() + SII_KEEPALIVE_MAX_S
+    while scraper.page and not scraper.page.is_closed():
+        if time.monotonic() >= limite:
+            print(f"[{scraper.rut}] Sin confirmación del envío tras {SII_KEEPALIVE_MAX_S:.0f}s, liberando la sesión.")
+            await manager.send_personal_message({"type": "log", "text": "⚠️ La sesión del SII se cerró por inactividad; será necesario reiniciar el scouting.", "log_type": "error"}, websocket)
+            await scraper.close_session()
+            return
+        estado = await scraper.latido_sesion()
+        await manager.send_personal_message({"type": "session_status", **estado}, websocket)
+        if not estado["vigente"]:
+            await manager.send_personal_message({"type": "log", "text": "⚠️ La sesión del SII expiró; será necesario reiniciar el scouting.", "log_type": "error"}, websocket)
+            return
+        await asyncio.sleep(min(SII_KEEPALIVE_S, max(0, limite - time.monotonic())))
 
 async def run_final_submission(scraper, websocket, banco):
     try:
@@ -129,13 +277,23 @@ async def run_final_submission(scraper, websocket, banco):
         await manager.send_personal_message({"type": "log", "text": f"ðŸ’¥ Error en envÃ­o: {str(e)}", "log_type": "error"}, websocket)
 
 async def run_live_scout(scraper, websocket, mes=None, anio=None):
+    inicio = time.monotonic()
+    etapa = "f29+rcv"
     try:
-        # 1. Ejecutamos la navegaciÃ³n del F29 (Propuesta)
-        result_f29 = await scraper.navigate_to_f29_from_home(mes, anio)
-        
-        # 2. Cruce de datos con el Registro de Compras (RCV) para detectar facturas pendientes
-        # Esto es el "Siguiente Nivel"
-        rcv_data = await scraper.check_pending_rcv(mes, anio)
+        # 1. Navegación del F29 (Propuesta) en la pestaña principal y, al mismo tiempo,
+        # 2. cruce con el Registro de Compras (RCV) en su propia pestaña para detectar facturas pendientes
+        # (comparten el login de la sesión; el F29 queda abierto para el envío)
+        f29 = asyncio.create_task(scraper.navigate_to_f29_from_home(mes, anio))
+        rcv = asyncio.create_task(scraper.check_pending_rcv(mes, anio))
+        try:
+            result_f29, rcv_data = await asyncio.gather(f29, rcv)
+        finally:
+            # Si una falla (o se cancela el scouting) la otra no sigue usando la sesión,
+            # y la pestaña del RCV no queda abierta por el resto de la sesión en vivo
+            for tarea in (f29, rcv):
+                tarea.cancel()
+            await asyncio.gather(f29, rcv, return_exceptions=True)
+            await scraper.cerrar_pestana("rcv")
         
         if result_f29:
              # GUARDAR CONTEXTO PARA EL CHAT POST-EJECUCIÃ“N
@@ -153,7 +311,9 @@ async def run_live_scout(scraper, websocket, mes=None, anio=None):
              
              # Obtener el anÃ¡lisis de la IA automÃ¡ticamente
              await manager.send_personal_message({"type": "log", "text": "ðŸ¤– Solicitando anÃ¡lisis al Auditor IA...", "log_type": "info"}, websocket)
+             etapa = "ia"
              analisis_ia = await auditor.analizar_f29(scouting_data)
+             etapa = "envio"
              
              # Prompt enriquecido con los datos extraÃ­dos para el chat posterior
              datos_txt = json.dumps(scouting_data.get('datos', {}), indent=2)
@@ -205,7 +365,13 @@ async def run_live_scout(scraper, websocket, mes=None, anio=None):
                 "text": "âŒ El proceso finalizÃ³ sin resultados o con error.",
                 "log_type": "error"
             }, websocket)
-            
+        cancelaciones.terminado("live_agent", time.monotonic() - inicio)
+        return bool(result_f29)
+
+    except asyncio.CancelledError:
+        # El socket se cerró: el navegador lo cierra quien canceló
+        cancelaciones.cancelado("live_agent", time.monotonic() - inicio, etapa)
+        raise
     except Exception as e:
         await manager.send_personal_message({
             "type": "log",
@@ -247,6 +413,13 @@ class RCVAnualRequest(BaseModel):
     rut: str
     clave: str
 
+class RCVDetalleRequest(BaseModel):
+    rut: str
+    clave: str
+    anio: str
+    mes: str
+    operacion: Optional[str] = "compra"
+
 class F29Request(BaseModel):
     rut: str
     clave: str
@@ -254,11 +427,134 @@ class F29Request(BaseModel):
     mes: str
     es_propuesta: Optional[bool] = True
 
+class F29HistoricoRequest(BaseModel):
+    rut: str
+    clave: str
+    desde: str  # AAAA-MM
+    hasta: str  # AAAA-MM
+    usar_historial: Optional[bool] = True
+
+class BHERequest(BaseModel):
+    rut: str
+    clave: str
+    desde: str  # AAAA-MM
+    hasta: str  # AAAA-MM
+
+# Máximo de periodos por consulta masiva
+MAX_PERIODOS_MASIVO = 36
+
+# Hosts del SII que necesita cada tipo de trabajo (todos pasan por el login en zeusr)
+HOST_LOGIN = "zeusr.sii.cl"
+HOSTS_POR_TRABAJO = {
+    "rcv": ("www4.sii.cl",),
+    "f29": ("www4.sii.cl",),
+    "bhe": ("proxy.sii.cl",),
+    "carpeta": ("misiir.sii.cl",),
+    "live": ("misiir.sii.cl", "www4.sii.cl"),
+}
+
+def verificar_salud_sii(tipo: str, scraper):
+    """
+    Rechaza con CircuitoAbierto (503) el trabajo que depende de un host del SII degradado.
+    Se verifica una vez por trabajo (scraper.salud_verificada; el agente en vivo lo reinicia
+    en cada inicio): con el circuito semiabierto, ese trabajo es la prueba.
+    """
+    if scraper.salud_verificada:
+        return
+    salud_sii.verificar(HOST_LOGIN, *HOSTS_POR_TRABAJO.get(tipo.split("_")[0], ()))
+    scraper.salud_verificada = True
+
+# Sesión precalentada del agente en vivo: se libera si no se usa en este tiempo
+LIVE_PRECALENTADO_IDLE_S = float(os.getenv("LIVE_PRECALENTADO_IDLE_S", "120"))
+stats_precalentado = {"iniciadas": 0, "usadas": 0, "expiradas": 0}
+# Intervalo del latido que mantiene viva la sesión del SII mientras se espera la confirmación
+SII_KEEPALIVE_S = float(os.getenv("SII_KEEPALIVE_S", "240"))
+# Tiempo máximo esperando la confirmación del envío antes de dejar de renovar y liberar la sesión
+SII_KEEPALIVE_MAX_S = float(os.getenv("SII_KEEPALIVE_MAX_S", "1800"))
+
+# Plazo total por solicitud (header X-Deadline-Ms o query deadline_s); 0 = sin plazo
+DEADLINE_DEFAULT_S = float(os.getenv("DEADLINE_DEFAULT_S", "0"))
+DEADLINE_MAX_S = float(os.getenv("DEADLINE_MAX_S", "900"))
+# Margen tras el plazo antes de cancelar a la fuerza un paso que no respeta su timeout
+DEADLINE_GRACIA_S = float(os.getenv("DEADLINE_GRACIA_S", "5"))
+
 # Directorio para archivos generados
 TEMP_DIR = "temp_pdfs"
 if not os.path.exists(TEMP_DIR):
     os.makedirs(TEMP_DIR)
 
+def plazo_solicitud(request: Request) -> float:
+    """Plazo en segundos pedido por el cliente (X-Deadline-Ms o ?deadline_s=), acotado a DEADLINE_MAX_S."""
+    try:
+        if request.headers.get("x-deadline-ms"):
+            plazo = float(request.headers["x-deadline-ms"]) / 1000
+        elif request.query_params.get("deadline_s"):
+            plazo = float(request.query_params["deadline_s"])
+        else:
+            plazo = DEADLINE_DEFAULT_S
+    except ValueError:
+        raise HTTPException(status_code=400, detail="X-Deadline-Ms / deadline_s deben ser numéricos.")
+    if plazo < 0:
+        raise HTTPException(status_code=400, detail="El plazo no puede ser negativo.")
+    return min(plazo, DEADLINE_MAX_S) if plazo else 0
+
+async def ejecutar_cancelable(request: Request, tipo: str, trabajo, scraper=None):
+    """
+    Ejecuta la corutina 'trabajo' y la cancela si el cliente HTTP se desconecta antes de
+    que termine, cerrando la sesión del scraper para liberar el navegador de inmediato.
+    Con plazo, el scraper lo reparte entre sus pasos y, si algún paso no lo respeta,
+    la tarea se cancela al vencer el margen y se responde 504 indicando en qué paso iba.
+    """
+    inicio = time.monotonic()
+    if scraper:
+        verificar_salud_sii(tipo, scraper)
+    plazo = plazo_solicitud(request)
+    limite = inicio + plazo if plazo else None
+    if scraper and plazo:
+        # Varias llamadas de una misma solicitud comparten un único plazo
+        if scraper.deadline is None:
+            scraper.fijar_plazo(plazo)
+        limite = scraper.deadline
+    tarea = asyncio.create_task(trabajo)
+    while not tarea.done():
+        await asyncio.wait({tarea}, timeout=1.0)
+        if not tarea.done() and limite and time.monotonic() > limite + DEADLINE_GRACIA_S:
+            tarea.cancel()
+            try:
+                await tarea
+            except BaseException:
+                pass
+            if scraper:
+                await scraper.close_session()
+            cancelaciones.cancelado(tipo, time.monotonic() - inicio, "plazo")
+            paso = scraper.paso_actual if scraper else tipo
+            raise PlazoAgotado(paso, scraper.pasos_consumidos() if scraper else [])
+        if not tarea.done() and await request.is_disconnected():
+            tarea.cancel()
+            try:
+                await tarea
+            except BaseException:
+                pass
+            if scraper:
+                await scraper.close_session()
+            cancelaciones.cancelado(tipo, time.monotonic() - inicio)
+            print(f"[{get_chile_time()}] Cliente desconectado: '{tipo}' cancelado tras {time.monotonic() - inicio:.1f}s.")
+            raise HTTPException(status_code=499, detail="Cliente desconectado.")
+    cancelaciones.terminado(tipo, time.monotonic() - inicio)
+    return tarea.result()
+
+async def transmitir_cancelable(tipo: str, chunks):
+    """Reenvía un stream y registra si el cliente lo cortó antes del final (Starlette cancela la tarea)."""
+    inicio = time.monotonic()
+    try:
+        async for chunk in chunks:
+            yield chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        cancelaciones.cancelado(tipo, time.monotonic() - inicio)
+        await chunks.aclose()
+        raise
+    cancelaciones.terminado(tipo, time.monotonic() - inicio)
+
 def cleanup_file(path: str):
     """Elimina el archivo despuÃ©s de un tiempo para no llenar el disco."""
     try:
@@ -272,9 +568,27 @@ def cleanup_file(path: str):
 def health_check():
     return {"status": "online", "service": "automatizaciones-sii"}
 
+@app.get("/sii/metricas")
+def api_metricas(x_api_key: str = Header(None)):
+    """Métricas internas del servicio (trazas, extracción F29, memoria y pool de navegadores)."""
+    if x_api_key != API_KEY_CREDENTIAL:
+        raise HTTPException(status_code=403, detail="Acceso denegado: API Key inválida.")
+    return {
+        "trazas": trazas.resumen(),
+        "extraccion_f29": memo_extraccion.resumen(),
+        "memoria": memoria.resumen(),
+        "pool_navegadores": pool_navegadores.resumen(),
+        "cancelaciones": cancelaciones.resumen(),
+        "sesiones_precalentadas": stats_precalentado,
+        "auditor_ia": auditor.resumen(),
+        "salud_sii": salud_sii.resumen(),
+        "tiempos_pasos": tiempos_pasos.resumen()
+    }
+
 @app.post("/sii/rcv-resumen")
 async def api_rcv_resumen(
     req: RCVRequest, 
+    request: Request,
     x_api_key: str = Header(None)
 ):
     # ValidaciÃ³n bÃ¡sica de API Key
@@ -284,7 +598,7 @@ async def api_rcv_resumen(
     scraper = SIIScraper(req.rut, req.clave)
     
     # Ejecutar el scraper
-    data = await scraper.get_rcv_resumen()
+    data = await ejecutar_cancelable(request, "rcv_resumen", scraper.get_rcv_resumen(), scraper)
     
     if data is None:
         raise HTTPException(
@@ -296,12 +610,55 @@ async def api_rcv_resumen(
         "status": "success",
         "rut": req.rut,
         "periodo": "actual",
-        "resumen_compras": data
+        "resumen_compras": data.to_filas(),
+        "totales": data.totales()
     }
 
+@app.post("/sii/rcv-detalle")
+async def api_rcv_detalle(
+    req: RCVDetalleRequest,
+    request: Request,
+    x_api_key: str = Header(None),
+    formato: Optional[str] = "ndjson"
+):
+    """Detalle factura a factura del RCV, transmitido fila a fila (ndjson o csv)."""
+    if x_api_key != API_KEY_CREDENTIAL:
+        raise HTTPException(status_code=403, detail="Acceso denegado: API Key inválida.")
+    if req.operacion not in ("compra", "venta") or formato not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="operacion debe ser compra|venta y formato ndjson|csv.")
+
+    filename = f"rcv_{req.rut.replace('-', '')}_{req.anio}{req.mes.zfill(2)}_{uuid.uuid4().hex[:6]}.csv"
+    file_path = os.path.join(TEMP_DIR, filename)
+
+    scraper = SIIScraper(req.rut, req.clave)
+    try:
+        success = await ejecutar_cancelable(
+            request, "rcv_detalle", scraper.descargar_detalle_rcv(req.anio, req.mes, file_path, req.operacion), scraper
+        )
+    except HTTPException:
+        cleanup_file(file_path)
+        raise
+
+    if not success:
+        cleanup_file(file_path)
+        raise HTTPException(
+            status_code=500,
+            detail="Error al descargar el detalle del RCV. Verifica credenciales o el estado de la web del SII."
+        )
+
+    filas = iterar_detalle_csv(file_path)
+    if formato == "csv":
+        cuerpo, media_type = stream_csv(filas), "text/csv"
+    else:
+        cuerpo, media_type = stream_ndjson(filas), "application/x-ndjson"
+
+    # El archivo temporal se borra apenas termina la transmisión
+    return StreamingResponse(cuerpo, media_type=media_type, background=BackgroundTask(cleanup_file, file_path))
+
 @app.post("/sii/descargar-carpeta")
 async def api_descargar_carpeta(
     req: CarpetaRequest, 
+    request: Request,
     background_tasks: BackgroundTasks,
     x_api_key: str = Header(None)
 ):
@@ -321,7 +678,7 @@ async def api_descargar_carpeta(
     }
     
     # Ejecutar el scraper
-    success = await scraper.get_carpeta_tributaria(file_path, datos_envio)
+    success = await ejecutar_cancelable(request, "carpeta_tributaria", scraper.get_carpeta_tributaria(file_path, datos_envio), scraper)
     
     if not success:
         # Intentamos borrar si quedÃ³ un archivo corrupto
@@ -342,16 +699,77 @@ async def api_descargar_carpeta(
         media_type='application/pdf'
     )
 
+async def stream_rcv_anual(scraper, formato):
+    """Transmite cada periodo del RCV anual (csv o ndjson) apenas termina de extraerse."""
+    if formato == "csv":
+        yield ",".join(COLUMNAS_ANUALES) + "\r\n"
+    async for item in scraper.iterar_rcv_ultimos_12_meses():
+        filas = filas_periodo_rcv(item)
+        chunks = stream_csv(filas, encabezado=COLUMNAS_ANUALES, con_encabezado=False) if formato == "csv" else stream_ndjson(filas)
+        for chunk in chunks:
+            yield chunk
+
+async def archivo_rcv_anual(scraper, formato, file_path):
+    """Escribe el RCV anual (xlsx o parquet) a disco periodo a periodo, sin acumular el año en memoria."""
+    escritor = EscritorXlsx(file_path) if formato == "xlsx" else EscritorParquet(file_path)
+    try:
+        async for item in scraper.iterar_rcv_ultimos_12_meses():
+            escritor.escribir(filas_periodo_rcv(item))
+    finally:
+        escritor.cerrar()
+
 @app.post("/sii/rcv-anual-consolidado")
 async def api_rcv_anual(
     req: RCVAnualRequest, 
-    x_api_key: str = Header(None)
+    request: Request,
+    x_api_key: str = Header(None),
+    format: Optional[str] = "json"
 ):
     if x_api_key != API_KEY_CREDENTIAL:
         raise HTTPException(status_code=403, detail="Acceso denegado: API Key invÃ¡lida.")
+    if format not in ("json", "csv", "ndjson", "xlsx", "parquet"):
+        raise HTTPException(status_code=400, detail="format debe ser json, csv, ndjson, xlsx o parquet.")
+
+    # Las respuestas transmitidas ya no pueden cambiar su status: el rechazo reciente se responde antes
+    verificar_no_rechazado(req.rut, req.clave)
+    scraper = SIIScraperAnual(req.rut, req.clave, prioridad="batch")
+    verificar_salud_sii("rcv_anual", scraper)
+    scraper.fijar_plazo(plazo_solicitud(request))
+    rut_limpio = req.rut.replace('-', '')
+
+    if format in ("csv", "ndjson"):
+        # Las filas salen al cliente a medida que se completa cada mes
+        media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+        return StreamingResponse(
+            transmitir_cancelable("rcv_anual", stream_rcv_anual(scraper, format)),
+            media_type=media_type,
+            headers={"Content-Disposition": f"attachment; filename=RCV_Anual_{rut_limpio}.{format}"}
+        )
+
+    if format in ("xlsx", "parquet"):
+        # Formatos con índice al final: se escriben a disco por periodo y se envían al cerrar
+        file_path = os.path.join(TEMP_DIR, f"rcv_anual_{rut_limpio}_{uuid.uuid4().hex[:6]}.{format}")
+        try:
+            await ejecutar_cancelable(request, "rcv_anual", archivo_rcv_anual(scraper, format, file_path), scraper)
+        except ImportError as e:
+            raise HTTPException(status_code=501, detail=f"Formato {format} no disponible en este servidor: {e}")
+        except (HTTPException, CredencialesInvalidas, PlazoAgotado, MemoriaInsuficiente, CircuitoAbierto):
+            # Cada uno tiene su propio status (401/503/504) vía los exception handlers
+            cleanup_file(file_path)
+            raise
+        except Exception:
+            cleanup_file(file_path)
+            raise HTTPException(
+                status_code=500,
+                detail="Error al extraer RCV anual. Verifica credenciales o el estado de la web del SII."
+            )
+        return FileResponse(
+            path=file_path,
+            filename=f"RCV_Anual_{rut_limpio}.{format}",
+            background=BackgroundTask(cleanup_file, file_path)
+        )
 
-    scraper = SIIScraperAnual(req.rut, req.clave)
-    data = await scraper.get_rcv_ultimos_12_meses()
+    data = await ejecutar_cancelable(request, "rcv_anual", scraper.get_rcv_ultimos_12_meses(), scraper)
     
     if data is None:
         raise HTTPException(
@@ -367,6 +785,7 @@ async def api_rcv_anual(
 @app.post("/sii/f29-datos")
 async def api_f29_datos(
     req: F29Request, 
+    request: Request,
     x_api_key: str = Header(None),
     ruta_oficial: Optional[bool] = False
 ):
@@ -379,20 +798,26 @@ async def api_f29_datos(
     if req.es_propuesta:
         if ruta_oficial:
             print(f"[{get_chile_time()}] [{req.rut}] Iniciando navegacin por ruta oficial (Servicios Online)...")
-            success = await scraper.navigate_to_f29_official_path(req.anio, req.mes)
+            success = await ejecutar_cancelable(request, "f29_ruta_oficial", scraper.navigate_to_f29_official_path(req.anio, req.mes), scraper)
             if not success:
                 raise HTTPException(status_code=500, detail="Error en navegaciÃ³n por ruta oficial.")
             # DespuÃ©s de navegar, extraemos los datos (asumiendo que navigate dejÃ³ la pÃ¡gina lista)
             # Nota: get_f29_data podrÃ­a ser refactorizado para extraer de la pÃ¡gina actual, 
             # pero por ahora get_f29_data hace su propio browser context.
             # Para esta demo, usamos get_f29_data directamente que es lo mÃ¡s estable.
-            data = await scraper.get_f29_data(req.anio, req.mes, es_propuesta=True)
+            data = await ejecutar_cancelable(request, "f29_propuesta", scraper.get_f29_data(req.anio, req.mes, es_propuesta=True), scraper)
         else:
             print(f"[{get_chile_time()}] [{req.rut}] Iniciando extracciÃ³n desde panel de alertas (Home)...")
-            data = await scraper.navigate_to_f29_from_home(req.mes, req.anio)
+            # Acceso directo al formulario con respaldo en la ruta oficial y en las alertas de Mi SII
+            try:
+                data = await ejecutar_cancelable(
+                    request, "f29_navegador", scraper.navigate_to_f29(req.mes, req.anio, liberar_navegador=True), scraper
+                )
+            finally:
+                await scraper.close_session()
     else:
         # Consulta histÃ³rica tradicional
-        data = await scraper.get_f29_data(req.anio, req.mes, es_propuesta=False)
+        data = await ejecutar_cancelable(request, "f29_historico", scraper.get_f29_data(req.anio, req.mes, es_propuesta=False), scraper)
     
     if data is None:
         raise HTTPException(
@@ -405,6 +830,74 @@ async def api_f29_datos(
         "data": data
     }
 
+@app.post("/sii/f29-historico")
+async def api_f29_historico(
+    req: F29HistoricoRequest,
+    request: Request,
+    x_api_key: str = Header(None)
+):
+    """F29 presentados de un rango de periodos (AAAA-MM a AAAA-MM) en una sola sesión del SII."""
+    if x_api_key != API_KEY_CREDENTIAL:
+        raise HTTPException(status_code=403, detail="Acceso denegado: API Key inválida.")
+    try:
+        periodos = rango_periodos(req.desde, req.hasta)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="desde/hasta deben tener formato AAAA-MM.")
+    if not periodos or len(periodos) > MAX_PERIODOS_MASIVO:
+        raise HTTPException(status_code=400, detail=f"El rango debe tener entre 1 y {MAX_PERIODOS_MASIVO} periodos.")
+
+    scraper = SIIScraper(req.rut, req.clave, prioridad="batch")
+    print(f"[{get_chile_time()}] [{req.rut}] Consultando {len(periodos)} F29 históricos ({req.desde} a {req.hasta})...")
+    data = await ejecutar_cancelable(request, "f29_historico_masivo", scraper.get_f29_historico(periodos, usar_historial=req.usar_historial), scraper)
+
+    if all("error" in item for item in data):
+        raise HTTPException(
+            status_code=500,
+            detail="Error al extraer el histórico del F29. Verifica los periodos o las credenciales."
+        )
+
+    return {
+        "status": "success",
+        "data": data
+    }
+
+COLUMNAS_BHE_STREAM = ("tipo",) + COLUMNAS_BHE + ("boletas", "error")
+
+async def stream_bhe(scraper, periodos, formato):
+    """Transmite boletas y totales mensuales de BHE a medida que se extrae cada mes."""
+    if formato == "csv":
+        yield ",".join(COLUMNAS_BHE_STREAM) + "\r\n"
+    async for fila in scraper.iterar_bhe_periodos(periodos):
+        chunks = stream_csv([fila], encabezado=COLUMNAS_BHE_STREAM, con_encabezado=False) if formato == "csv" else stream_ndjson([fila])
+        for chunk in chunks:
+            yield chunk
+
+@app.post("/sii/bhe-recibidas")
+async def api_bhe_recibidas(
+    req: BHERequest,
+    request: Request,
+    x_api_key: str = Header(None),
+    formato: Optional[str] = "ndjson"
+):
+    """Boletas de honorarios recibidas de un rango de periodos, fila a fila con totales por mes (ndjson o csv)."""
+    if x_api_key != API_KEY_CREDENTIAL:
+        raise HTTPException(status_code=403, detail="Acceso denegado: API Key inválida.")
+    if formato not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="formato debe ser ndjson o csv.")
+    try:
+        periodos = rango_periodos(req.desde, req.hasta)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="desde/hasta deben tener formato AAAA-MM.")
+    if not periodos or len(periodos) > MAX_PERIODOS_MASIVO:
+        raise HTTPException(status_code=400, detail=f"El rango debe tener entre 1 y {MAX_PERIODOS_MASIVO} periodos.")
+
+    verificar_no_rechazado(req.rut, req.clave)
+    scraper = SIIScraper(req.rut, req.clave, prioridad="batch")
+    verificar_salud_sii("bhe_recibidas", scraper)
+    scraper.fijar_plazo(plazo_solicitud(request))
+    media_type = "text/csv" if formato == "csv" else "application/x-ndjson"
+    return StreamingResponse(transmitir_cancelable("bhe_recibidas", stream_bhe(scraper, periodos, formato)), media_type=media_type)
+
 @app.post("/sii/f29-scouting")
 async def api_f29_scouting(
     req: F29Request, 
@@ -452,6 +945,7 @@ async def api_f29_scouting(
 @app.post("/sii/chat-interaction")
 async def api_chat_interaction(
     req: ChatRequest,
+    request: Request,
     x_api_key: str = Header(None)
 ):
     if x_api_key != API_KEY_CREDENTIAL:
@@ -469,7 +963,7 @@ async def api_chat_interaction(
     full_history.append({"role": "user", "content": req.message})
 
     print(f"[{get_chile_time()}] [{req.rut}] Procesando mensaje de chat...")
-    respuesta_ia = await auditor.chat_turn(full_history)
+    respuesta_ia = await ejecutar_cancelable(request, "chat_ia", auditor.chat_turn(full_history))
     
     return {
         "status": "success",
@@ -0,0 +1,198 @@
+import asyncio
+import os
+import time
+
+from recursos import memoria, opciones_lanzamiento
+
+# Navegadores compartidos por las sesiones persistentes (un contexto por sesión)
+POOL_MAX_NAVEGADORES = int(os.getenv("POOL_MAX_NAVEGADORES", "2"))
+POOL_MAX_CONTEXTOS = int(os.getenv("POOL_MAX_CONTEXTOS", "50"))  # contextos servidos antes de reciclar
+POOL_MAX_RSS_MB = float(os.getenv("POOL_MAX_RSS_MB", "0"))  # 0 = sin umbral de memoria
+POOL_HEALTH_S = float(os.getenv("POOL_HEALTH_S", "30"))
+POOL_DRAIN_TIMEOUT_S = float(os.getenv("POOL_DRAIN_TIMEOUT_S", "300"))
+
+
+class NavegadorPool:
+    """Un Chromium del pool con su contabilidad de uso."""
+
+    def __init__(self, browser, reserva: str):
+        self.browser = browser
+        self.reserva = reserva
+        self.creado = time.time()
+        self.contextos_servidos = 0
+        self.activos = 0
+        self.retirando_desde = None
+        self.cerrando = False
+
+    def disponible(self) -> bool:
+        return self.retirando_desde is None and self.browser.is_connected()
+
+
+class PoolNavegadores:
+    """
+    Pool de Chromium para las sesiones persistentes. Cada sesión toma un navegador
+    (y crea su propio contexto en él) y lo devuelve al cerrar. Un chequeo periódico
+    detecta navegadores caídos y retira los que sirvieron POOL_MAX_CONTEXTOS contextos
+    o superan POOL_MAX_RSS_MB: un navegador retirado no recibe sesiones nuevas y se
+    cierra recién cuando terminan las que tiene en curso (o tras POOL_DRAIN_TIMEOUT_S).
+    """
+
+    def __init__(self):
+        self.navegadores = []
+        self.stats = {"lanzados": 0, "reciclados": 0, "caidos": 0, "drenajes_forzados": 0}
+        self._pw = None
+        self._lock = None
+        self._chequeo = None
+        self._lanzando = 0  # lanzamientos en curso (esperando memoria o arrancando Chromium)
+
+    async def _lanzar(self, clase: str) -> NavegadorPool:
+        if self._pw is None:
+            from playwright.async_api import async_playwright
+            self._pw = await async_playwright().start()
+        self.stats["lanzados"] += 1
+        reserva = f"pool:{self.stats['lanzados']}"
+        await memoria.reservar(reserva, clase)
+        try:
+            browser = await self._pw.chromium.launch(**opciones_lanzamiento(True))
+        except Exception:
+            await memoria.liberar(reserva)
+            raise
+        memoria.registrar(reserva, browser)
+        entrada = NavegadorPool(browser, reserva)
+        browser.on("disconnected", lambda _: self._desconectado(entrada))
+        self.navegadores.append(entrada)
+        return entrada
+
+    def _desconectado(self, entrada: NavegadorPool):
+        if entrada in self.navegadores:
+            self.navegadores.remove(entrada)
+        if not entrada.cerrando:
+            # Nadie pidió cerrarlo: Chromium se cayó
+            self.stats["caidos"] += 1
+            print(f"[pool] ⚠️ Navegador {entrada.reserva} caído ({entrada.activos} sesiones en curso).")
+
+    async def adquirir(self, clase: str = "api"):
+        """
+        Navegador sano del pool para una nueva sesión (el menos cargado, o uno nuevo si hay
+        cupo). Lanzar uno nuevo pasa por el presupuesto con la clase de prioridad de la sesión.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            sanos = [n for n in self.navegadores if n.disponible()]
+            lanzar = not sanos or (
+                min(n.activos for n in sanos) > 0 and len(self.navegadores) + self._lanzando < POOL_MAX_NAVEGADORES
+            )
+            if lanzar:
+                self._lanzando += 1
+            else:
+                return self._asignar(min(sanos, key=lambda n: n.activos))
+
+        # La reserva de memoria puede encolarse hasta MEMORY_QUEUE_TIMEOUT_S: se espera fuera
+        # del lock para que otras clases (p. ej. interactiva) sigan obteniendo navegadores
+        try:
+            entrada = await self._lanzar(clase)
+        finally:
+            self._lanzando -= 1
+        async with self._lock:
+            return self._asignar(entrada)
+
+    def _asignar(self, entrada: NavegadorPool):
+        if self._chequeo is None or self._chequeo.done():
+            self._chequeo = asyncio.create_task(self._chequear_periodicamente())
+        entrada.activos += 1
+        entrada.contextos_servidos += 1
+        if entrada.contextos_servidos >= POOL_MAX_CONTEXTOS:
+            self._retirar(entrada, "contextos")
+        return entrada.browser
+
+    async def liberar(self, browser):
+        """La sesión terminó con el navegador; si estaba retirado y queda vacío, se cierra."""
+        entrada = next((n for n in self.navegadores if n.browser is browser), None)
+        if entrada is None:
+            return
+        entrada.activos = max(0, entrada.activos - 1)
+        if entrada.retirando_desde is not None and entrada.activos == 0:
+            await self._cerrar(entrada)
+
+    def _retirar(self, entrada: NavegadorPool, motivo: str):
+        if entrada.retirando_desde is None:
+            entrada.retirando_desde = time.monotonic()
+            self.stats["reciclados"] += 1
+            print(f"[pool] Reciclando navegador {entrada.reserva} ({motivo}), {entrada.activos} sesiones en curso.")
+
+    async def _cerrar(self, entrada: NavegadorPool):
+        entrada.cerrando = True
+        if entrada in self.navegadores:
+            self.navegadores.remove(entrada)
+        try:
+            await entrada.browser.close()
+        except Exception:
+            pass
+
+    async def _sano(self, entrada: NavegadorPool) -> bool:
+        if not entrada.browser.is_connected():
+            return False
+        try:
+            cdp = await entrada.browser.new_browser_cdp_session()
+            await asyncio.wait_for(cdp.send("Browser.getVersion"), 10)
+            await cdp.detach()
+            return True
+        except Exception:
+            return False
+
+    async def chequear(self):
+        """Un ciclo de salud: descarta caídos/colgados, recicla por memoria y completa drenajes."""
+        for entrada in list(self.navegadores):
+            if not entrada.browser.is_connected():
+                continue  # ya contabilizado por el evento 'disconnected'
+            if not await self._sano(entrada):
+                self.stats["caidos"] += 1
+                print(f"[pool] ⚠️ Navegador {entrada.reserva} no responde, descartado.")
+                await self._cerrar(entrada)
+                continue
+            rss = memoria.sesiones.get(entrada.reserva, {}).get("rss_mb", 0)
+            if POOL_MAX_RSS_MB and rss > POOL_MAX_RSS_MB:
+                self._retirar(entrada, f"{rss:.0f} MB")
+            if entrada.retirando_desde is not None:
+                if entrada.activos == 0:
+                    await self._cerrar(entrada)
+                elif time.monotonic() - entrada.retirando_desde > POOL_DRAIN_TIMEOUT_S:
+                    self.stats["drenajes_forzados"] += 1
+                    await self._cerrar(entrada)
+
+    async def _chequear_periodicamente(self):
+        while self.navegadores:
+            await asyncio.sleep(POOL_HEALTH_S)
+            try:
+                await self.chequear()
+            except Exception as e:
+                print(f"[pool] Error en chequeo de salud: {e}")
+
+    async def cerrar(self):
+        """Cierra todos los navegadores y Playwright (apagado del proceso)."""
+        if self._chequeo:
+            self._chequeo.cancel()
+        for entrada in list(self.navegadores):
+            await self._cerrar(entrada)
+        if self._pw:
+            await self._pw.stop()
+            self._pw = None
+
+    def resumen(self) -> dict:
+        return {
+            **self.stats,
+            "navegadores": [
+                {
+                    "id": n.reserva,
+                    "sesiones_activas": n.activos,
+                    "contextos_servidos": n.contextos_servidos,
+                    "retirando": n.retirando_desde is not None,
+                    "edad_s": round(time.time() - n.creado),
+                }
+                for n in self.navegadores
+            ],
+        }
+
+# Instancia global compartida por todos los scrapers del proceso
+pool_navegadores = PoolNavegadores()
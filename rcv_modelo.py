@@ -0,0 +1,260 @@
+import csv
+import io
+import json
+import re
+from array import array
+
+# Columnas numéricas del resumen RCV (una fila por tipo de documento)
+COLUMNAS_RCV = ("total_documentos", "monto_exento", "monto_neto", "iva_recuperable", "monto_total")
+
+# Claves del JSON anual anterior al modelo tipado -> columna actual. Se siguen entregando en
+# /sii/rcv-anual-consolidado (ahora con valores numéricos en vez de texto)
+CLAVES_LEGADO_ANUAL = {"tipo_doc": "tipo_documento", "cantidad": "total_documentos", "neto": "monto_neto",
+                       "iva": "iva_recuperable", "total": "monto_total"}
+
+# Devuelve las celdas de texto de cada fila de la tabla de resumen del RCV.
+# El parseo a enteros se hace una sola vez en Python (ResumenRCV.desde_celdas).
+JS_CELDAS_TABLA_RCV = """() => {
+    const rows = Array.from(document.querySelectorAll('table tbody tr'));
+    return rows
+        .map(row => Array.from(row.querySelectorAll('td')).map(td => td.innerText.trim()))
+        .filter(cols => cols.length >= 6);
+}"""
+
+_NO_NUMERICO = re.compile(r"[^0-9-]")
+
+
+def a_entero(texto) -> int:
+    """Convierte montos del SII ("1.234.567", "$ -3.000", "") a int."""
+    if isinstance(texto, int):
+        return texto
+    limpio = _NO_NUMERICO.sub("", texto or "")
+    if not limpio or limpio == "-":
+        return 0
+    negativo = limpio.startswith("-")
+    digitos = limpio.replace("-", "")
+    return -int(digitos) if negativo else int(digitos)
+
+
+def a_decimal(texto):
+    """Convierte tasas del SII ("19,5", "10", "") a float; None si la celda viene vacía."""
+    limpio = re.sub(r"[^0-9,.-]", "", texto or "")
+    if "," in limpio:
+        # Formato chileno: punto de miles y coma decimal
+        limpio = limpio.replace(".", "").replace(",", ".")
+    try:
+        return float(limpio)
+    except ValueError:
+        return None
+
+
+class ResumenRCV:
+    """
+    Resumen del RCV de un periodo en formato columnar: una lista de tipos de documento
+    y un array de enteros (64 bits) por cada columna de COLUMNAS_RCV.
+    """
+    __slots__ = ("rut", "periodo", "operacion", "tipo_documento") + COLUMNAS_RCV
+
+    def __init__(self, rut=None, periodo=None, operacion="compra"):
+        self.rut = rut
+        self.periodo = periodo
+        self.operacion = operacion
+        self.tipo_documento = []
+        for col in COLUMNAS_RCV:
+            setattr(self, col, array("q"))
+
+    @classmethod
+    def desde_celdas(cls, celdas, rut=None, periodo=None, operacion="compra"):
+        """Construye el resumen desde las celdas crudas de JS_CELDAS_TABLA_RCV."""
+        resumen = cls(rut, periodo, operacion)
+        for cols in celdas:
+            resumen.agregar_fila(cols[0], cols[1], cols[2], cols[3], cols[4], cols[-1])
+        return resumen
+
+    @classmethod
+    def desde_dict(cls, data):
+        """Inverso de to_dict()."""
+        resumen = cls(data.get("rut"), data.get("periodo"), data.get("operacion", "compra"))
+        resumen.tipo_documento = list(data["tipo_documento"])
+        for col in COLUMNAS_RCV:
+            setattr(resumen, col, array("q", data[col]))
+        return resumen
+
+    def agregar_fila(self, tipo, *valores):
+        self.tipo_documento.append(tipo)
+        for col, valor in zip(COLUMNAS_RCV, valores):
+            getattr(self, col).append(a_entero(valor))
+
+    def __len__(self):
+        return len(self.tipo_documento)
+
+    def total(self, columna: str) -> int:
+        return sum(getattr(self, columna))
+
+    def totales(self) -> dict:
+        return {col: sum(getattr(self, col)) for col in COLUMNAS_RCV}
+
+    def to_dict(self) -> dict:
+        """Serialización columnar (listas planas de enteros, sin claves repetidas por fila)."""
+        data = {"rut": self.rut, "periodo": self.periodo, "operacion": self.operacion,
+                "tipo_documento": self.tipo_documento}
+        for col in COLUMNAS_RCV:
+            data[col] = getattr(self, col).tolist()
+        return data
+
+    def to_filas(self, legado: bool = False) -> list:
+        """
+        Una fila (dict) por tipo de documento, con montos ya numéricos. Con legado=True se
+        agregan también las claves que usaba el JSON anual antes del modelo tipado
+        (ver CLAVES_LEGADO_ANUAL), para no romper a los clientes existentes.
+        """
+        columnas = [getattr(self, col) for col in COLUMNAS_RCV]
+        filas = [
+            dict(tipo_documento=tipo, **{col: vals[i] for col, vals in zip(COLUMNAS_RCV, columnas)})
+            for i, tipo in enumerate(self.tipo_documento)
+        ]
+        if legado:
+            for fila in filas:
+                fila.update({antigua: fila[nueva] for antigua, nueva in CLAVES_LEGADO_ANUAL.items()})
+        return filas
+
+
+def agregar(resumenes, por: str = "periodo") -> dict:
+    """
+    Suma columnas de varios ResumenRCV agrupando por 'periodo', 'rut', 'operacion'
+    o 'tipo_documento'. Retorna {grupo: {columna: total}}.
+    """
+    grupos = {}
+    for resumen in resumenes:
+        if por == "tipo_documento":
+            columnas = [getattr(resumen, col) for col in COLUMNAS_RCV]
+            for i, tipo in enumerate(resumen.tipo_documento):
+                acc = grupos.setdefault(tipo, [0] * len(COLUMNAS_RCV))
+                for j, vals in enumerate(columnas):
+                    acc[j] += vals[i]
+        else:
+            acc = grupos.setdefault(getattr(resumen, por), [0] * len(COLUMNAS_RCV))
+            for j, col in enumerate(COLUMNAS_RCV):
+                acc[j] += sum(getattr(resumen, col))
+    return {grupo: dict(zip(COLUMNAS_RCV, acc)) for grupo, acc in grupos.items()}
+
+
+# --- DETALLE DE DOCUMENTOS (CSV "Descargar Detalles" del RCV) ---
+
+def _normalizar_columna(nombre: str) -> str:
+    """'Monto IVA Recuperable' -> 'monto_iva_recuperable'."""
+    nombre = nombre.strip().lower()
+    for a, b in (("á", "a"), ("é", "e"), ("í", "i"), ("ó", "o"), ("ú", "u"), ("ñ", "n"), (".", "")):
+        nombre = nombre.replace(a, b)
+    return re.sub(r"[^a-z0-9]+", "_", nombre).strip("_")
+
+
+def _es_columna_numerica(columna: str) -> bool:
+    return columna.startswith(("monto_", "valor_", "iva_", "nro", "tipo_doc", "folio", "codigo_"))
+
+
+def _es_columna_decimal(columna: str) -> bool:
+    # Las tasas traen decimales ("19,5"): como enteros quedarían multiplicadas por 10
+    return columna.startswith("tasa_")
+
+
+def iterar_detalle_csv(path: str, encoding: str = "latin-1"):
+    """
+    Lee el CSV de detalle del RCV línea a línea (separado por ';') y genera un dict
+    tipado por documento. Nunca carga el archivo completo en memoria.
+    """
+    with open(path, newline="", encoding=encoding) as f:
+        lector = csv.reader(f, delimiter=";")
+        encabezado = next(lector, None)
+        if not encabezado:
+            return
+        columnas = [_normalizar_columna(c) for c in encabezado]
+        conversores = [
+            a_entero if _es_columna_numerica(c) else a_decimal if _es_columna_decimal(c) else str.strip
+            for c in columnas
+        ]
+        for celdas in lector:
+            if not any(celdas):
+                continue
+            yield {col: convertir(valor) for col, convertir, valor in zip(columnas, conversores, celdas)}
+
+
+# --- SERIALIZACIÓN EN STREAMING (una fila a la vez) ---
+
+def stream_ndjson(filas):
+    """Genera una línea JSON por fila."""
+    for fila in filas:
+        yield json.dumps(fila, ensure_ascii=False) + "\n"
+
+
+def stream_csv(filas, encabezado=None, con_encabezado: bool = True):
+    """Genera el CSV fila a fila; sin encabezado explícito se usan las claves de la primera fila."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for fila in filas:
+        if encabezado is None:
+            encabezado = list(fila.keys())
+        if con_encabezado:
+            writer.writerow(encabezado)
+            con_encabezado = False
+        writer.writerow([fila.get(col, "") for col in encabezado])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+
+# --- CONSOLIDACIÓN ANUAL (una fila por periodo / operación / tipo de documento) ---
+
+COLUMNAS_ANUALES = ("periodo", "operacion", "tipo_documento") + COLUMNAS_RCV + ("error",)
+
+
+def filas_periodo_rcv(item: dict):
+    """Aplana un periodo de SIIScraperAnual.iterar_rcv_ultimos_12_meses en filas planas."""
+    if "error" in item:
+        yield {"periodo": item["periodo"], "error": item["error"]}
+        return
+    for operacion in ("compras", "ventas"):
+        for fila in item[operacion].to_filas():
+            yield dict(periodo=item["periodo"], operacion=item[operacion].operacion, **fila)
+
+
+class EscritorXlsx:
+    """Libro Excel en modo write-only: cada fila se escribe a disco y se libera."""
+
+    def __init__(self, path: str):
+        from openpyxl import Workbook
+        self.path = path
+        self.libro = Workbook(write_only=True)
+        self.hoja = self.libro.create_sheet("RCV")
+        self.hoja.append(list(COLUMNAS_ANUALES))
+
+    def escribir(self, filas):
+        for fila in filas:
+            self.hoja.append([fila.get(col) for col in COLUMNAS_ANUALES])
+
+    def cerrar(self):
+        self.libro.save(self.path)
+
+
+class EscritorParquet:
+    """Archivo Parquet con un row group por periodo (requiere pyarrow)."""
+
+    def __init__(self, path: str):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema(
+            [(col, pa.string()) for col in ("periodo", "operacion", "tipo_documento")]
+            + [(col, pa.int64()) for col in COLUMNAS_RCV]
+            + [("error", pa.string())]
+        )
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def escribir(self, filas):
+        filas = list(filas)  # un solo periodo: a lo más unas decenas de filas
+        if filas:
+            columnas = {col: [fila.get(col) for fila in filas] for col in COLUMNAS_ANUALES}
+            self.writer.write_table(self.pa.Table.from_pydict(columnas, schema=self.schema))
+
+    def cerrar(self):
+        self.writer.close()
@@ -0,0 +1,276 @@
+import asyncio
+import os
+import time
+
+# Opciones de lanzamiento de Chromium orientadas a bajo consumo de memoria
+CHROMIUM_CHANNEL = os.getenv("CHROMIUM_CHANNEL", "")  # ej: chromium-headless-shell (Playwright >= 1.49)
+CHROMIUM_DISK_CACHE_MB = int(os.getenv("CHROMIUM_DISK_CACHE_MB", "16"))
+CHROMIUM_JS_HEAP_MB = int(os.getenv("CHROMIUM_JS_HEAP_MB", "0"))
+CHROMIUM_ARGS_EXTRA = [a for a in os.getenv("CHROMIUM_ARGS_EXTRA", "").split() if a]
+
+CHROMIUM_ARGS_BASE = [
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-dev-shm-usage",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--mute-audio",
+    "--no-first-run",
+]
+
+# Presupuesto de memoria para navegadores simultáneos
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "0"))  # 0 = sin límite
+MEMORY_POLICY = os.getenv("MEMORY_POLICY", "queue")  # queue | refuse
+MEMORY_QUEUE_TIMEOUT_S = float(os.getenv("MEMORY_QUEUE_TIMEOUT_S", "120"))
+MEMORY_SESION_MB = float(os.getenv("MEMORY_SESION_MB", "350"))  # estimación inicial por navegador
+MEMORY_SAMPLE_S = float(os.getenv("MEMORY_SAMPLE_S", "5"))
+
+# Clases de prioridad, de mayor a menor. La clase interactiva (agente en vivo) tiene capacidad
+# reservada que las demás no pueden ocupar, y en la cola siempre pasa antes que api y batch.
+PRIORIDADES = ("interactiva", "api", "batch")
+MAX_NAVEGADORES = int(os.getenv("MAX_NAVEGADORES", "0"))  # 0 = sin límite de navegadores simultáneos
+RESERVA_INTERACTIVA_NAVEGADORES = int(os.getenv("RESERVA_INTERACTIVA_NAVEGADORES", "1"))
+RESERVA_INTERACTIVA_MB = float(os.getenv("RESERVA_INTERACTIVA_MB", "0"))
+
+
+def opciones_lanzamiento(headless: bool = True) -> dict:
+    """kwargs para chromium.launch según la configuración de bajo consumo."""
+    args = list(CHROMIUM_ARGS_BASE)
+    args.append(f"--disk-cache-size={CHROMIUM_DISK_CACHE_MB * 1024 * 1024}")
+    if CHROMIUM_JS_HEAP_MB:
+        args.append(f"--js-flags=--max-old-space-size={CHROMIUM_JS_HEAP_MB}")
+    args += CHROMIUM_ARGS_EXTRA
+    opciones = {"headless": headless, "args": args}
+    if CHROMIUM_CHANNEL:
+        opciones["channel"] = CHROMIUM_CHANNEL
+    return opciones
+
+
+def rss_mb(pid: int) -> float:
+    """RSS del proceso en MB leído de /proc (0 si no existe o no es Linux)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return 0.0
+
+
+class MemoriaInsuficiente(Exception):
+    """No hay presupuesto de memoria para abrir otro navegador."""
+
+
+class PresupuestoMemoria:
+    """
+    Lleva la cuenta de la memoria (RSS) de cada navegador abierto, desglosada por tipo de
+    proceso de Chromium (browser, renderer, gpu, utility), y decide si una nueva sesión
+    cabe en MEMORY_BUDGET_MB y MAX_NAVEGADORES. Si no cabe, la encola o la rechaza según
+    MEMORY_POLICY; la cola atiende por clase de prioridad (interactiva > api > batch).
+    La estimación por sesión se ajusta con el peak observado de las sesiones cerradas.
+    """
+
+    def __init__(self):
+        self.sesiones = {}
+        self.estimacion_mb = MEMORY_SESION_MB
+        self.stats = {"sesiones": 0, "rechazadas": 0, "encoladas": 0, "espera_total_s": 0.0, "peak_total_mb": 0.0}
+        self.stats_por_clase = {
+            clase: {"admitidas": 0, "encoladas": 0, "rechazadas": 0, "adelantos": 0, "espera_total_s": 0.0, "espera_max_s": 0.0}
+            for clase in PRIORIDADES
+        }
+        # Trabajos esperando cupo: [(rango de prioridad, orden de llegada)]
+        self.cola = []
+        self._turnos = 0
+        self._cambio = None
+
+    def _condicion(self):
+        if self._cambio is None:
+            self._cambio = asyncio.Condition()
+        return self._cambio
+
+    def en_uso_mb(self) -> float:
+        # Las sesiones aún sin medición cuentan con la estimación
+        return sum(max(s["rss_mb"], self.estimacion_mb) for s in self.sesiones.values())
+
+    def _cabe(self, clase: str = "api") -> bool:
+        if not self.sesiones:
+            return True
+        interactiva = clase == "interactiva"
+        if MAX_NAVEGADORES:
+            limite = MAX_NAVEGADORES - (0 if interactiva else RESERVA_INTERACTIVA_NAVEGADORES)
+            if len(self.sesiones) >= limite:
+                return False
+        if MEMORY_BUDGET_MB:
+            limite_mb = MEMORY_BUDGET_MB - (0 if interactiva else RESERVA_INTERACTIVA_MB)
+            if self.en_uso_mb() + self.estimacion_mb > limite_mb:
+                return False
+        return True
+
+    def _es_su_turno(self, turno, clase: str) -> bool:
+        # Pasa si hay cupo para su clase y nadie de mayor prioridad (o de igual, llegado antes) espera
+        return turno == min(self.cola) and self._cabe(clase)
+
+    async def reservar(self, job_id: str, clase: str = "api"):
+        """
+        Reserva cupo para un navegador de la clase de prioridad dada; si no hay, espera en la
+        cola (ordenada por prioridad y llegada) o lanza MemoriaInsuficiente según MEMORY_POLICY.
+        """
+        if clase not in PRIORIDADES:
+            clase = "api"
+        stats_clase = self.stats_por_clase[clase]
+        cambio = self._condicion()
+        async with cambio:
+            turno = (PRIORIDADES.index(clase), self._turnos)
+            self._turnos += 1
+            if self.cola or not self._cabe(clase):
+                if MEMORY_POLICY == "refuse" and not self._cabe(clase):
+                    self.stats["rechazadas"] += 1
+                    stats_clase["rechazadas"] += 1
+                    raise MemoriaInsuficiente(
+                        f"Sin cupo para navegadores ({len(self.sesiones)} activos, {self.en_uso_mb():.0f}/{MEMORY_BUDGET_MB:.0f} MB)."
+                    )
+                # Los trabajos de menor prioridad ya en cola quedan detrás de este
+                stats_clase["adelantos"] += sum(1 for t in self.cola if t[0] > turno[0])
+                self.cola.append(turno)
+                self.stats["encoladas"] += 1
+                stats_clase["encoladas"] += 1
+                inicio = time.monotonic()
+                try:
+                    await asyncio.wait_for(cambio.wait_for(lambda: self._es_su_turno(turno, clase)), MEMORY_QUEUE_TIMEOUT_S)
+                except asyncio.TimeoutError:
+                    self.stats["rechazadas"] += 1
+                    stats_clase["rechazadas"] += 1
+                    raise MemoriaInsuficiente(
+                        f"Sin cupo para navegadores tras {MEMORY_QUEUE_TIMEOUT_S:.0f}s en cola ({clase})."
+                    )
+                finally:
+                    self.cola.remove(turno)
+                    espera = time.monotonic() - inicio
+                    self.stats["espera_total_s"] += espera
+                    stats_clase["espera_total_s"] += espera
+                    stats_clase["espera_max_s"] = max(stats_clase["espera_max_s"], espera)
+                    # El siguiente en la cola puede ser el que ahora tiene turno
+                    cambio.notify_all()
+            self.sesiones[job_id] = {"inicio": time.time(), "clase": clase, "rss_mb": 0.0, "peak_mb": 0.0, "procesos": {}, "tarea": None}
+            self.stats["sesiones"] += 1
+            stats_clase["admitidas"] += 1
+
+    def registrar(self, job_id: str, browser):
+        """Asocia el navegador lanzado a la reserva: lo muestrea y libera la reserva al desconectarse."""
+        sesion = self.sesiones.get(job_id)
+        if sesion is None:
+            return
+        sesion["tarea"] = asyncio.create_task(self._muestrear(job_id, browser))
+        browser.on("disconnected", lambda _: asyncio.create_task(self.liberar(job_id)))
+
+    async def medir(self, job_id: str, browser) -> dict:
+        """RSS por tipo de proceso de Chromium del navegador, vía CDP SystemInfo + /proc."""
+        sesion = self.sesiones.get(job_id)
+        if sesion is None:
+            return {}
+        cdp = await browser.new_browser_cdp_session()
+        try:
+            info = await cdp.send("SystemInfo.getProcessInfo")
+        finally:
+            await cdp.detach()
+        procesos = {}
+        for proc in info.get("processInfo", []):
+            procesos[proc["type"]] = procesos.get(proc["type"], 0.0) + rss_mb(proc["id"])
+        sesion["procesos"] = {tipo: round(mb, 1) for tipo, mb in procesos.items()}
+        sesion["rss_mb"] = round(sum(procesos.values()), 1)
+        sesion["peak_mb"] = max(sesion["peak_mb"], sesion["rss_mb"])
+        self.stats["peak_total_mb"] = max(self.stats["peak_total_mb"], round(self.en_uso_mb(), 1))
+        return sesion["procesos"]
+
+    async def _muestrear(self, job_id: str, browser):
+        while job_id in self.sesiones and browser.is_connected():
+            try:
+                await self.medir(job_id, browser)
+            except Exception:
+                pass
+            await asyncio.sleep(MEMORY_SAMPLE_S)
+
+    async def liberar(self, job_id: str):
+        sesion = self.sesiones.pop(job_id, None)
+        if sesion is None:
+            return
+        if sesion["tarea"]:
+            sesion["tarea"].cancel()
+        if sesion["peak_mb"]:
+            # Media móvil del peak real por sesión para las próximas decisiones de presupuesto
+            self.estimacion_mb = round(0.8 * self.estimacion_mb + 0.2 * sesion["peak_mb"], 1)
+        cambio = self._condicion()
+        async with cambio:
+            cambio.notify_all()
+
+    def resumen(self) -> dict:
+        return {
+            **self.stats,
+            "espera_total_s": round(self.stats["espera_total_s"], 2),
+            "presupuesto_mb": MEMORY_BUDGET_MB,
+            "max_navegadores": MAX_NAVEGADORES,
+            "politica": MEMORY_POLICY,
+            "en_cola": {clase: sum(1 for t in self.cola if t[0] == i) for i, clase in enumerate(PRIORIDADES)},
+            "por_clase": {
+                clase: {
+                    **st,
+                    "espera_total_s": round(st["espera_total_s"], 2),
+                    "espera_max_s": round(st["espera_max_s"], 2),
+                    "espera_media_s": round(st["espera_total_s"] / st["encoladas"], 2) if st["encoladas"] else 0.0,
+                }
+                for clase, st in self.stats_por_clase.items()
+            },
+            "estimacion_sesion_mb": self.estimacion_mb,
+            "en_uso_mb": round(self.en_uso_mb(), 1),
+            "activas": {
+                job_id: {"clase": s["clase"], "rss_mb": s["rss_mb"], "peak_mb": s["peak_mb"], "procesos": s["procesos"]}
+                for job_id, s in self.sesiones.items()
+            },
+        }
+
+# Instancia global compartida por todos los scrapers del proceso
+memoria = PresupuestoMemoria()
+
+
+class RegistroCancelaciones:
+    """
+    Trabajos cancelados porque el cliente se desconectó. Estima los segundos de navegador
+    recuperados como la duración media de los trabajos del mismo tipo que sí terminaron,
+    menos lo que el cancelado alcanzó a correr.
+    """
+
+    def __init__(self):
+        self.tipos = {}
+
+    def _tipo(self, tipo: str) -> dict:
+        return self.tipos.setdefault(tipo, {
+            "terminados": 0, "cancelados": 0, "segundos_terminados": 0.0,
+            "segundos_cancelados": 0.0, "segundos_navegador_recuperados": 0.0, "etapas": {}
+        })
+
+    def terminado(self, tipo: str, duracion_s: float):
+        st = self._tipo(tipo)
+        st["terminados"] += 1
+        st["segundos_terminados"] += duracion_s
+
+    def cancelado(self, tipo: str, transcurrido_s: float, etapa: str = None):
+        st = self._tipo(tipo)
+        st["cancelados"] += 1
+        st["segundos_cancelados"] += transcurrido_s
+        if st["terminados"]:
+            media = st["segundos_terminados"] / st["terminados"]
+            st["segundos_navegador_recuperados"] += max(0.0, media - transcurrido_s)
+        if etapa:
+            st["etapas"][etapa] = st["etapas"].get(etapa, 0) + 1
+
+    def resumen(self) -> dict:
+        return {
+            tipo: {**st, **{k: round(st[k], 1) for k in ("segundos_terminados", "segundos_cancelados", "segundos_navegador_recuperados")}}
+            for tipo, st in self.tipos.items()
+        }
+
+# Instancia global compartida por todos los endpoints del proceso
+cancelaciones = RegistroCancelaciones()
@@ -0,0 +1,178 @@
+"""
+Grabación y reproducción HAR de los flujos del scraper para medir regresiones de latencia.
+
+    # 1. Grabar contra el SII real (credenciales por variables de entorno, nunca en el código)
+    SII_RUT=12345678-9 SII_CLAVE=... python run_har_regresion.py record f29_home --mes Diciembre --anio 2025
+
+    # 2. Reproducir sin red y guardar los tiempos como línea base
+    python run_har_regresion.py replay f29_home --guardar base_f29_home.json
+
+    # 3. En un pull request: reproducir y comparar contra la línea base (exit 1 si hay regresión)
+    python run_har_regresion.py replay f29_home --baseline base_f29_home.json --tolerancia 0.2
+
+Los HAR quedan en HAR_DIR/<flujo>/ sin la clave ni cookies. Los flujos del RCV dependen
+del mes actual, por lo que conviene regrabarlos cada mes.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+from urllib.parse import quote_plus
+
+import scraper as scraper_mod
+from scraper import SIIScraper
+from scraper_anual import SIIScraperAnual
+from pool_navegadores import pool_navegadores
+
+CLAVE_REDACTADA = "CLAVE_REDACTADA"
+
+FLUJOS = {
+    "f29_home": lambda s, a: s.navigate_to_f29_from_home(a.mes, a.anio),
+    "f29": lambda s, a: s.navigate_to_f29(a.mes, a.anio, liberar_navegador=True),
+    "rcv_resumen": lambda s, a: s.get_rcv_resumen(),
+    "rcv_anual": lambda s, a: s.get_rcv_ultimos_12_meses(),
+    "f29_historico": lambda s, a: s.get_f29_data(a.anio, a.mes, es_propuesta=False),
+}
+
+
+def sanear_har(path: str, clave: str):
+    """Reemplaza la clave (texto plano y url-encoded) y elimina cookies/autorización del HAR."""
+    with open(path, encoding="utf-8") as f:
+        har = json.load(f)
+
+    secretos = {clave, quote_plus(clave)}
+    def limpiar(texto):
+        for secreto in secretos:
+            texto = texto.replace(secreto, CLAVE_REDACTADA)
+        return texto
+
+    for entry in har["log"]["entries"]:
+        req, resp = entry["request"], entry["response"]
+        req["url"] = limpiar(req["url"])
+        post = req.get("postData")
+        if post:
+            if "text" in post:
+                post["text"] = limpiar(post["text"])
+            for param in post.get("params", []):
+                param["value"] = limpiar(param.get("value", ""))
+        for mensaje in (req, resp):
+            mensaje["cookies"] = []
+            for header in mensaje.get("headers", []):
+                if header["name"].lower() in ("cookie", "set-cookie", "authorization"):
+                    header["value"] = "REDACTED"
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(har, f, ensure_ascii=False)
+
+
+def tiempos_por_paso(linea_tiempo, total_s):
+    """Duración de cada paso = tiempo hasta el siguiente mensaje de log."""
+    pasos = []
+    marcas = linea_tiempo + [(total_s, "fin")]
+    for (t, mensaje), (t_sig, _) in zip(marcas, marcas[1:]):
+        pasos.append({"paso": mensaje, "inicio_s": t, "duracion_s": round(t_sig - t, 3)})
+    return pasos
+
+
+def _clave_paso(mensaje):
+    # Los mensajes llevan montos/periodos variables: se comparan sin dígitos
+    return re.sub(r"\d+", "#", mensaje)
+
+
+def comparar(reporte, base, tolerancia):
+    regresiones = []
+    if reporte["total_s"] > base["total_s"] * (1 + tolerancia):
+        regresiones.append(f"Total: {base['total_s']}s -> {reporte['total_s']}s")
+
+    def agrupar(pasos):
+        acumulado = {}
+        for p in pasos:
+            acumulado[_clave_paso(p["paso"])] = acumulado.get(_clave_paso(p["paso"]), 0) + p["duracion_s"]
+        return acumulado
+
+    actual, anterior = agrupar(reporte["pasos"]), agrupar(base["pasos"])
+    for paso, dur in actual.items():
+        previo = anterior.get(paso)
+        if previo is not None and dur - previo > 0.5 and dur > previo * (1 + tolerancia):
+            regresiones.append(f"{paso}: {previo:.2f}s -> {dur:.2f}s")
+    return regresiones
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modo", choices=["record", "replay"])
+    parser.add_argument("flujo", choices=sorted(FLUJOS))
+    parser.add_argument("--mes")
+    parser.add_argument("--anio")
+    parser.add_argument("--baseline", help="JSON de tiempos de referencia para comparar")
+    parser.add_argument("--guardar", help="Guardar el reporte de tiempos en este JSON")
+    parser.add_argument("--tolerancia", type=float, default=0.2)
+    args = parser.parse_args()
+
+    har_dir = os.path.join(scraper_mod.HAR_DIR, args.flujo)
+    meta_path = os.path.join(har_dir, "meta.json")
+
+    if args.modo == "record":
+        rut, clave = os.getenv("SII_RUT"), os.getenv("SII_CLAVE")
+        if not rut or not clave:
+            sys.exit("Definir SII_RUT y SII_CLAVE para grabar.")
+    else:
+        if not os.path.exists(meta_path):
+            sys.exit(f"No hay grabación para '{args.flujo}' en {har_dir}.")
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        rut, clave = meta["rut"], CLAVE_REDACTADA
+        args.mes = args.mes or meta.get("mes")
+        args.anio = args.anio or meta.get("anio")
+
+    clase = SIIScraperAnual if args.flujo == "rcv_anual" else SIIScraper
+    s = clase(rut, clave)
+    s.har_mode, s.har_dir = args.modo, har_dir
+
+    inicio = time.monotonic()
+    try:
+        resultado = await FLUJOS[args.flujo](s, args)
+    finally:
+        await s.close_session()
+        await pool_navegadores.cerrar()
+    total_s = round(time.monotonic() - inicio, 3)
+
+    if args.modo == "record":
+        for nombre in os.listdir(har_dir):
+            if nombre.endswith(".har"):
+                sanear_har(os.path.join(har_dir, nombre), clave)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"rut": rut, "mes": args.mes, "anio": args.anio}, f)
+
+    reporte = {
+        "flujo": args.flujo,
+        "modo": args.modo,
+        "ok": bool(resultado),
+        "total_s": total_s,
+        "pasos": tiempos_por_paso(s.linea_tiempo, total_s),
+    }
+    print(f"\n{'Paso':<70} {'Dur (s)':>8}")
+    for p in reporte["pasos"]:
+        print(f"{p['paso'][:70]:<70} {p['duracion_s']:>8.2f}")
+    print(f"{'TOTAL':<70} {total_s:>8.2f}  ({'ok' if reporte['ok'] else 'sin resultado'})")
+
+    if args.guardar:
+        with open(args.guardar, "w", encoding="utf-8") as f:
+            json.dump(reporte, f, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            base = json.load(f)
+        regresiones = comparar(reporte, base, args.tolerancia)
+        if regresiones:
+            print("\n❌ Regresiones de latencia:")
+            for r in regresiones:
+                print(f"   - {r}")
+            sys.exit(1)
+        print("\n✅ Sin regresiones de latencia respecto a la línea base.")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,219 @@
+import math
+import os
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+# Circuito por host del SII: fallos seguidos (5xx, errores de red o respuestas más lentas
+# que SII_LENTO_S) que lo abren, y cuánto tiempo rechaza trabajo antes de volver a probar
+SII_CIRCUITO_FALLOS = int(os.getenv("SII_CIRCUITO_FALLOS", "5"))
+SII_CIRCUITO_ABIERTO_S = float(os.getenv("SII_CIRCUITO_ABIERTO_S", "60"))
+SII_LENTO_S = float(os.getenv("SII_LENTO_S", "20"))  # 0 = la latencia no abre el circuito
+
+# Timeouts aprendidos por paso: p99 de las últimas PASO_VENTANA esperas × PASO_TIMEOUT_MARGEN,
+# acotado a [PASO_TIMEOUT_MIN_MS, PASO_TIMEOUT_MAX_MS]. Con pocas muestras se usa el valor fijo
+PASO_TIMEOUT_MIN_MS = int(os.getenv("PASO_TIMEOUT_MIN_MS", "3000"))
+PASO_TIMEOUT_MAX_MS = int(os.getenv("PASO_TIMEOUT_MAX_MS", "60000"))
+PASO_TIMEOUT_MARGEN = float(os.getenv("PASO_TIMEOUT_MARGEN", "1.5"))
+PASO_MUESTRAS_MIN = int(os.getenv("PASO_MUESTRAS_MIN", "20"))
+PASO_VENTANA = int(os.getenv("PASO_VENTANA", "200"))
+
+
+def percentil(valores, q: float):
+    """Percentil q (0-100) por rango más cercano; None si no hay valores."""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[max(0, math.ceil(q / 100 * len(ordenados)) - 1)]
+
+
+class CircuitoAbierto(Exception):
+    """El servicio está marcado como caído: se rechaza el trabajo sin intentarlo."""
+
+    def __init__(self, nombre: str, reintentar_en: float):
+        super().__init__(f"{nombre} no disponible temporalmente, reintentar en {reintentar_en:.0f}s")
+        self.nombre = nombre
+        self.reintentar_en = reintentar_en
+
+
+class Circuito:
+    """
+    Interruptor de circuito para un servicio externo. Tras 'fallos_max' fallos seguidos
+    (o respuestas más lentas que 'lento_s', si se define) se abre y rechaza de inmediato
+    durante 'abierto_s'; luego deja pasar una sola llamada de prueba (semiabierto) y se
+    cierra si esa llamada resulta bien o vuelve a abrirse si falla.
+    """
+
+    def __init__(self, nombre: str, fallos_max: int = 5, abierto_s: float = 30, lento_s: float = 0):
+        self.nombre = nombre
+        self.fallos_max = fallos_max
+        self.abierto_s = abierto_s
+        self.lento_s = lento_s
+        self.estado = "cerrado"
+        self.fallos_seguidos = 0
+        self.abierto_desde = None
+        self.sonda_desde = None
+        self.latencias = deque(maxlen=200)
+        self.stats = {"llamadas": 0, "exitos": 0, "fallos": 0, "lentas": 0, "rechazadas": 0, "aperturas": 0}
+
+    def reintentar_en(self) -> float:
+        if self.estado != "abierto":
+            return 0
+        return max(0.0, self.abierto_s - (time.monotonic() - self.abierto_desde))
+
+    def verificar(self):
+        """Lanza CircuitoAbierto si no se debe intentar la llamada ahora."""
+        ahora = time.monotonic()
+        if self.estado == "abierto" and ahora - self.abierto_desde >= self.abierto_s:
+            self.estado = "semiabierto"
+            self.sonda_desde = None
+        if self.estado == "semiabierto":
+            # Una sola llamada de prueba a la vez (si la prueba nunca informó, se permite otra)
+            if self.sonda_desde is None or ahora - self.sonda_desde >= self.abierto_s:
+                self.sonda_desde = ahora
+            else:
+                self.stats["rechazadas"] += 1
+                raise CircuitoAbierto(self.nombre, self.abierto_s - (ahora - self.sonda_desde))
+        elif self.estado == "abierto":
+            self.stats["rechazadas"] += 1
+            raise CircuitoAbierto(self.nombre, self.reintentar_en())
+        self.stats["llamadas"] += 1
+
+    def exito(self, latencia_s: float = None):
+        if latencia_s is not None:
+            self.latencias.append(latencia_s)
+            if self.lento_s and latencia_s > self.lento_s:
+                self.stats["lentas"] += 1
+                self._fallo()
+                return
+        self.stats["exitos"] += 1
+        self.fallos_seguidos = 0
+        if self.estado != "cerrado":
+            print(f"[salud] {self.nombre} respondió bien: circuito cerrado.")
+        self.estado = "cerrado"
+
+    def fallo(self, latencia_s: float = None):
+        if latencia_s is not None:
+            self.latencias.append(latencia_s)
+        self.stats["fallos"] += 1
+        self._fallo()
+
+    def _fallo(self):
+        self.fallos_seguidos += 1
+        if self.estado == "semiabierto" or (self.estado == "cerrado" and self.fallos_seguidos >= self.fallos_max):
+            self.estado = "abierto"
+            self.abierto_desde = time.monotonic()
+            self.stats["aperturas"] += 1
+            print(f"[salud] ⚠️ {self.nombre} degradado ({self.fallos_seguidos} fallos seguidos): circuito abierto {self.abierto_s:.0f}s.")
+
+    def resumen(self) -> dict:
+        p50, p95 = percentil(self.latencias, 50), percentil(self.latencias, 95)
+        return {
+            **self.stats,
+            "estado": self.estado,
+            "fallos_seguidos": self.fallos_seguidos,
+            "reintentar_en_s": round(self.reintentar_en(), 1),
+            "latencia_p50_s": round(p50, 2) if p50 is not None else None,
+            "latencia_p95_s": round(p95, 2) if p95 is not None else None,
+        }
+
+
+class SaludSII:
+    """
+    Salud de cada host del SII (zeusr, www4, proxy, ...) a partir de las respuestas que ven
+    los navegadores y el cliente HTTP. Cuando un host se degrada, el trabajo nuevo que lo
+    necesita se rechaza de inmediato en vez de lanzar un navegador para esperar timeouts.
+    """
+
+    def __init__(self):
+        self.hosts = {}
+
+    def circuito(self, host: str) -> Circuito:
+        if host not in self.hosts:
+            self.hosts[host] = Circuito(host, SII_CIRCUITO_FALLOS, SII_CIRCUITO_ABIERTO_S, SII_LENTO_S)
+        return self.hosts[host]
+
+    def verificar(self, *hosts: str):
+        """Lanza CircuitoAbierto si alguno de los hosts que necesita el trabajo está degradado."""
+        for host in hosts:
+            self.circuito(host).verificar()
+
+    def registrar(self, url: str, ok: bool, latencia_s: float = None):
+        host = urlparse(url).hostname or ""
+        if not host.endswith("sii.cl"):
+            return
+        if ok:
+            self.circuito(host).exito(latencia_s)
+        else:
+            self.circuito(host).fallo(latencia_s)
+
+    def observar(self, context):
+        """Alimenta la salud con los documentos y XHR que carga un contexto de Playwright."""
+        async def terminada(request):
+            if request.resource_type not in ("document", "xhr", "fetch"):
+                return
+            respuesta = await request.response()
+            fin_ms = request.timing.get("responseEnd", -1)
+            self.registrar(request.url, respuesta is None or respuesta.status < 500, fin_ms / 1000 if fin_ms >= 0 else None)
+
+        def fallida(request):
+            # ERR_ABORTED: la propia página canceló la carga (otra navegación), no es culpa del SII
+            if request.resource_type in ("document", "xhr", "fetch") and "ERR_ABORTED" not in (request.failure or ""):
+                self.registrar(request.url, False)
+
+        context.on("requestfinished", terminada)
+        context.on("requestfailed", fallida)
+
+    def resumen(self) -> dict:
+        return {host: c.resumen() for host, c in self.hosts.items()}
+
+# Instancia global compartida por todos los scrapers del proceso
+salud_sii = SaludSII()
+
+
+class TiemposPasos:
+    """
+    Latencia reciente de cada espera con nombre del scraper (un selector, una carga) y el
+    timeout que se deriva de ella. Una espera agotada entra como muestra con el valor del
+    timeout, de modo que en horas lentas el timeout crece en vez de fallar una y otra vez.
+    """
+
+    def __init__(self):
+        self.pasos = {}
+
+    def _datos(self, paso: str) -> dict:
+        if paso not in self.pasos:
+            self.pasos[paso] = {"muestras": deque(maxlen=PASO_VENTANA), "agotados": 0, "tope_ms": None}
+        return self.pasos[paso]
+
+    def registrar(self, paso: str, segundos: float, agotado: bool = False, muestra: bool = True):
+        datos = self._datos(paso)
+        if agotado:
+            datos["agotados"] += 1
+        if muestra:
+            datos["muestras"].append(segundos)
+
+    def timeout_ms(self, paso: str, tope_ms: int) -> int:
+        """Timeout para la espera 'paso'; 'tope_ms' es el valor fijo de respaldo."""
+        datos = self._datos(paso)
+        datos["tope_ms"] = tope_ms
+        if len(datos["muestras"]) < PASO_MUESTRAS_MIN:
+            return tope_ms
+        p99 = percentil(datos["muestras"], 99)
+        return int(min(PASO_TIMEOUT_MAX_MS, max(PASO_TIMEOUT_MIN_MS, p99 * 1000 * PASO_TIMEOUT_MARGEN)))
+
+    def resumen(self) -> dict:
+        resumen = {}
+        for paso, datos in self.pasos.items():
+            p95, p99 = percentil(datos["muestras"], 95), percentil(datos["muestras"], 99)
+            resumen[paso] = {
+                "muestras": len(datos["muestras"]),
+                "agotados": datos["agotados"],
+                "p95_s": round(p95, 2) if p95 is not None else None,
+                "p99_s": round(p99, 2) if p99 is not None else None,
+                "timeout_ms": self.timeout_ms(paso, datos["tope_ms"]) if datos["tope_ms"] else None,
+            }
+        return resumen
+
+# Instancia global compartida por todos los scrapers del proceso
+tiempos_pasos = TiemposPasos()
@@ -1,17 +1,166 @@
 import asyncio
-from playwright.async_api import async_playwright
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 import os
+import time
+import uuid
 from datetime import datetime, timedelta, timezone
+from rcv_modelo import ResumenRCV, JS_CELDAS_TABLA_RCV
+from artefactos import artefactos, trazas
+from sii_http import (ClienteSIIHttp, SesionExpirada, URL_BHE_RECIBIDAS, extraer_total_retencion,
+                      extraer_boletas_bhe, total_mes_bhe, cookies_vigentes, guardar_cookies, invalidar_cookies,
+                      CredencialesInvalidas, registrar_rechazo, verificar_no_rechazado)
+from extraccion_f29 import (JS_EXTRAER_CODIGO_F29, memo_extraccion, url_frame, limpiar_valor,
+                            capturar_snapshots, extraer_en_pool)
+from recursos import memoria, opciones_lanzamiento
+from pool_navegadores import pool_navegadores
+from historial import historial, periodo_clave, periodo_desde_texto, periodo_en_texto, F29
+from salud import salud_sii, tiempos_pasos
+
+MESES = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
+
+SII_HOME_URL = "https://misiir.sii.cl/cgi_misii/siihome.cgi"
+F29_DEEP_LINK = "https://www4.sii.cl/formulario29internetui/#/declarar"
+
+# Códigos leídos desde el Formulario Completo del F29
+CODIGOS_F29_FORMULARIO = {
+    "538": "Impuesto Único",
+    "589": "IVA Débito (Total)",
+    "503": "Débito Facturas",
+    "511": "IVA Crédito E-Factura",
+    "537": "Crédito Periodo",
+    "504": "Remanente Mes Ant.",
+    "77": "Remanente Mes Sig.",
+    "91": "Total a Pagar",
+    "62": "PPM Neto"
+}
+
+F29_HISTORICO_URL = "https://www4.sii.cl/consul_f29_internetui/"
+
+# Códigos leídos desde la consulta de F29 (propuesta e histórico)
+# Basado en análisis de AI Studio y manual del SII
+CODIGOS_F29_CONSULTA = {
+    "538": "Ventas Afectas (Débito)",
+    "503": "Débito Facturas",
+    "589": "Total Débito IVA",
+    "511": "Monto Neto Facturas Compra",
+    "537": "Total Crédito IVA",
+    "504": "Remanente Mes Anterior",
+    "77": "Remanente Mes Nacional (a favor)",
+    "115": "PPM (Monto)",
+    "62": "Tasa PPM (%)",
+    "151": "Retención Honorarios",
+    "91": "Total a Pagar"
+}
+
+# Cuántos códigos distintos del F29 debe mostrar un frame (como celda/etiqueta o nodo #cod)
+# para considerarlo el formulario: Mi SII o el selector de periodo mencionan "IVA" o "F29"
+# pero no tienen la grilla de códigos.
+MIN_CODIGOS_FORMULARIO_F29 = 3
+JS_CODIGOS_FORMULARIO_F29 = r"""(codigos) => {
+    const vistos = new Set();
+    for (const el of document.querySelectorAll('td, th, span, label, div, input')) {
+        const id = el.id || el.getAttribute('name') || '';
+        const texto = el.children.length === 0 ? el.textContent.trim().replace(/^\[|\]$/g, '') : '';
+        for (const c of codigos) {
+            if (id === 'cod' + c || texto === c) vistos.add(c);
+        }
+    }
+    return vistos.size;
+}"""
+
+# Códigos que toda declaración F29 consultada muestra: si falta alguno, la lectura no es
+# confiable (formulario sin cargar o vista equivocada) y no se guarda en el historial.
+CODIGOS_F29_OBLIGATORIOS = ("91",)
+
+# Estado de la consulta de F29 presentados: si el texto visible (sin contar los <select>)
+# muestra el periodo pedido y una firma de los nodos #cod... para detectar que cambiaron.
+JS_ESTADO_CONSULTA_F29 = r"""([mes, anio, mm]) => {
+    const walker = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT, {
+        acceptNode: n => n.parentElement && n.parentElement.closest('select, script, style')
+            ? NodeFilter.FILTER_REJECT : NodeFilter.FILTER_ACCEPT
+    });
+    let texto = '';
+    while (walker.nextNode()) texto += ' ' + walker.currentNode.nodeValue;
+    const patrones = [
+        new RegExp(mes + '\\s+(de\\s+)?' + anio, 'i'),
+        new RegExp('\\b' + mm + '\\s*[-/]\\s*' + anio + '\\b'),
+        new RegExp('\\b' + anio + '\\s*[-/]?\\s*' + mm + '\\b'),
+    ];
+    const codigos = Array.from(document.querySelectorAll('[id^="cod"], [name^="cod"]'));
+    return {
+        periodo: codigos.length > 0 && patrones.some(p => p.test(texto)),
+        firma: codigos.map(el => el.id + '=' + (el.value || el.innerText || '')).join('|'),
+    };
+}"""
+
+# Resultado del login: 'ok' al salir de las páginas de autenticación, o el texto del error
+# que muestra el SII en un contenedor de error visible (clave incorrecta, RUT inválido, clave
+# bloqueada); null mientras carga.
+JS_RESULTADO_LOGIN = """() => {
+    if (!/IngresoRutClave|AUT2000/i.test(location.href)) return 'ok';
+    // Solo el texto de contenedores de error/alerta visibles: la página de login trae textos de
+    // ayuda ("si su clave está bloqueada...") que no son un rechazo
+    const texto = Array.from(document.querySelectorAll(
+        '[role="alert"], .alert, .error, .errores, .modal.in, .modal.show, [class*="error" i], [id*="error" i]'
+    )).filter(el => el.offsetParent !== null).map(el => el.innerText).join('\\n');
+    const error = /(clave|contraseña)[^.\\n]{0,60}(incorrect|no es (válid|correct)|inválid|bloquead)|rut[^.\\n]{0,40}(inválid|incorrect|no (existe|válid))/i.exec(texto);
+    return error ? error[0] : null;
+}"""
+LOGIN_TIMEOUT_MS = int(os.getenv("SII_LOGIN_TIMEOUT_MS", "20000"))
+
+# Página liviana de Mi SII para mantener viva una sesión inactiva (sin mover la pestaña)
+KEEPALIVE_URL = "https://misiir.sii.cl/cgi_misii/siihome.cgi"
+
+# Tope de páginas por mes al recorrer el listado de boletas de honorarios
+MAX_PAGINAS_BHE = 50
+
+# Grabación/reproducción de tráfico en HAR para pruebas de regresión: off | record | replay
+HAR_MODE = os.getenv("HAR_MODE", "off")
+HAR_DIR = os.getenv("HAR_DIR", "hars")
+
+# Historial (en memoria del proceso) de qué ruta llegó al formulario F29 y cuánto tardó
+RUTAS_F29_STATS = {
+    "deep_link": {"exitos": 0, "fallos": 0, "segundos_total": 0.0},
+    "ruta_oficial": {"exitos": 0, "fallos": 0, "segundos_total": 0.0},
+    "home": {"exitos": 0, "fallos": 0, "segundos_total": 0.0},
+}
+
+class PlazoAgotado(Exception):
+    """El plazo total de la solicitud se agotó (o ya no alcanza para el siguiente paso)."""
+
+    def __init__(self, paso: str, pasos: list = None):
+        super().__init__(f"Plazo agotado en el paso: {paso}")
+        self.paso = paso
+        self.pasos = pasos or []
 
 class SIIScraper:
-    def __init__(self, rut, clave, log_callback=None):
+    def __init__(self, rut, clave, log_callback=None, prioridad: str = "api"):
         self.rut = rut
         self.clave = clave
         self.log_callback = log_callback
+        # Clase de prioridad para obtener navegadores: interactiva | api | batch
+        self.prioridad = prioridad
         self.browser = None
         self.context = None
         self.page = None
-        self.pw_instance = None
+        # Pestañas con nombre de la sesión persistente ("principal" es self.page)
+        self.pestanas = {}
+        # Serializa la creación de la sesión persistente (p. ej. precalentamiento + inicio real)
+        self._sesion_lock = asyncio.Lock()
+        # Identificador único del trabajo (carpeta de artefactos, logs)
+        self.job_id = f"{rut.replace('.', '').replace('-', '')}_{uuid.uuid4().hex[:8]}"
+        self.har_mode = HAR_MODE
+        self.har_dir = HAR_DIR
+        self.navegadores_lanzados = 0
+        # El trabajo ya pasó el control de salud de los hosts del SII (ver salud.py)
+        self.salud_verificada = False
+        # Línea de tiempo de los mensajes de log: [(segundos desde el inicio, mensaje)]
+        self.inicio = time.monotonic()
+        self.linea_tiempo = []
+        # Plazo total de la solicitud (time.monotonic) y timeout base de cada contexto/página
+        self.deadline = None
+        self.paso_actual = "inicio"
+        self._timeouts_base = {}
         self.login_url = "https://zeusr.sii.cl/AUT2000/InicioAutenticacion/IngresoRutClave.html?https://misiir.sii.cl/cgi_misii/siihome.cgi"
 
     async def log(self, message: str, type: str = "info"):
@@ -19,6 +168,10 @@ class SIIScraper:
         # Chile está en UTC-3
         chile_time = datetime.now(timezone(timedelta(hours=-3))).strftime("%Y-%m-%d %H:%M:%S")
         formatted_msg = f"[{chile_time}] [{self.rut}] {message}"
+        self.linea_tiempo.append((round(time.monotonic() - self.inicio, 3), message))
+        self.paso_actual = message
+        if self.deadline is not None:
+            self._ajustar_timeouts()
         print(formatted_msg)
         if self.log_callback:
             # Si el callback es asíncrono, lo esperamos
@@ -27,33 +180,247 @@ class SIIScraper:
             else:
                 self.log_callback(formatted_msg, type)
 
+    def fijar_plazo(self, segundos: float):
+        """Acota toda la solicitud a 'segundos' desde ahora: cada espera recibe solo lo que queda."""
+        self.deadline = time.monotonic() + segundos if segundos else None
+
+    def pasos_consumidos(self, n: int = 5) -> list:
+        """Los n pasos (mensajes de log) que más tiempo tomaron, de mayor a menor."""
+        marcas = self.linea_tiempo + [(round(time.monotonic() - self.inicio, 3), "(en curso)")]
+        pasos = [{"paso": m, "segundos": round(t_sig - t, 2)} for (t, m), (t_sig, _) in zip(marcas, marcas[1:])]
+        return sorted(pasos, key=lambda p: p["segundos"], reverse=True)[:n]
+
+    def _plazo_ms(self, tope_ms: int) -> int:
+        """Timeout para una espera: el tope del paso o lo que queda del plazo, lo que sea menor."""
+        if self.deadline is None:
+            return tope_ms
+        restante_ms = (self.deadline - time.monotonic()) * 1000
+        if restante_ms <= 0:
+            raise PlazoAgotado(self.paso_actual, self.pasos_consumidos())
+        return int(min(tope_ms, restante_ms))
+
+    def _verificar_plazo(self):
+        """Lanza PlazoAgotado si el plazo ya venció (para pasos sin timeout de Playwright, p. ej. HTTP)."""
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise PlazoAgotado(self.paso_actual, self.pasos_consumidos())
+
+    async def _pausa(self, segundos: float):
+        """Espera fija; si ya no cabe en el plazo, falla de inmediato en vez de esperar."""
+        if self.deadline is not None and time.monotonic() + segundos > self.deadline:
+            raise PlazoAgotado(self.paso_actual, self.pasos_consumidos())
+        await asyncio.sleep(segundos)
+
+    async def _esperar(self, paso: str, espera, tope_ms: int, opcional: bool = False):
+        """
+        Ejecuta espera(timeout_ms) con el timeout aprendido para 'paso' (ver salud.TiemposPasos),
+        recortado al plazo, y registra cuánto tardó. En esperas opcionales (el elemento puede
+        no aparecer nunca) un timeout no cuenta como muestra, para no alargar la próxima.
+        """
+        aprendido = tiempos_pasos.timeout_ms(paso, tope_ms)
+        timeout_ms = self._plazo_ms(aprendido)
+        # Los tiempos reproducidos desde HAR no representan al SII real
+        medir = self.har_mode != "replay"
+        inicio = time.monotonic()
+        try:
+            resultado = await espera(timeout_ms)
+        except PlaywrightTimeoutError:
+            if medir and timeout_ms >= aprendido:  # si lo cortó el plazo, no dice nada del paso
+                tiempos_pasos.registrar(paso, timeout_ms / 1000, agotado=True, muestra=not opcional)
+            raise
+        if medir:
+            tiempos_pasos.registrar(paso, time.monotonic() - inicio)
+        return resultado
+
+    def _timeout_base(self, objetivo, tope_ms: int):
+        """Timeout por defecto de un contexto o página, recortado al plazo en cada paso."""
+        self._timeouts_base[objetivo] = tope_ms
+        objetivo.set_default_timeout(self._plazo_ms(tope_ms))
+
+    def _ajustar_timeouts(self):
+        """
+        Recorta los timeouts base a lo que queda del plazo. Nunca lanza: se llama desde log(),
+        también dentro de bloques except; agotado el plazo deja el mínimo y es la siguiente
+        espera (_plazo_ms/_pausa) la que lanza PlazoAgotado.
+        """
+        restante_ms = max(1, int((self.deadline - time.monotonic()) * 1000))
+        for objetivo, tope_ms in list(self._timeouts_base.items()):
+            try:
+                objetivo.set_default_timeout(min(tope_ms, restante_ms))
+            except Exception:
+                self._timeouts_base.pop(objetivo, None)  # contexto/página ya cerrado
+
+    async def _lanzar_navegador(self, playwright, headless: bool = True):
+        """
+        Lanza Chromium con las opciones de bajo consumo, previa reserva en el presupuesto
+        de memoria (puede esperar en cola o lanzar MemoriaInsuficiente). La reserva se
+        libera sola cuando el navegador se cierra.
+        """
+        # Credenciales rechazadas hace poco: no se abre un navegador para volver a fallar
+        verificar_no_rechazado(self.rut, self.clave)
+        self.navegadores_lanzados += 1
+        reserva = f"{self.job_id}:{self.navegadores_lanzados}"
+        await memoria.reservar(reserva, self.prioridad)
+        try:
+            browser = await playwright.chromium.launch(**opciones_lanzamiento(headless))
+        except Exception:
+            await memoria.liberar(reserva)
+            raise
+        memoria.registrar(reserva, browser)
+        return browser
+
+    async def _nuevo_contexto(self, browser, flujo: str, **kwargs):
+        """
+        Crea un contexto con la configuración estándar. En HAR_MODE=record graba el tráfico
+        en <HAR_DIR>/<flujo>.har (se escribe al cerrar el contexto); en replay sirve las
+        respuestas desde ese archivo sin red.
+        """
+        opciones = {
+            "viewport": {'width': 1366, 'height': 768},
+            "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        }
+        har_path = os.path.join(self.har_dir, f"{flujo}.har")
+        if self.har_mode == "record":
+            os.makedirs(self.har_dir, exist_ok=True)
+            opciones.update(record_har_path=har_path, record_har_content="embed")
+        opciones.update(kwargs)
+        context = await browser.new_context(**opciones)
+        await trazas.iniciar(context, flujo)
+        if self.deadline is not None:
+            self._timeout_base(context, 30000)
+        if self.har_mode == "replay":
+            await context.route_from_har(har_path, not_found="abort")
+        else:
+            # El tráfico reproducido desde HAR no dice nada de la salud real del SII
+            salud_sii.observar(context)
+        return context
+
+    async def _sesion_sana(self) -> bool:
+        """La sesión persistente sigue utilizable: navegador conectado y pestaña que responde."""
+        if not self.browser.is_connected() or self.page.is_closed():
+            return False
+        try:
+            await asyncio.wait_for(self.page.evaluate("1"), 10)
+            return True
+        except Exception:
+            return False
+
     async def _ensure_session(self):
-        """Asegura que haya una sesión de navegador activa."""
-        from playwright.async_api import async_playwright
-        if not self.pw_instance:
-            self.pw_instance = await async_playwright().start()
-            self.browser = await self.pw_instance.chromium.launch(headless=True)
-            self.context = await self.browser.new_context(
-                viewport={'width': 1366, 'height': 768},
-                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-            )
-            self.page = await self.context.new_page()
-            await self._login(self.page)
-        return self.page
+        """
+        Asegura que haya una sesión de navegador activa, en un contexto propio sobre un
+        navegador del pool. Si el navegador se cayó o la pestaña quedó colgada, la sesión
+        se recrea (con un nuevo login) de forma transparente.
+        """
+        async with self._sesion_lock:
+            if self.page and not await self._sesion_sana():
+                await self.log("⚠️ El navegador de la sesión no responde, recreando sesión...", "error")
+                await self.close_session()
+            if not self.page:
+                verificar_no_rechazado(self.rut, self.clave)
+                self.browser = await pool_navegadores.adquirir(self.prioridad)
+                try:
+                    self.context = await self._nuevo_contexto(self.browser, "_ensure_session")
+                    self.page = await self.context.new_page()
+                    await self._login(self.page)
+                except BaseException:
+                    # También si se cancela a medio login: el navegador vuelve al pool
+                    await self.close_session()
+                    raise
+                # Las cookies de la sesión quedan disponibles para las rutas HTTP directas
+                guardar_cookies(self.rut, await self.context.cookies())
+            return self.page
+
+    async def pestana(self, nombre: str = "principal"):
+        """
+        Pestaña con nombre dentro del contexto de la sesión persistente (se crea la primera
+        vez). Permite correr pasos en paralelo sin sacar a la pestaña principal del
+        formulario en que está, p. ej. el RCV mientras el F29 queda listo para enviar.
+        """
+        principal = await self._ensure_session()
+        if nombre == "principal":
+            return principal
+        page = self.pestanas.get(nombre)
+        if page is None or page.is_closed():
+            page = await self.context.new_page()
+            self.pestanas[nombre] = page
+        return page
+
+    async def cerrar_pestana(self, nombre: str):
+        page = self.pestanas.pop(nombre, None)
+        if page and not page.is_closed():
+            try:
+                await page.close()
+            except Exception:
+                pass  # el navegador pudo haberse caído
+
+    def _paginas_formulario(self, page):
+        """Páginas del contexto donde buscar el formulario, sin las pestañas con nombre (RCV, etc.)."""
+        otras = set(self.pestanas.values())
+        return [p for p in page.context.pages if p not in otras]
+
+    async def precalentar(self):
+        """
+        Abre la sesión persistente y hace login por adelantado, sin navegar a ningún
+        formulario, para que el primer paso real parta ya autenticado.
+        """
+        inicio = time.monotonic()
+        await self._ensure_session()
+        await self.log(f"🔥 Sesión SII precalentada en {time.monotonic() - inicio:.1f}s.")
+
+    async def latido_sesion(self) -> dict:
+        """
+        Petición autenticada barata (con las cookies del contexto, sin tocar la pestaña del
+        formulario) que renueva la sesión del SII. Devuelve si sigue vigente; no se informa
+        un vencimiento porque las cookies de sesión del SII no lo traen.
+        """
+        if not self.context:
+            return {"vigente": False, "latencia_ms": None}
+        inicio = time.monotonic()
+        try:
+            resp = await self.context.request.get(KEEPALIVE_URL, timeout=15000)
+            # Sesión vencida: el SII redirige al formulario de autenticación
+            vigente = resp.ok and "AUT2000" not in resp.url
+            await resp.dispose()
+        except Exception as e:
+            print(f"[{self.rut}] Latido de sesión fallido: {e}")
+            vigente = False
+        return {
+            "vigente": vigente,
+            "latencia_ms": round((time.monotonic() - inicio) * 1000),
+        }
 
     async def close_session(self):
-        """Cierra el navegador y limpia recursos."""
-        if self.browser: await self.browser.close()
-        if self.pw_instance: await self.pw_instance.stop()
-        self.browser = self.context = self.page = self.pw_instance = None
+        """Cierra el contexto de la sesión y devuelve el navegador al pool."""
+        if self.context:
+            try:
+                await trazas.detener(self.context)
+                await self.context.close()
+            except Exception:
+                pass  # el navegador pudo haberse caído
+        if self.browser:
+            await pool_navegadores.liberar(self.browser)
+        self.browser = self.context = self.page = None
+        self.pestanas = {}
 
     async def _login(self, page):
-        """Método interno para manejar la autenticación."""
+        """
+        Método interno para manejar la autenticación. Si el SII rechaza el RUT/clave lanza
+        CredencialesInvalidas apenas aparece el error, y recuerda el rechazo por un tiempo.
+        """
+        verificar_no_rechazado(self.rut, self.clave)
         await self.log("Autenticando...")
         await page.goto(self.login_url, wait_until="networkidle")
         await page.fill("#rutcntr", self.rut.replace(".", "").replace("-", ""))
         await page.fill("#clave", self.clave)
         await page.click("#bt_ingresar")
+        plazo_login = self._plazo_ms(LOGIN_TIMEOUT_MS)
+        try:
+            resultado = await (await page.wait_for_function(JS_RESULTADO_LOGIN, polling=250, timeout=plazo_login)).json_value()
+        except Exception:
+            resultado = None  # sin veredicto claro: se sigue como antes y el flujo decidirá
+        if resultado and resultado != "ok":
+            await self.log(f"❌ Login rechazado por el SII: {resultado}", "error")
+            registrar_rechazo(self.rut, self.clave, resultado)
+            raise CredencialesInvalidas(resultado)
         await page.wait_for_load_state("networkidle")
 
     # ... (métodos existentes adaptados para usar self.page si existe, o abrir nuevo si no)
@@ -81,8 +448,7 @@ class SIIScraper:
         # Se detiene justo antes de 'Enviar'
         
         # Tomar captura para el 'Humano'
-        screenshot_path = f"scouting_{self.rut}_{mes}.png"
-        await page.screenshot(path=screenshot_path)
+        screenshot_path = await artefactos.capturar(page, self.job_id, f"scouting_{mes}", obligatorio=True)
 
         return {
             "resumen": "Propuesta lista para validación",
@@ -93,11 +459,8 @@ class SIIScraper:
 
     async def get_carpeta_tributaria(self, output_path, datos_envio=None):
         async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            context = await browser.new_context(
-                viewport={'width': 1366, 'height': 768},
-                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-            )
+            browser = await self._lanzar_navegador(p)
+            context = await self._nuevo_contexto(browser, "get_carpeta_tributaria")
             page = await context.new_page()
 
             try:
@@ -106,12 +469,12 @@ class SIIScraper:
                 
                 # 2. Navegar a la página de generación
                 print(f"[{self.rut}] Navegando a Carpeta...")
-                await page.goto(self.target_url, wait_until="networkidle")
+                await self._esperar("carpeta.abrir", lambda t: page.goto(self.target_url, wait_until="networkidle", timeout=t), 30000)
 
                 # 3. Primer Continuar
                 print(f"[{self.rut}] Iniciando generacin...")
                 await page.get_by_role("button", name="Continuar").first.click()
-                await page.wait_for_load_state("networkidle")
+                await self._esperar("carpeta.continuar", lambda t: page.wait_for_load_state("networkidle", timeout=t), 30000)
 
                 # 4. RELLENAR FORMULARIO
                 data = datos_envio or {
@@ -127,7 +490,12 @@ class SIIScraper:
                 
                 print(f"[{self.rut}] Esperando autocompletado...")
                 nombre_input = page.locator("input[placeholder*='Ingresa Nombre']").first
-                await page.wait_for_function('el => el.value !== ""', arg=await nombre_input.element_handle(), timeout=10000)
+                handle_nombre = await nombre_input.element_handle()
+                await self._esperar(
+                    "carpeta.autocompletado",
+                    lambda t: page.wait_for_function('el => el.value !== ""', arg=handle_nombre, timeout=t),
+                    10000
+                )
 
                 print(f"[{self.rut}] Completando datos...")
                 await page.fill("input[placeholder*='Ingrese correo']", data['dest_correo'])
@@ -136,7 +504,7 @@ class SIIScraper:
                 
                 # Checkbox de Autorización
                 await page.evaluate("() => { const cbs = document.querySelectorAll('input[type=\"checkbox\"]'); cbs[cbs.length-1].click(); }")
-                await asyncio.sleep(2)
+                await self._pausa(2)
 
                 print(f"[{self.rut}] Enviando formulario...")
                 btn_cont = page.locator("button:has-text('Continuar')")
@@ -146,20 +514,20 @@ class SIIScraper:
                 print(f"[{self.rut}] Confirmando en ventana emergente...")
                 try:
                     btn_aceptar = page.locator("button:visible:has-text('Aceptar')")
-                    await btn_aceptar.first.wait_for(state="visible", timeout=10000)
+                    await self._esperar("carpeta.modal_aceptar", lambda t: btn_aceptar.first.wait_for(state="visible", timeout=t), 10000, opcional=True)
                     await btn_aceptar.first.click()
                     await page.wait_for_load_state("networkidle")
                 except:
                     # Intento alternativo via JS
                     await page.evaluate("() => { const buttons = Array.from(document.querySelectorAll('button')); const btn = buttons.find(b => b.innerText.includes('Aceptar') && b.offsetParent !== null); if(btn) btn.click(); }")
-                    await asyncio.sleep(2)
+                    await self._pausa(2)
 
                 # 5. Descarga Final (Botón Verde "Ver PDF Generado")
                 print(f"[{self.rut}] Descargando resultado final...")
                 btn_final = page.locator("button:visible:has-text('Ver PDF Generado'), button:visible:has-text('Generar Carpeta')")
                 
                 try:
-                    await btn_final.first.wait_for(state="visible", timeout=20000)
+                    await self._esperar("carpeta.boton_pdf", lambda t: btn_final.first.wait_for(state="visible", timeout=t), 20000, opcional=True)
                 except:
                     btn_final = page.get_by_role("button").filter(has_text="PDF")
 
@@ -173,20 +541,21 @@ class SIIScraper:
                 print(f"[{self.rut}]  Carpeta guardada en: {output_path}")
                 return True
 
+            except (CredencialesInvalidas, PlazoAgotado):
+                raise
             except Exception as e:
                 print(f"[{self.rut}]  Error en Carpeta: {str(e)}")
+                await trazas.resultado(context, self.job_id, fallo=True)
                 return False
             finally:
+                await context.close()
                 await browser.close()
 
     async def get_rcv_resumen(self):
-        """Extrae el resumen de compras (RCV) del periodo actual."""
+        """Extrae el resumen de compras (RCV) del periodo actual como ResumenRCV."""
         async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            context = await browser.new_context(
-                viewport={'width': 1366, 'height': 768},
-                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-            )
+            browser = await self._lanzar_navegador(p)
+            context = await self._nuevo_contexto(browser, "get_rcv_resumen")
             page = await context.new_page()
 
             try:
@@ -202,36 +571,84 @@ class SIIScraper:
                 btn_consultar = page.locator("button:has-text('Consultar')")
                 await btn_consultar.click()
                 await page.wait_for_load_state("networkidle")
-                await asyncio.sleep(2) # Esperar a que cargue la tabla dinámica
+                await self._pausa(2) # Esperar a que cargue la tabla dinámica
 
                 # 4. Extraer datos de la tabla de resumen de COMPRAS
                 print(f"[{self.rut}] Extrayendo datos de la tabla...")
                 
-                resumen = await page.evaluate("""() => {
-                    const rows = Array.from(document.querySelectorAll('table tbody tr'));
-                    return rows.map(row => {
-                        const cols = row.querySelectorAll('td');
-                        if (cols.length >= 6) {
-                            return {
-                                tipo_documento: cols[0].innerText.trim(),
-                                total_documentos: cols[1].innerText.trim(),
-                                monto_exento: cols[2].innerText.trim(),
-                                monto_neto: cols[3].innerText.trim(),
-                                iva_recuperable: cols[4].innerText.trim(),
-                                monto_total: cols[cols.length - 1].innerText.trim()
-                            };
-                        }
-                        return null;
-                    }).filter(r => r !== null);
-                }""")
+                celdas = await page.evaluate(JS_CELDAS_TABLA_RCV)
+                resumen = ResumenRCV.desde_celdas(celdas, rut=self.rut, periodo="actual", operacion="compra")
+                # El RCV abre en el mes en curso (hora Chile)
+                periodo_actual = datetime.now(timezone(timedelta(hours=-3))).strftime("%Y-%m")
+                historial.guardar_rcv(resumen, periodo=periodo_actual, fuente="get_rcv_resumen")
 
                 print(f"[{self.rut}]  Datos RCV extrados con xito.")
                 return resumen
 
+            except (CredencialesInvalidas, PlazoAgotado):
+                raise
             except Exception as e:
                 print(f"[{self.rut}]  Error en RCV: {str(e)}")
+                await trazas.resultado(context, self.job_id, fallo=True)
                 return None
             finally:
+                await context.close()
+                await browser.close()
+
+    async def _consultar_periodo_rcv(self, page, anio_str: str, mes_str: str):
+        """En la app del RCV ya abierta, selecciona el periodo (mes 'MM') y presiona Consultar."""
+        await self._esperar("rcv.selector_periodo", lambda t: page.wait_for_selector("#periodoMes", timeout=t), 10000)
+
+        # Seleccionar Año (3er select) y Mes
+        selects = page.locator("select")
+        await selects.nth(2).select_option(label=anio_str)
+        await page.select_option("#periodoMes", value=mes_str)
+
+        # Click en Consultar
+        await page.locator("button:has-text('Consultar')").click()
+        await self._pausa(3)
+        await page.wait_for_load_state("networkidle")
+
+    async def descargar_detalle_rcv(self, anio: str, mes: str, output_path: str, operacion: str = "compra"):
+        """
+        Descarga el CSV de detalle (factura por factura) del RCV para un periodo.
+        Playwright escribe la descarga directo a disco; se lee después con iterar_detalle_csv.
+        """
+        async with async_playwright() as p:
+            browser = await self._lanzar_navegador(p)
+            context = await self._nuevo_contexto(browser, "descargar_detalle_rcv", accept_downloads=True)
+            page = await context.new_page()
+
+            try:
+                await self._login(page)
+
+                await self.log(f"Descargando detalle RCV ({operacion}) {mes}/{anio}...")
+                await page.goto("https://www4.sii.cl/consdcvinternetui/#/index", wait_until="networkidle")
+                await self._consultar_periodo_rcv(page, str(anio), str(mes).zfill(2))
+
+                await page.click(f"a[href='#{operacion}/']")
+                await self._pausa(1)
+                await page.wait_for_load_state("networkidle")
+
+                btn_descarga = page.locator("button:has-text('Descargar Detalles')")
+                await btn_descarga.first.wait_for(state="visible", timeout=self._plazo_ms(15000))
+                async with page.expect_download() as download_info:
+                    await btn_descarga.first.click()
+
+                download = await download_info.value
+                await download.save_as(output_path)
+
+                print(f"[{self.rut}]  Detalle RCV guardado en: {output_path}")
+                return True
+
+            except (CredencialesInvalidas, PlazoAgotado):
+                raise
+            except Exception as e:
+                print(f"[{self.rut}]  Error descargando detalle RCV: {str(e)}")
+                await trazas.resultado(context, self.job_id, fallo=True)
+                return False
+            finally:
+                await context.close()
                 await browser.close()
 
     async def get_f29_data(self, anio: str, mes: str, es_propuesta: bool = True):
@@ -241,13 +658,10 @@ class SIIScraper:
         Si es_propuesta=False, consulta el histórico para el periodo dado.
         """
         async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            context = await browser.new_context(
-                viewport={'width': 1366, 'height': 768},
-                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-            )
+            browser = await self._lanzar_navegador(p)
+            context = await self._nuevo_contexto(browser, "get_f29_data")
             page = await context.new_page()
-            page.set_default_timeout(60000)
+            self._timeout_base(page, 60000)
 
             try:
                 # 1. Login
@@ -260,109 +674,275 @@ class SIIScraper:
                 else:
                     # Ruta para consultar histórico (Seguimiento)
                     print(f"[{self.rut}] Accediendo a Histrico de F29 ({mes}/{anio})...")
-                    await page.goto("https://www4.sii.cl/consul_f29_internetui/", wait_until="networkidle")
-                    
-                    await asyncio.sleep(8) # Esperar GWT
-                    selects = page.locator("select.gwt-ListBox")
-                    await selects.first.wait_for(state="visible")
-                    
-                    # Seleccionar F29, Año y Mes
-                    await selects.nth(0).select_option(label="Formulario 29")
-                    await selects.nth(1).select_option(label=anio)
-                    await selects.nth(2).select_option(label=mes)
-                    
-                    await page.get_by_role("button", name="Buscar Datos Ingresados").click()
-                    await asyncio.sleep(5)
+                    await self._abrir_f29_historico(page)
+                    await self._buscar_periodo_f29_historico(page, anio, mes)
 
                 # 2. Extracción de códigos (Lógica común de lectura de campos)
                 # Esta parte lee los valores una vez que el formulario/detalle está cargado
                 print(f"[{self.rut}] Extrayendo cdigos tributarios...")
-                
-                # Mapeo de códigos de interés (pueden expandirse)
-                # Basado en análisis de AI Studio y manual del SII
-                codigos_objetivo = {
-                    "538": "Ventas Afectas (Débito)",
-                    "503": "Débito Facturas",
-                    "589": "Total Débito IVA",
-                    "511": "Monto Neto Facturas Compra",
-                    "537": "Total Crédito IVA",
-                    "504": "Remanente Mes Anterior",
-                    "77": "Remanente Mes Nacional (a favor)",
-                    "115": "PPM (Monto)",
-                    "62": "Tasa PPM (%)",
-                    "151": "Retención Honorarios",
-                    "91": "Total a Pagar"
-                }
-                resultados = {}
-
-                for cod in codigos_objetivo.keys():
-                    try:
-                        # Intentamos obtener el valor vía input o innerText según el estado del form
-                        valor = await page.evaluate(f"""(c) => {{
-                            const el = document.querySelector('#cod' + c) || 
-                                       document.querySelector('[name="cod' + c + '"]') ||
-                                       document.getElementById('cod' + c);
-                            if (!el) return "0";
-                            return el.value || el.innerText || "0";
-                        }}""", cod)
-                        
-                        limpio = valor.strip().replace(".", "").replace("$", "")
-                        resultados[cod] = limpio if limpio else "0"
-                    except:
-                        resultados[cod] = "N/A"
-
-                # Detección de Postergación de IVA
-                try:
-                    is_postponed = await page.evaluate("""() => {
-                        const cb = document.querySelector('input[name*="postergacion"]') || 
-                                   document.querySelector('#chkPostergacion');
-                        return cb ? cb.checked : false;
-                    }""")
-                    resultados["postergacion_iva"] = is_postponed
-                except:
-                    resultados["postergacion_iva"] = False
+                resultados = await self._leer_codigos_f29_consulta(page)
 
                 print(f"[{self.rut}]  Consulta F29 completada.")
+                if self._f29_confiable(resultados):
+                    historial.guardar_f29(self.rut, periodo_clave(anio, mes), resultados,
+                                          propuesta=es_propuesta, fuente="get_f29_data")
+                else:
+                    print(f"[{self.rut}] ⚠️ Lectura F29 {mes}/{anio} incompleta: no se guarda en el historial.")
                 return {
                     "periodo": f"{mes}-{anio}",
                     "es_propuesta": es_propuesta,
                     "datos": resultados
                 }
 
+            except (CredencialesInvalidas, PlazoAgotado):
+                raise
             except Exception as e:
                 print(f"[{self.rut}]  Error en Consulta F29: {str(e)}")
+                await trazas.resultado(context, self.job_id, fallo=True)
                 return None
             finally:
+                await context.close()
                 await browser.close()
 
+    async def _abrir_f29_historico(self, page):
+        """Carga la app GWT de consulta de F29 presentados y espera sus selectores."""
+        await page.goto(F29_HISTORICO_URL, wait_until="networkidle")
+        await self._pausa(8) # Esperar GWT
+        await page.locator("select.gwt-ListBox").first.wait_for(state="visible")
+
+    async def _buscar_periodo_f29_historico(self, page, anio: str, mes: str):
+        """En la app de consulta ya cargada, selecciona F29/Año/Mes y busca los datos ingresados."""
+        selects = page.locator("select.gwt-ListBox")
+        await selects.first.wait_for(state="visible")
+
+        # Seleccionar F29, Año y Mes
+        await selects.nth(0).select_option(label="Formulario 29")
+        await selects.nth(1).select_option(label=anio)
+        await selects.nth(2).select_option(label=mes)
+
+        # La búsqueda es un XHR de GWT (no una navegación): se espera a que la página muestre
+        # el periodo pedido y, si ya lo mostraba, a que cambien los códigos. Así nunca se lee
+        # (ni se guarda en el historial) el resultado del periodo anterior.
+        args = [mes, anio, f"{MESES.index(mes) + 1:02d}"] if mes in MESES else [mes, anio, str(mes).zfill(2)]
+        antes = await page.evaluate(JS_ESTADO_CONSULTA_F29, args)
+        await page.get_by_role("button", name="Buscar Datos Ingresados").click()
+        try:
+            await self._esperar(
+                "f29_historico.resultados",
+                lambda t: page.wait_for_function(
+                    """([args, antes]) => {
+                        const estado = (%s)(args);
+                        return estado.periodo && (!antes.periodo || estado.firma !== antes.firma);
+                    }""" % JS_ESTADO_CONSULTA_F29,
+                    arg=[args, antes], polling=250, timeout=t
+                ),
+                20000
+            )
+        except PlaywrightTimeoutError:
+            raise ValueError(f"El SII no mostró los datos de {mes}/{anio} tras la búsqueda")
+
+    async def _leer_codigos_f29_consulta(self, page):
+        """
+        Lee los códigos de CODIGOS_F29_CONSULTA y la postergación de IVA de la página actual.
+        Un código que no está en la página (o que no se pudo leer) queda en None, distinto de
+        un "0" realmente declarado.
+        """
+        resultados = {}
+
+        for cod in CODIGOS_F29_CONSULTA.keys():
+            try:
+                # Intentamos obtener el valor vía input o innerText según el estado del form
+                valor = await page.evaluate("""(c) => {
+                    const el = document.querySelector('#cod' + c) ||
+                               document.querySelector('[name="cod' + c + '"]') ||
+                               document.getElementById('cod' + c);
+                    if (!el) return null;
+                    return el.value || el.innerText || "0";
+                }""", cod)
+            except Exception:
+                valor = None
+            if valor is None:
+                resultados[cod] = None
+            else:
+                limpio = valor.strip().replace(".", "").replace("$", "")
+                resultados[cod] = limpio if limpio else "0"
+
+        # Detección de Postergación de IVA
+        try:
+            is_postponed = await page.evaluate("""() => {
+                const cb = document.querySelector('input[name*="postergacion"]') ||
+                           document.querySelector('#chkPostergacion');
+                return cb ? cb.checked : false;
+            }""")
+            resultados["postergacion_iva"] = is_postponed
+        except:
+            resultados["postergacion_iva"] = False
+        return resultados
+
+    @staticmethod
+    def _f29_confiable(resultados) -> bool:
+        """La lectura trae los códigos obligatorios con valores numéricos."""
+        return bool(resultados) and all(
+            str(resultados.get(cod) or "").lstrip("-").isdigit() for cod in CODIGOS_F29_OBLIGATORIOS
+        )
+
+    async def get_f29_historico(self, periodos, usar_historial: bool = True):
+        """
+        Consulta varios F29 presentados en una sola sesión: un login y una carga de la app
+        GWT, cambiando solo los selectores entre periodos. 'periodos' es una lista de
+        (anio, mes) con el mes por nombre. Los periodos ya guardados en el historial no se
+        vuelven a consultar salvo usar_historial=False.
+        Retorna una lista de {"periodo", "es_propuesta", "datos"} o {"periodo", "error"}.
+        """
+        salida = {}
+        pendientes = []
+        for anio, mes in periodos:
+            guardado = historial.f29(self.rut, periodo_clave(anio, mes)) if usar_historial else None
+            if guardado and self._f29_confiable(guardado):
+                salida[(anio, mes)] = {"periodo": f"{mes}-{anio}", "es_propuesta": False, "datos": guardado, "origen": "historial"}
+            else:
+                pendientes.append((anio, mes))
+
+        if pendientes:
+            async with async_playwright() as p:
+                browser = await self._lanzar_navegador(p)
+                context = await self._nuevo_contexto(browser, "get_f29_historico")
+                page = await context.new_page()
+                self._timeout_base(page, 60000)
+
+                try:
+                    await self._login(page)
+                    await self.log(f"Accediendo a Histórico de F29 ({len(pendientes)} periodos)...")
+                    await self._abrir_f29_historico(page)
+
+                    for i, (anio, mes) in enumerate(pendientes):
+                        await self.log(f"({i+1}/{len(pendientes)}) F29 {mes}/{anio}...")
+                        try:
+                            try:
+                                await self._buscar_periodo_f29_historico(page, anio, mes)
+                            except PlazoAgotado:
+                                raise
+                            except Exception:
+                                # La app quedó en otra vista: se recarga una vez y se reintenta
+                                await self._abrir_f29_historico(page)
+                                await self._buscar_periodo_f29_historico(page, anio, mes)
+                            resultados = await self._leer_codigos_f29_consulta(page)
+                            if not self._f29_confiable(resultados):
+                                raise ValueError("lectura incompleta (faltan códigos obligatorios)")
+                            historial.guardar_f29(self.rut, periodo_clave(anio, mes), resultados, fuente="get_f29_historico")
+                            salida[(anio, mes)] = {"periodo": f"{mes}-{anio}", "es_propuesta": False, "datos": resultados, "origen": "sii"}
+                        except (CredencialesInvalidas, PlazoAgotado):
+                            # Sin plazo no tiene sentido seguir con los periodos restantes
+                            raise
+                        except Exception as e:
+                            await self.log(f"⚠️ Error en F29 {mes}/{anio}: {e}", "error")
+                            salida[(anio, mes)] = {"periodo": f"{mes}-{anio}", "error": str(e)}
+
+                except (CredencialesInvalidas, PlazoAgotado):
+                    raise
+                except Exception as e:
+                    print(f"[{self.rut}]  Error en Histórico F29: {str(e)}")
+                    await trazas.resultado(context, self.job_id, fallo=True)
+                    for anio, mes in pendientes:
+                        salida.setdefault((anio, mes), {"periodo": f"{mes}-{anio}", "error": str(e)})
+                finally:
+                    await context.close()
+                    await browser.close()
+
+        return [salida[(anio, mes)] for anio, mes in periodos]
+
     async def get_prev_month_remanente(self, current_anio: str, current_mes: str):
         """Busca el remanente (Código 77) del mes anterior."""
         # Lógica para calcular mes anterior
-        meses = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
         try:
-            idx = meses.index(current_mes)
+            idx = MESES.index(current_mes)
             if idx == 0:
                 prev_mes = "Diciembre"
                 prev_anio = str(int(current_anio) - 1)
             else:
-                prev_mes = meses[idx - 1]
+                prev_mes = MESES[idx - 1]
                 prev_anio = current_anio
         except:
             return 0
 
+        # Primero el historial local: el F29 ya presentado no cambia entre consultas.
+        # Una lectura guardada que no es confiable se descarta y se vuelve a consultar.
+        periodo = periodo_clave(prev_anio, prev_mes)
+        guardado = historial.f29(self.rut, periodo)
+        if guardado and self._f29_confiable(guardado):
+            print(f"[{self.rut}] Remanente de {prev_mes}/{prev_anio} leído del historial.")
+            return self._remanente_f29(guardado)
+        if guardado:
+            historial.invalidar(self.rut, periodo, F29)
+
         print(f"[{self.rut}] Buscando remanente anterior de {prev_mes}/{prev_anio}...")
         data = await self.get_f29_data(prev_anio, prev_mes, es_propuesta=False)
-        if data and "datos" in data:
-            # El código 77 del mes anterior es el que se arrastra
-            val = data["datos"].get("77", "0")
-            return int(val) if val.isdigit() else 0
+        if data and self._f29_confiable(data.get("datos")):
+            return self._remanente_f29(data["datos"])
         return 0
 
+    def _remanente_f29(self, datos) -> int:
+        # El código 77 del mes anterior es el que se arrastra; si la declaración no lo
+        # incluye (None) es que no hubo remanente, a diferencia de una lectura fallida
+        valor = datos.get("77")
+        if valor is None:
+            print(f"[{self.rut}] La declaración anterior no declara remanente (código 77).")
+            return 0
+        return int(valor) if str(valor).isdigit() else 0
+
+    async def _cookies_sesion(self):
+        """Cookies autenticadas del RUT: cache, sesión persistente o un login breve en el navegador."""
+        cookies = cookies_vigentes(self.rut)
+        if cookies:
+            return cookies
+        if self.context:
+            cookies = await self.context.cookies()
+        else:
+            async with async_playwright() as p:
+                browser = await self._lanzar_navegador(p)
+                context = await self._nuevo_contexto(browser, "_cookies_sesion")
+                try:
+                    page = await context.new_page()
+                    await self._login(page)
+                    cookies = await context.cookies()
+                finally:
+                    await context.close()
+                    await browser.close()
+        guardar_cookies(self.rut, cookies)
+        return cookies
+
+    async def _get_bhe_received_http(self, anio: str, mes: str):
+        """BHE recibidas enviando el formulario CGI directo por HTTP con las cookies de la sesión."""
+        cookies = await self._cookies_sesion()
+        async with ClienteSIIHttp(cookies) as cliente:
+            html = await cliente.enviar_formulario(
+                URL_BHE_RECIBIDAS,
+                selects_por_label={"mes": mes, "ano": anio},
+                boton="Consultar"
+            )
+        return extraer_total_retencion(html)
+
     async def get_bhe_received(self, anio: str, mes: str):
-        """Extrae retenciones de boletas de honorarios recibidas."""
+        """Extrae retenciones de boletas de honorarios recibidas (HTTP directo, con navegador como respaldo)."""
+        if self.har_mode != "off":
+            # La grabación/reproducción HAR solo cubre el tráfico del navegador
+            return await self._get_bhe_received_browser(anio, mes)
+        try:
+            inicio = time.monotonic()
+            retencion = await self._get_bhe_received_http(anio, mes)
+            print(f"[{self.rut}] BHE vía HTTP en {time.monotonic() - inicio:.2f}s.")
+            return retencion
+        except Exception as e:
+            if isinstance(e, SesionExpirada):
+                invalidar_cookies(self.rut)
+            print(f"[{self.rut}] Ruta HTTP de BHE no disponible ({e}), usando navegador...")
+        return await self._get_bhe_received_browser(anio, mes)
+
+    async def _get_bhe_received_browser(self, anio: str, mes: str):
+        """Extrae retenciones de boletas de honorarios recibidas (ruta con navegador)."""
         async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            context = await browser.new_context()
+            browser = await self._lanzar_navegador(p)
+            context = await self._nuevo_contexto(browser, "_get_bhe_received_browser")
             page = await context.new_page()
             try:
                 await self._login(page)
@@ -387,9 +967,106 @@ class SIIScraper:
                     return "0";
                 }""")
                 return int(retencion.replace('.','')) if retencion else 0
-            except:
+            except (CredencialesInvalidas, PlazoAgotado):
+                raise
+            except Exception:
+                await trazas.resultado(context, self.job_id, fallo=True)
                 return 0
             finally:
+                await context.close()
+                await browser.close()
+
+    async def _boletas_bhe_http(self, cliente, anio: str, mes: str):
+        """Boletas de un mes por HTTP, recorriendo todas las páginas del listado."""
+        periodo = periodo_clave(anio, mes)
+        html = await cliente.enviar_formulario(URL_BHE_RECIBIDAS, selects_por_label={"mes": mes, "ano": anio}, boton="Consultar")
+        primera, boletas = html, []
+        for _ in range(MAX_PAGINAS_BHE):
+            boletas += extraer_boletas_bhe(html, periodo)
+            html = await cliente.pagina_siguiente(html, URL_BHE_RECIBIDAS)
+            if html is None:
+                break
+        return boletas, total_mes_bhe(periodo, boletas, primera)
+
+    async def _boletas_bhe_navegador(self, page, anio: str, mes: str):
+        """Boletas de un mes en el navegador (sesión ya iniciada), recorriendo todas las páginas."""
+        periodo = periodo_clave(anio, mes)
+        await page.goto(URL_BHE_RECIBIDAS)
+        await page.select_option("select[name='mes']", label=mes)
+        await page.select_option("select[name='ano']", label=anio)
+        await page.click("input[value='Consultar']")
+        await page.wait_for_load_state("networkidle")
+        primera, boletas = await page.content(), []
+        for _ in range(MAX_PAGINAS_BHE):
+            boletas += extraer_boletas_bhe(await page.content(), periodo)
+            siguiente = page.locator("a:has-text('Siguiente'), input[type='submit'][value*='Siguiente']")
+            if not await siguiente.count():
+                break
+            await siguiente.first.click()
+            await page.wait_for_load_state("networkidle")
+        return boletas, total_mes_bhe(periodo, boletas, primera)
+
+    async def iterar_bhe_periodos(self, periodos):
+        """
+        Boletas de honorarios recibidas de varios periodos [(anio, mes por nombre)] con un
+        solo login: por HTTP directo con las cookies de la sesión y, si esa ruta no está
+        disponible, con un único navegador. Genera cada boleta como {"tipo": "boleta", ...}
+        y al cerrar cada mes {"tipo": "total_mes", ...} (o {"tipo": "error", ...}).
+        """
+        pendientes = list(periodos)
+
+        if self.har_mode == "off":
+            cliente = None
+            try:
+                cliente = ClienteSIIHttp(await self._cookies_sesion())
+                while pendientes:
+                    anio, mes = pendientes[0]
+                    await self.log(f"BHE {mes}/{anio} (HTTP)...")
+                    self._verificar_plazo()
+                    try:
+                        boletas, total = await self._boletas_bhe_http(cliente, anio, mes)
+                    except SesionExpirada:
+                        # Cookies vencidas: se renuevan una vez y se reintenta el periodo
+                        invalidar_cookies(self.rut)
+                        await cliente.client.aclose()
+                        cliente = None
+                        cliente = ClienteSIIHttp(await self._cookies_sesion())
+                        boletas, total = await self._boletas_bhe_http(cliente, anio, mes)
+                    pendientes.pop(0)
+                    for boleta in boletas:
+                        yield {"tipo": "boleta", **boleta}
+                    yield {"tipo": "total_mes", **total}
+            except (CredencialesInvalidas, PlazoAgotado):
+                raise
+            except Exception as e:
+                print(f"[{self.rut}] Ruta HTTP de BHE no disponible ({e}), usando navegador...")
+            finally:
+                # El cliente vigente, sea el original o el que reemplazó a uno con sesión vencida
+                if cliente:
+                    await cliente.client.aclose()
+
+        if not pendientes:
+            return
+        async with async_playwright() as p:
+            browser = await self._lanzar_navegador(p)
+            context = await self._nuevo_contexto(browser, "iterar_bhe_periodos")
+            page = await context.new_page()
+            try:
+                await self._login(page)
+                for anio, mes in pendientes:
+                    try:
+                        boletas, total = await self._boletas_bhe_navegador(page, anio, mes)
+                    except (CredencialesInvalidas, PlazoAgotado):
+                        raise
+                    except Exception as e:
+                        await self.log(f"⚠️ Error en BHE {mes}/{anio}: {e}", "error")
+                        yield {"tipo": "error", "periodo": periodo_clave(anio, mes), "error": str(e)}
+                        continue
+                    for boleta in boletas:
+                        yield {"tipo": "boleta", **boleta}
+                    yield {"tipo": "total_mes", **total}
+            finally:
+                await context.close()
                 await browser.close()
 
     async def prepare_f29_scouting(self, anio: str, mes: str):
@@ -410,13 +1087,16 @@ class SIIScraper:
         # 4. Propuesta actual del SII (para contrastar)
         propuesta_sii = await self.get_f29_data(anio, mes, es_propuesta=True)
 
+        # Una lectura sin los códigos obligatorios no se usa como propuesta (no es un 0 real)
+        propuesta_confiable = bool(propuesta_sii) and self._f29_confiable(propuesta_sii.get("datos"))
+
         # 5. Cálculos lógicos (Simulación de Auditoría)
         iva_ventas = 0
         iva_compras = 0
         if rcv_data:
             # Aquí deberíamos tener lógica para separar compras de ventas en el scraper
             # Por ahora sumamos lo que tenemos
-            iva_compras = sum(int(item['iva_recuperable'].replace('.','')) for item in rcv_data if 'iva_recuperable' in item)
+            iva_compras = rcv_data.total("iva_recuperable")
 
         # Construcción del borrador para el "Humano"
         borrador = {
@@ -424,7 +1104,7 @@ class SIIScraper:
                 "iva_compras_rcv": iva_compras,
                 "remanente_anterior": remanente_ant,
                 "retenciones_honorarios": retenciones_bhe,
-                "propuesta_sii_total": int(propuesta_sii['datos'].get('91', '0')) if propuesta_sii else 0
+                "propuesta_sii_total": int(propuesta_sii['datos'].get('91') or 0) if propuesta_confiable else None
             },
             "alertas": [],
             "consultas_al_usuario": [
@@ -442,7 +1122,12 @@ class SIIScraper:
         }
         
         # Añadir banderas lógicas
-        if propuesta_sii and int(propuesta_sii['datos'].get('537', '0')) != iva_compras:
+        if propuesta_sii and not propuesta_confiable:
+            borrador["alertas"].append({
+                "tipo": "Lectura incompleta",
+                "mensaje": "No se pudo leer el total de la propuesta del SII (código 91). Revísala directamente en el SII."
+            })
+        if propuesta_confiable and int(propuesta_sii['datos'].get('537') or 0) != iva_compras:
             borrador["alertas"].append({
                 "tipo": "Diferencia IVA",
                 "mensaje": "El RCV muestra más crédito que la propuesta del SII. ¿Hay facturas sin aceptar?"
@@ -468,14 +1153,20 @@ class SIIScraper:
         if not rcv_data or not f29_result:
             return {"error": "No se pudieron obtener ambos sets de datos para comparar."}
 
-        f29_codes = f29_result.get("datos", {})
+        f29_codes = f29_result.get("datos") or {}
+        if not self._f29_confiable(f29_codes):
+            return {
+                "periodo": f"{mes}-{anio}",
+                "error": "Lectura incompleta de la propuesta F29 (faltan códigos obligatorios): no se puede comparar.",
+                "analisis": {"estado": "INCOMPLETO"}
+            }
         
         # 3. Lógica de comparación de IVA
         # Sumamos el neto y IVA de las facturas en el RCV
-        rcv_neto_total = sum(int(item['monto_neto'].replace('.','')) for item in rcv_data if 'monto_neto' in item)
-        rcv_iva_total = sum(int(item['iva_recuperable'].replace('.','')) for item in rcv_data if 'iva_recuperable' in item)
+        rcv_neto_total = rcv_data.total("monto_neto")
+        rcv_iva_total = rcv_data.total("iva_recuperable")
         
-        f29_iva_credito = int(f29_codes.get("537", "0"))
+        f29_iva_credito = int(f29_codes.get("537") or 0)
         
         discrepancia_iva = rcv_iva_total - f29_iva_credito
         
@@ -487,7 +1178,7 @@ class SIIScraper:
             },
             "f29_propuesta": {
                 "iva_credito_cod537": f29_iva_credito,
-                "total_a_pagar_cod91": int(f29_codes.get("91", "0"))
+                "total_a_pagar_cod91": int(f29_codes.get("91") or 0)
             },
             "analisis": {
                 "discrepancia_iva": discrepancia_iva,
@@ -502,363 +1193,521 @@ class SIIScraper:
     async def navigate_to_f29_official_path(self, anio: str, mes: str):
         """Navega al F29 siguiendo la ruta oficial sugerida por AI Studio."""
         async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            context = await browser.new_context(
-                viewport={'width': 1366, 'height': 768},
-                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-            )
+            browser = await self._lanzar_navegador(p)
+            context = await self._nuevo_contexto(browser, "navigate_to_f29_official_path")
             page = await context.new_page()
 
             try:
                 # 1. Login
                 await self._login(page)
-                
+
                 # 2. Ruta: Servicios online -> Impuestos mensuales -> Declaración mensual (F29) -> Declarar IVA (F29)
-                print(f"[{self.rut}] Navegando por ruta oficial...")
-                await page.goto("https://www.sii.cl/servicios_online/impuestos_mensuales.html")
-                await page.click("text=Declaración mensual (F29)")
-                await page.click("text=Declarar IVA (F29)")
-                
-                # 3. Selección de período
-                print(f"[{self.rut}] Seleccionando perodo {mes}/{anio}...")
-                await page.wait_for_selector("select[name='mes']", timeout=15000)
-                await page.select_option("select[name='mes']", label=mes)
-                await page.select_option("select[name='anio']", label=anio)
-                await page.click("button:has-text('Aceptar')")
-                
-                # 4. Manejo de asistentes y modales (reutilizamos la lógica del flujo de alertas)
-                await asyncio.sleep(10)
-                
-                # Manejo de modal de actividad económica si aparece
-                if await page.locator("button:has-text('Cerrar')").count() > 0:
-                    await page.click("button:has-text('Cerrar')")
-                
-                # Si hay una propuesta, aceptar
-                btn_aceptar = page.locator("button:has-text('Aceptar')")
-                if await btn_aceptar.count() > 0:
-                    await btn_aceptar.click()
-                    await asyncio.sleep(10)
-                
-                # Continuar en asistentes
-                btn_continuar = page.locator("button:has-text('Continuar')")
-                if await btn_continuar.count() > 0:
-                    await btn_continuar.click()
-                    await asyncio.sleep(5)
-
-                # Confirmar que no hay complementos
-                check_aceptar = page.locator("#checkAceptar")
-                if await check_aceptar.count() > 0:
-                    await check_aceptar.check()
-                    await page.click("button:has-text('Confirmar que no debo complementar')")
-                    await asyncio.sleep(5)
-
-                # Ir al formulario completo
-                link_formulario = page.locator("text=Ingresa aquí").or_(page.locator("text=Ver Formulario 29"))
-                if await link_formulario.count() > 0:
-                    await link_formulario.first.click()
-                    await asyncio.sleep(8)
+                await self._abrir_f29_ruta_oficial(page, anio, mes)
 
                 print(f"[{self.rut}]  Llegamos al formulario final.")
                 # Aquí se podría llamar a una función de extracción común
                 # Por ahora retornamos éxito de navegación
                 return True
 
+            except (CredencialesInvalidas, PlazoAgotado):
+                raise
             except Exception as e:
                 print(f"[{self.rut}]  Error en ruta oficial: {str(e)}")
+                await trazas.resultado(context, self.job_id, fallo=True)
                 return False
             finally:
+                await context.close()
                 await browser.close()
 
-    async def navigate_to_f29_from_home(self, mes=None, anio=None):
+    async def _abrir_f29_ruta_oficial(self, page, anio: str, mes: str):
+        """Servicios online -> Impuestos mensuales -> Declarar IVA (F29) -> periodo -> asistentes."""
+        print(f"[{self.rut}] Navegando por ruta oficial...")
+        await page.goto("https://www.sii.cl/servicios_online/impuestos_mensuales.html")
+        await page.click("text=Declaración mensual (F29)")
+        await page.click("text=Declarar IVA (F29)")
+
+        # 3. Selección de período
+        print(f"[{self.rut}] Seleccionando perodo {mes}/{anio}...")
+        await page.wait_for_selector("select[name='mes']", timeout=self._plazo_ms(15000))
+        await page.select_option("select[name='mes']", label=mes)
+        await page.select_option("select[name='anio']", label=anio)
+        await page.click("button:has-text('Aceptar')")
+
+        # 4. Manejo de asistentes y modales (reutilizamos la lógica del flujo de alertas)
+        await self._pausa(10)
+
+        # Manejo de modal de actividad económica si aparece
+        if await page.locator("button:has-text('Cerrar')").count() > 0:
+            await page.click("button:has-text('Cerrar')")
+
+        # Si hay una propuesta, aceptar
+        btn_aceptar = page.locator("button:has-text('Aceptar')")
+        if await btn_aceptar.count() > 0:
+            await btn_aceptar.click()
+            await self._pausa(10)
+
+        # Continuar en asistentes
+        btn_continuar = page.locator("button:has-text('Continuar')")
+        if await btn_continuar.count() > 0:
+            await btn_continuar.click()
+            await self._pausa(5)
+
+        # Confirmar que no hay complementos
+        check_aceptar = page.locator("#checkAceptar")
+        if await check_aceptar.count() > 0:
+            await check_aceptar.check()
+            await page.click("button:has-text('Confirmar que no debo complementar')")
+            await self._pausa(5)
+
+        # Ir al formulario completo
+        link_formulario = page.locator("text=Ingresa aquí").or_(page.locator("text=Ver Formulario 29"))
+        if await link_formulario.count() > 0:
+            await link_formulario.first.click()
+            await self._pausa(8)
+        if not await self._esperar_formulario_f29(page, intentos=5):
+            return None
+        return await self._periodo_formulario_f29(page, anio, mes)
+
+    async def _abrir_f29_deep_link(self, page, anio: str = None, mes: str = None):
+        """Va directo a la app de declaración del F29 y elige el periodo si el SII lo pide."""
+        await self.log("Probando acceso directo al formulario F29...")
+        await page.goto(F29_DEEP_LINK, wait_until="networkidle")
+
+        # Si la app muestra el selector de periodo, elegimos el solicitado
+        if mes and anio and await page.locator("select[name='mes']").count() > 0:
+            await page.select_option("select[name='mes']", label=mes)
+            await page.select_option("select[name='anio']", label=anio)
+            await page.click("button:has-text('Aceptar')")
+            await self._pausa(5)
+
+        await self._superar_asistentes_f29(page)
+        if not await self._esperar_formulario_f29(page, intentos=5):
+            return None
+        return await self._periodo_formulario_f29(page, anio, mes)
+
+    async def _abrir_f29_desde_home(self, page, mes=None, anio=None):
         """
-        Navega al F29 utilizando las alertas de la página de inicio (Mi SII).
-        Si no se especifica mes/anio, busca el periodo más reciente con estado 'Pendiente'.
+        Recorre las alertas de Mi SII hasta el formulario del F29.
+        Retorna el texto del periodo encontrado, o None si no hay periodo pendiente.
         """
-        page = await self._ensure_session()
-
+        # 2. Esperar a la Home
+        await self.log("Esperando panel de alertas...")
+        await self._esperar(
+            "f29_home.panel_alertas",
+            lambda t: page.wait_for_selector("text=Responsabilidades Tributarias", timeout=t),
+            20000
+        )
+
+        # 3. Asegurar que 'Declaraciones' esté seleccionado
+        await self.log("Seleccionando pestaña 'Declaraciones'...")
+        await page.wait_for_load_state("networkidle")
+        # Selector más robusto para la pestaña Declaraciones
         try:
-            # Si no estamos logueados o en una URL del SII, _ensure_session ya hizo lo básico, 
-            # pero forzamos ir a la home de alertas si estamos perdidos.
-            if "portal.sii.cl" not in page.url and "rfiInternet" not in page.url:
-                await self._login(page)
+            await self._esperar("f29_home.pestana_declaraciones", lambda t: page.click("text=/^\\s*Declaraciones\\s*$/", timeout=t), 5000, opcional=True)
+        except:
+            await self.log("No se pudo hacer clic exacto en 'Declaraciones', intentando alternativa...")
+            await page.click("div:has-text('Declaraciones')")
+        await self._pausa(2)
 
-            # 2. Esperar a la Home
-            await self.log("Esperando panel de alertas...")
-            await page.wait_for_selector("text=Responsabilidades Tributarias", timeout=20000)
-            
-            # 3. Asegurar que 'Declaraciones' esté seleccionado
-            await self.log("Seleccionando pestaña 'Declaraciones'...")
-            await page.wait_for_load_state("networkidle")
-            # Selector más robusto para la pestaña Declaraciones
+        # 4. Buscar el ítem de F29 y hacer clic para expandir
+        await self.log("Buscando sección de F29...")
+        await page.click("text=Declaración de IVA, impuestos mensuales (F29)")
+        await self._pausa(3)
+
+        # 5. Buscar la fila del periodo objetivo o el más reciente pendiente
+        periodo_objetivo = f"{mes} {anio}" if mes and anio else None
+
+        if periodo_objetivo:
+            await self.log(f"Buscando periodo específico: {periodo_objetivo}...")
+            fila_target = page.locator("tr").filter(has_text=periodo_objetivo).filter(has_text="Pendiente")
+        else:
+            await self.log("Buscando el periodo pendiente más reciente...")
+            # Tomamos la primera fila que tenga el texto 'Pendiente' dentro de la sección de F29
+            fila_target = page.locator("tr:has-text('Pendiente')").first
+
+        if await fila_target.count() == 0:
+            return None
+
+        texto_periodo = await fila_target.locator("td").first.inner_text()
+        await self.log(f"Periodo detectado: {texto_periodo.strip()} ✅")
+
+        # El botón 'Pendiente' suele ser el link
+        btn_pendiente = fila_target.locator("text=Pendiente")
+
+        await self.log("Haciendo clic en 'Pendiente' para entrar al formulario...")
+        async def entrar_formulario(t):
+            async with page.expect_navigation(timeout=t):
+                await btn_pendiente.click()
+        await self._esperar("f29_home.entrar_formulario", entrar_formulario, 30000)
+
+        await self._pausa(15) # Esperar carga profunda del formulario/selector de periodo
+        await self.log(f"Página de selección/formulario cargada. URL: {page.url}")
+
+        await self._superar_asistentes_f29(page)
+        return texto_periodo.strip()
+
+    async def _superar_asistentes_f29(self, page):
+        """Cierra modales y asistentes del F29 hasta dejar visible el Formulario Completo."""
+        # --- NUEVO: Manejo de Modal de Actividad Económica (Enero 2026) ---
+        await self.log("Verificando si aparece modal de Actividad Económica...")
+        modal_actividad = page.locator("div:has-text('ACTIVIDAD ECONÓMICA PRINCIPAL')")
+        if await modal_actividad.count() > 0 and await modal_actividad.is_visible():
+            await self.log("Modal detectado. Seleccionando actividad...")
             try:
-                await page.click("text=/^\\s*Declaraciones\\s*$/", timeout=5000)
-            except:
-                await self.log("No se pudo hacer clic exacto en 'Declaraciones', intentando alternativa...")
-                await page.click("div:has-text('Declaraciones')")
-            await asyncio.sleep(2)
-
-            # 4. Buscar el ítem de F29 y hacer clic para expandir
-            await self.log("Buscando sección de F29...")
-            await page.click("text=Declaración de IVA, impuestos mensuales (F29)")
-            await asyncio.sleep(3)
-
-            # 5. Buscar la fila del periodo objetivo o el más reciente pendiente
-            periodo_objetivo = f"{mes} {anio}" if mes and anio else None
-            
-            if periodo_objetivo:
-                await self.log(f"Buscando periodo específico: {periodo_objetivo}...")
-                fila_target = page.locator("tr").filter(has_text=periodo_objetivo).filter(has_text="Pendiente")
-            else:
-                await self.log("Buscando el periodo pendiente más reciente...")
-                # Tomamos la primera fila que tenga el texto 'Pendiente' dentro de la sección de F29
-                fila_target = page.locator("tr:has-text('Pendiente')").first
-            
-            if await fila_target.count() > 0:
-                texto_periodo = await fila_target.locator("td").first.inner_text()
-                await self.log(f"Periodo detectado: {texto_periodo.strip()} ✅")
-                
-                # El botón 'Pendiente' suele ser el link
-                btn_pendiente = fila_target.locator("text=Pendiente")
-                
-                await self.log("Haciendo clic en 'Pendiente' para entrar al formulario...")
-                async with page.expect_navigation():
-                    await btn_pendiente.click()
-                
-                await asyncio.sleep(15) # Esperar carga profunda del formulario/selector de periodo
-                await self.log(f"Página de selección/formulario cargada. URL: {page.url}")
-                
-                # --- NUEVO: Manejo de Modal de Actividad Económica (Enero 2026) ---
-                await self.log("Verificando si aparece modal de Actividad Económica...")
-                modal_actividad = page.locator("div:has-text('ACTIVIDAD ECONÓMICA PRINCIPAL')")
-                if await modal_actividad.count() > 0 and await modal_actividad.is_visible():
-                    await self.log("Modal detectado. Seleccionando actividad...")
+                # Seleccionar la primera opción válida del dropdown
+                select_act = page.locator("select").filter(has_text="Seleccione Actividad")
+                if await select_act.count() > 0:
+                    await select_act.select_option(index=1)
+                    await self._pausa(1)
+                    await page.click("button:has-text('Confirmar')")
+                    await self.log("Actividad confirmada.")
+                    await self._pausa(5)
+            except Exception as e:
+                await self.log(f"No se pudo completar el modal: {e}", "error")
+                # Intentar simplemente cerrar si existe el botón
+                await page.click("button:has-text('Cerrar')")
+
+        # 6. Detectar si estamos en la página de "Aceptar"
+        btn_aceptar = page.locator("button:has-text('Aceptar')")
+        if await btn_aceptar.count() > 0:
+            await self.log("Detectado botón 'Aceptar'. Haciendo clic para ver propuesta...")
+            await btn_aceptar.click()
+            await self._pausa(15) # Esperar carga profunda del formulario/asistentes
+
+        # 7. Superar Asistentes de Cálculo (Botón Continuar)
+        btn_continuar = page.locator("button:has-text('Continuar')")
+        if await btn_continuar.count() > 0:
+            await self.log("Superando asistentes de cálculo...")
+            await btn_continuar.click()
+            await self._pausa(5)
+
+        # 8. Modal de Información Adicional (IMPORTANTE)
+        await self.log("Verificando modal de confirmación de datos...")
+        check_aceptar = page.locator("#checkAceptar")
+        if await check_aceptar.count() > 0:
+            await self.log("Marcando checkbox de confirmación...")
+            await check_aceptar.check()
+            await self._pausa(1)
+            btn_confirmar_complemento = page.locator("button:has-text('Confirmar que no debo complementar')")
+            if await btn_confirmar_complemento.count() > 0:
+                await btn_confirmar_complemento.click()
+                await self.log("Información adicional confirmada.")
+                await self._pausa(8)
+
+        # 9. Cerrar Modal de Atención (si aparece)
+        btn_cerrar_atencion = page.locator("button:has-text('Cerrar')").or_(page.locator(".modal-footer button"))
+        if await btn_cerrar_atencion.count() > 0 and await btn_cerrar_atencion.is_visible():
+            await self.log("Cerrando modal de atención...")
+            await btn_cerrar_atencion.first.click()
+            await self._pausa(2)
+
+        # 10. Ir al Formulario Completo (donde están todos los códigos con valores reales)
+        await self.log("Buscando acceso al Formulario Completo...")
+        # A veces el botón tarda en aparecer o está en un frame
+        await self._pausa(5)
+        link_formulario = page.locator("text=Ingresa aquí").or_(page.locator("text=Ver Formulario 29")).or_(page.locator("text=Formulario en Pantalla"))
+
+        found_link = False
+        for _ in range(3): # Re-intentar 3 veces con esperas
+            if await link_formulario.count() > 0 and await link_formulario.first.is_visible():
+                await self.log("Accediendo a la vista de Formulario Completo...")
+                await link_formulario.first.click()
+                await self._pausa(12)
+                found_link = True
+                break
+            await self._pausa(3)
+
+        if not found_link:
+             await self.log("⚠️ No se encontró el botón para el Formulario Completo. Intentando extracción en vista actual.")
+
+        await self.log(f"Formulario final cargado. URL: {page.url}")
+
+    async def _frames_formulario_f29(self, page) -> list:
+        """Frames (de las páginas del formulario) que muestran la grilla de códigos del F29."""
+        frames = []
+        for p in self._paginas_formulario(page):
+            for f in p.frames:
+                try:
+                    if await f.evaluate(JS_CODIGOS_FORMULARIO_F29, list(CODIGOS_F29_FORMULARIO)) >= MIN_CODIGOS_FORMULARIO_F29:
+                        frames.append(f)
+                except Exception:
+                    continue
+        return frames
+
+    async def _esperar_formulario_f29(self, page, intentos: int = 15):
+        """Espera a que algún frame muestre la grilla de códigos del F29 (cada intento espera 2s)."""
+        for _ in range(intentos):
+            if await self._frames_formulario_f29(page):
+                return True
+            await self._pausa(2)
+        return False
+
+    async def _periodo_formulario_f29(self, page, anio=None, mes=None):
+        """
+        Periodo que muestra el formulario F29 abierto. Con anio/mes, verifica que sea ese
+        (retorna "Mes AAAA" o None si muestra otro); sin ellos, lo lee del texto del formulario.
+        """
+        textos = []
+        for f in await self._frames_formulario_f29(page):
+            try:
+                textos.append(await f.inner_text("body"))
+            except Exception:
+                continue
+        texto = "\n".join(textos)
+        pedido = periodo_clave(anio, mes)
+        if pedido:
+            return f"{mes} {anio}" if periodo_en_texto(texto, pedido) else None
+        leido = periodo_desde_texto(texto)
+        if not leido:
+            return None
+        anio_leido, mm = leido.split("-")
+        return f"{MESES[int(mm) - 1]} {anio_leido}"
+
+    async def _preparar_formulario_f29(self, page):
+        """Recorre la planilla y espera a que algún frame tenga el contenido del formulario."""
+        # 11. Scroll Automático
+        await self.log("Desplazando por la planilla final...")
+        for i in range(5):
+            await page.mouse.wheel(0, 1000)
+            await self._pausa(1)
+        await page.mouse.wheel(0, -5000)
+        await self._pausa(2)
+
+        # ESPERAR A QUE CARGUE EL FORMULARIO EN ALGÚN FRAME
+        await self.log("Esperando carga de datos en formulario (Buscando en todos los frames)...")
+
+        form_ready = await self._esperar_formulario_f29(page) # Intentar por 30 segundos
+
+        if not form_ready:
+            await self.log("⚠️ No se detectó contenido del formulario tras 30s. Intentando extracción de todos modos.")
+        else:
+            await self.log("✅ Contenido del formulario detectado en los frames.")
+
+        await self._pausa(3) # Estabilización final
+
+    async def _extraer_codigos_f29(self, page):
+        """Lee los códigos clave del formulario F29 ya cargado en cualquier pestaña o frame."""
+        await self._preparar_formulario_f29(page)
+
+        # 12. Extracción de códigos
+        await self.log("Iniciando extracción de códigos clave...")
+        resultados = {k: 0 for k in CODIGOS_F29_FORMULARIO.keys()}
+
+        # Huella del diseño del formulario: permite reutilizar frame/estrategia de ejecuciones previas
+        huella = await memo_extraccion.huella(self._paginas_formulario(page))
+
+        for cod in CODIGOS_F29_FORMULARIO.keys():
+            await self.log(f"Buscando Código [{cod}]...")
+            found = False
+
+            # 1. Intento directo con la combinación frame/estrategia recordada
+            pista = memo_extraccion.pista(huella, cod)
+            if pista:
+                frames = [f for p in self._paginas_formulario(page) for f in p.frames if url_frame(f.url) == pista["frame"]]
+                for frame in frames:
                     try:
-                        # Seleccionar la primera opción válida del dropdown
-                        select_act = page.locator("select").filter(has_text="Seleccione Actividad")
-                        if await select_act.count() > 0:
-                            await select_act.select_option(index=1)
-                            await asyncio.sleep(1)
-                            await page.click("button:has-text('Confirmar')")
-                            await self.log("Actividad confirmada.")
-                            await asyncio.sleep(5)
-                    except Exception as e:
-                        await self.log(f"No se pudo completar el modal: {e}", "error")
-                        # Intentar simplemente cerrar si existe el botón
-                        await page.click("button:has-text('Cerrar')")
-
-                # 6. Detectar si estamos en la página de "Aceptar"
-                btn_aceptar = page.locator("button:has-text('Aceptar')")
-                if await btn_aceptar.count() > 0:
-                    await self.log("Detectado botón 'Aceptar'. Haciendo clic para ver propuesta...")
-                    await btn_aceptar.click()
-                    await asyncio.sleep(15) # Esperar carga profunda del formulario/asistentes
-
-                # 7. Superar Asistentes de Cálculo (Botón Continuar)
-                btn_continuar = page.locator("button:has-text('Continuar')")
-                if await btn_continuar.count() > 0:
-                    await self.log("Superando asistentes de cálculo...")
-                    await btn_continuar.click()
-                    await asyncio.sleep(5)
-
-                # 8. Modal de Información Adicional (IMPORTANTE)
-                await self.log("Verificando modal de confirmación de datos...")
-                check_aceptar = page.locator("#checkAceptar")
-                if await check_aceptar.count() > 0:
-                    await self.log("Marcando checkbox de confirmación...")
-                    await check_aceptar.check()
-                    await asyncio.sleep(1)
-                    btn_confirmar_complemento = page.locator("button:has-text('Confirmar que no debo complementar')")
-                    if await btn_confirmar_complemento.count() > 0:
-                        await btn_confirmar_complemento.click()
-                        await self.log("Información adicional confirmada.")
-                        await asyncio.sleep(8)
-
-                # 9. Cerrar Modal de Atención (si aparece)
-                btn_cerrar_atencion = page.locator("button:has-text('Cerrar')").or_(page.locator(".modal-footer button"))
-                if await btn_cerrar_atencion.count() > 0 and await btn_cerrar_atencion.is_visible():
-                    await self.log("Cerrando modal de atención...")
-                    await btn_cerrar_atencion.first.click()
-                    await asyncio.sleep(2)
-
-                # 10. Ir al Formulario Completo (donde están todos los códigos con valores reales)
-                await self.log("Buscando acceso al Formulario Completo...")
-                # A veces el botón tarda en aparecer o está en un frame
-                await asyncio.sleep(5)
-                link_formulario = page.locator("text=Ingresa aquí").or_(page.locator("text=Ver Formulario 29")).or_(page.locator("text=Formulario en Pantalla"))
-                
-                found_link = False
-                for _ in range(3): # Re-intentar 3 veces con esperas
-                    if await link_formulario.count() > 0 and await link_formulario.first.is_visible():
-                        await self.log("Accediendo a la vista de Formulario Completo...")
-                        await link_formulario.first.click()
-                        await asyncio.sleep(12)
-                        found_link = True
+                        r = await frame.evaluate(JS_EXTRAER_CODIGO_F29, {"c": cod, "estrategia": pista["estrategia"]})
+                    except: continue
+                    valor = limpiar_valor(r["valor"]) if r else None
+                    if valor is not None:
+                        resultados[cod] = valor
+                        await self.log(f"    Code [{cod}]: {valor} (memo: {pista['estrategia']})")
+                        found = True
                         break
-                    await asyncio.sleep(3)
-                    
-                if not found_link:
-                     await self.log("⚠️ No se encontró el botón para el Formulario Completo. Intentando extracción en vista actual.")
+                if found:
+                    memo_extraccion.stats["aciertos"] += 1
+                    continue
+                memo_extraccion.stats["fallos_memo"] += 1
+                memo_extraccion.olvidar(huella, cod)
+
+            # 2. Búsqueda completa: todas las páginas abiertas (por si abrió pestaña nueva) y todos los frames
+            memo_extraccion.stats["busquedas_completas"] += 1
+            for p in self._paginas_formulario(page):
+                if found: break
+                for frame in p.frames:
+                    try:
+                        r = await frame.evaluate(JS_EXTRAER_CODIGO_F29, {"c": cod, "estrategia": None})
 
-                await self.log(f"Formulario final cargado. URL: {page.url}")
-                
-                # 11. Scroll Automático
-                await self.log("Desplazando por la planilla final...")
-                for i in range(5):
-                    await page.mouse.wheel(0, 1000)
-                    await asyncio.sleep(1)
-                await page.mouse.wheel(0, -5000) 
-                await asyncio.sleep(2)
-
-                # 12. Extracción de códigos
-                await self.log("Iniciando extracción de códigos clave...")
-                codigos_objetivo = {
-                    "538": "Impuesto Único",
-                    "589": "IVA Débito (Total)",
-                    "503": "Débito Facturas",
-                    "511": "IVA Crédito E-Factura",
-                    "537": "Crédito Periodo",
-                    "504": "Remanente Mes Ant.",
-                    "77": "Remanente Mes Sig.",
-                    "91": "Total a Pagar",
-                    "62": "PPM Neto"
-                }
-                resultados = {k: 0 for k in codigos_objetivo.keys()}
-                
-                # ESPERAR A QUE CARGUE EL FORMULARIO EN ALGÚN FRAME
-                await self.log("Esperando carga de datos en formulario (Buscando en todos los frames)...")
-                
-                form_ready = False
-                for _ in range(15): # Intentar por 30 segundos
-                    for f in page.frames:
-                        try:
-                            content = await f.inner_text("body")
-                            if "Débito" in content or "538" in content or "IVA" in content:
-                                form_ready = True
-                                break
-                        except: continue
-                    if form_ready: break
-                    await asyncio.sleep(2)
-                
-                if not form_ready:
-                    await self.log("⚠️ No se detectó contenido del formulario tras 30s. Intentando extracción de todos modos.")
-                else:
-                    await self.log("✅ Contenido del formulario detectado en los frames.")
-                
-                await asyncio.sleep(3) # Estabilización final
-
-                for cod in codigos_objetivo.keys():
-                    await self.log(f"Buscando Código [{cod}]...")
-                    found = False
-                    # Buscamos en todas las páginas abiertas (por si abrió pestaña nueva)
-                    for p in page.context.pages:
-                        if found: break
-                        for frame in p.frames:
-                            try:
-                                valor = await frame.evaluate(f"""(c) => {{
-                                    const cleanNum = (str) => {{
-                                        if (!str) return null;
-                                        const cleaned = str.replace(/[^0-9]/g, '');
-                                        return cleaned.length > 0 ? parseInt(cleaned).toString() : null;
-                                    }};
-
-                                    // 1. Prioridad: Input con ID o Name que contenga el código
-                                    const input = document.getElementById('valCode' + c) || 
-                                                  document.getElementById('code' + c) ||
-                                                  document.querySelector(`input[id*="${{c}}"]`) ||
-                                                  document.querySelector(`input[name*="${{c}}"]`);
-                                    
-                                    if (input && input.value && cleanNum(input.value)) return input.value;
-
-                                    // 2. Búsqueda por "Label" o Celda que contenga el código (Regex)
-                                    // Buscamos algo como "[504]" o "504:" o "(504)" en el texto
-                                    const elements = Array.from(document.querySelectorAll('td, span, div, b, label'));
-                                    const regex = new RegExp('(\\\\[|\\\\(|^|\\\\s)' + c + '(\\\\]|\\\\)|:|\\\\s|$)');
-                                    
-                                    const labelEl = elements.find(el => regex.test(el.innerText));
-                                    
-                                    if (labelEl) {{
-                                        // Si la celda misma tiene el número largo (ej: "504: 28.500.956")
-                                        if (cleanNum(labelEl.innerText) && cleanNum(labelEl.innerText).length > c.length) {{
-                                            return labelEl.innerText;
-                                        }}
-
-                                        // Si no, buscar en la fila o alrededores
-                                        const container = labelEl.closest('tr') || labelEl.closest('div.row') || labelEl.parentElement;
-                                        if (container) {{
-                                            // Buscar input en el contenedor
-                                            const inCont = container.querySelector('input');
-                                            if (inCont && inCont.value && cleanNum(inCont.value)) return inCont.value;
-
-                                            // Buscar cualquier número largo en las celdas hermanas
-                                            const siblings = Array.from(container.querySelectorAll('td, div, span'));
-                                            for (let s of siblings.reverse()) {{
-                                                const val = cleanNum(s.innerText);
-                                                if (val && val !== c) return s.innerText;
-                                            }}
-                                        }}
-                                    }}
-                                    // ESTRATEGIA 3: Estructura de Tabla Simple (TD con código -> Sibling TD con valor)
-                                    // Común en vistas de resumen/propuesta
-                                    const tds = Array.from(document.querySelectorAll('td'));
-                                    // Buscamos celda que tenga el código (ej: "538" o "[538]")
-                                    const codeTd = tds.find(td => td.innerText.includes('[' + c + ']') || td.innerText.trim() == c);
-
-                                    if (codeTd) {{
-                                        // Buscar en las celdas siguientes de la misma fila
-                                        let sibling = codeTd.nextElementSibling;
-                                        while (sibling) {{
-                                            const txt = sibling.innerText;
-                                            // Si tiene un número y NO es solo el código (evitar falsos positivos si el código se repite)
-                                            // Y es suficientemente largo o tiene formato moneda
-                                            if (cleanNum(txt) && cleanNum(txt) != c) {{
-                                                return txt;
-                                            }}
-                                            sibling = sibling.nextElementSibling;
-                                        }}
-                                    }}
-                                    
-                                    return null;
-                                }}""", cod)
-
-                                if valor:
-                                    val_limpio = valor.strip().replace(".", "").replace("$", "").replace(",", "")
-                                    if val_limpio.isdigit():
-                                        resultados[cod] = int(val_limpio)
-                                        await self.log(f"    Code [{cod}]: {resultados[cod]} (Encontrado en {frame.url[:40]}...)")
-                                        found = True
-                                        break
-                            except: continue
-                    
-                    if not found:
-                         await self.log(f"    Code [{cod}]: 0 (No Encontrado)")
-
-                await page.screenshot(path="f29_full_data_extracted.png")
-                
-                # Verificación de pago (Código 91)
-                total_a_pagar = resultados.get("91", 0)
-                if total_a_pagar > 0:
-                    await self.log(f"⚠️ Atención: Declaración con pago pendiente de ${total_a_pagar}.")
-                else:
-                    await self.log("✅ Declaración sin pago determinado o en $0.")
+                        valor = limpiar_valor(r["valor"]) if r else None
+                        if valor is not None:
+                            resultados[cod] = valor
+                            memo_extraccion.recordar(huella, cod, frame.url, r["estrategia"])
+                            await self.log(f"    Code [{cod}]: {resultados[cod]} (Encontrado en {frame.url[:40]}...)")
+                            found = True
+                            break
+                    except: continue
 
-                return {
-                    "periodo": texto_periodo.strip() if 'texto_periodo' in locals() else "Desconocido",
-                    "url": page.url,
-                    "datos": resultados,
-                    "pago_requerido": total_a_pagar > 0,
-                    "monto_pago": total_a_pagar
-                }
+            if not found:
+                 await self.log(f"    Code [{cod}]: 0 (No Encontrado)")
+
+        return resultados
+
+    async def _extraer_codigos_f29_snapshot(self, page):
+        """
+        Variante sin navegador: toma el HTML de cada frame una sola vez, cierra la sesión
+        de inmediato y procesa los snapshots en el pool de procesos.
+        """
+        await self._preparar_formulario_f29(page)
+
+        await self.log("Capturando snapshots del formulario y liberando el navegador...")
+        snapshots = await capturar_snapshots(self._paginas_formulario(page))
+        await self.close_session()
+
+        encontrados = await extraer_en_pool(snapshots, CODIGOS_F29_FORMULARIO.keys())
+        resultados = {k: 0 for k in CODIGOS_F29_FORMULARIO.keys()}
+        for cod in CODIGOS_F29_FORMULARIO.keys():
+            if cod in encontrados:
+                resultados[cod] = encontrados[cod]["valor"]
+                await self.log(f"    Code [{cod}]: {resultados[cod]} ({encontrados[cod]['estrategia']} en {encontrados[cod]['frame'][:40]}...)")
             else:
+                await self.log(f"    Code [{cod}]: 0 (No Encontrado)")
+        return resultados
+
+    def _resultado_f29(self, url, periodo, resultados):
+        """Arma la respuesta estándar de navegación + extracción del F29."""
+        # Verificación de pago (Código 91)
+        total_a_pagar = resultados.get("91", 0)
+        return {
+            "periodo": periodo or "Desconocido",
+            "url": url,
+            "datos": resultados,
+            "pago_requerido": total_a_pagar > 0,
+            "monto_pago": total_a_pagar
+        }
+
+    def _guardar_f29_historial(self, mes, anio, texto_periodo, resultados, fuente):
+        """Guarda en el historial los códigos leídos del formulario F29 del periodo en curso."""
+        periodo = periodo_clave(anio, mes) or periodo_desde_texto(texto_periodo)
+        historial.guardar_f29(self.rut, periodo, resultados, propuesta=True, fuente=fuente)
+
+    async def _log_pago_f29(self, resultados):
+        total_a_pagar = resultados.get("91", 0)
+        if total_a_pagar > 0:
+            await self.log(f"⚠️ Atención: Declaración con pago pendiente de ${total_a_pagar}.")
+        else:
+            await self.log("✅ Declaración sin pago determinado o en $0.")
+
+    async def navigate_to_f29_from_home(self, mes=None, anio=None):
+        """
+        Navega al F29 utilizando las alertas de la página de inicio (Mi SII).
+        Si no se especifica mes/anio, busca el periodo más reciente con estado 'Pendiente'.
+        """
+        page = await self._ensure_session()
+
+        try:
+            # _ensure_session ya dejó la sesión autenticada (p. ej. precalentada): solo se vuelve
+            # a la home de alertas si la pestaña está en otra página, y se reautentica únicamente
+            # si el SII nos devolvió al login (sesión vencida).
+            if not page.url.startswith(SII_HOME_URL):
+                await page.goto(SII_HOME_URL, wait_until="networkidle")
+            if "AUT2000" in page.url or "IngresoRutClave" in page.url:
+                await self._login(page)
+
+            await trazas.paso(page.context, "alertas_home")
+            texto_periodo = await self._abrir_f29_desde_home(page, mes, anio)
+            if texto_periodo is None:
                 print(f"[{self.rut}]  No se encontró el periodo solicitado ({mes} {anio} - pendiente) en las alertas.")
+                await trazas.resultado(page.context, self.job_id, fallo=True)
                 return None
 
+            await trazas.paso(page.context, "extraccion")
+            resultados = await self._extraer_codigos_f29(page)
+
+            await artefactos.capturar(page, self.job_id, "f29_full_data_extracted")
+            await trazas.resultado(page.context, self.job_id, fallo=False)
+
+            await self._log_pago_f29(resultados)
+            self._guardar_f29_historial(mes, anio, texto_periodo, resultados, fuente="home")
+            return self._resultado_f29(page.url, texto_periodo, resultados)
+
+        except (CredencialesInvalidas, PlazoAgotado):
+            raise
         except Exception as e:
             print(f"[{self.rut}]  Error navegando desde Home: {str(e)}")
             if 'page' in locals():
-                await page.screenshot(path="error_navigation_home.png")
+                await artefactos.capturar(page, self.job_id, "error_navigation_home", fallo=True)
+                await trazas.resultado(page.context, self.job_id, fallo=True)
             return False
         # REMOVIDO: finally browser.close() para permitir persistencia en Scouting Interactivo
 
+    def _rutas_f29_ordenadas(self):
+        """Rutas de navegación al F29, de la más confiable/rápida a la más lenta según el historial."""
+        def prioridad(ruta):
+            st = RUTAS_F29_STATS[ruta]
+            intentos = st["exitos"] + st["fallos"]
+            tasa = st["exitos"] / intentos if intentos else 0.5
+            tiempo = st["segundos_total"] / st["exitos"] if st["exitos"] else 60.0
+            return (-tasa, tiempo)
+        return sorted(RUTAS_F29_STATS.keys(), key=prioridad)
+
+    async def navigate_to_f29(self, mes=None, anio=None, liberar_navegador: bool = False):
+        """
+        Navegador F29 con ruta rápida: intenta primero el acceso directo (deep link) y solo
+        recurre a la ruta oficial o a las alertas de Mi SII si no llegó al formulario.
+        Registra qué ruta funcionó para probarla primero la próxima vez.
+        Con liberar_navegador=True la sesión se cierra apenas se capturan los snapshots
+        del formulario y la extracción corre fuera del navegador.
+        """
+        page = await self._ensure_session()
+        rutas = {
+            "deep_link": lambda: self._abrir_f29_deep_link(page, anio, mes),
+            "ruta_oficial": lambda: self._abrir_f29_ruta_oficial(page, anio, mes),
+            "home": lambda: self._abrir_f29_home_logueado(page, mes, anio),
+        }
+
+        for ruta in self._rutas_f29_ordenadas():
+            # La ruta oficial necesita el periodo explícito
+            if ruta == "ruta_oficial" and not (mes and anio):
+                continue
+            inicio = time.monotonic()
+            try:
+                await self.log(f"Navegando al F29 vía '{ruta}'...")
+                await trazas.paso(page.context, f"ruta_{ruta}")
+                texto_periodo = await rutas[ruta]()
+                ok = texto_periodo is not None and await self._esperar_formulario_f29(page, intentos=5)
+                if ok and mes and anio and not await self._periodo_formulario_f29(page, anio, mes):
+                    # Llegó a un formulario, pero de otro periodo: no cuenta como éxito de la ruta
+                    await self.log(f"Ruta '{ruta}' abrió un formulario que no es de {mes} {anio}.", "error")
+                    ok = False
+            except (CredencialesInvalidas, PlazoAgotado):
+                raise
+            except Exception as e:
+                await self.log(f"Ruta '{ruta}' falló: {e}", "error")
+                ok = False
+
+            st = RUTAS_F29_STATS[ruta]
+            if not ok:
+                st["fallos"] += 1
+                continue
+
+            st["exitos"] += 1
+            st["segundos_total"] += time.monotonic() - inicio
+            await self.log(f"✅ Formulario F29 alcanzado vía '{ruta}' en {time.monotonic() - inicio:.1f}s.")
+
+            await trazas.paso(page.context, "extraccion")
+            url_formulario = page.url
+            if liberar_navegador:
+                await trazas.resultado(page.context, self.job_id, fallo=False)
+                resultados = await self._extraer_codigos_f29_snapshot(page)
+            else:
+                resultados = await self._extraer_codigos_f29(page)
+                await trazas.resultado(page.context, self.job_id, fallo=False)
+            await self._log_pago_f29(resultados)
+            self._guardar_f29_historial(mes, anio, texto_periodo, resultados, fuente=ruta)
+            resultado = self._resultado_f29(url_formulario, texto_periodo, resultados)
+            resultado["ruta"] = ruta
+            return resultado
+
+        print(f"[{self.rut}]  Ninguna ruta llegó al formulario F29 ({mes} {anio}).")
+        await artefactos.capturar(page, self.job_id, "error_navegacion_f29", fallo=True)
+        await trazas.resultado(page.context, self.job_id, fallo=True)
+        return None
+
+    async def _abrir_f29_home_logueado(self, page, mes=None, anio=None):
+        """Vuelve a Mi SII (con la sesión ya iniciada) y recorre las alertas hasta el F29."""
+        await page.goto(SII_HOME_URL, wait_until="networkidle")
+        return await self._abrir_f29_desde_home(page, mes, anio)
+
     async def submit_f29(self, page, banco=None):
         """
         Finaliza el proceso de envío del F29. 
@@ -870,7 +1719,7 @@ class SIIScraper:
             # 1. Click en el botón de enviar/aceptar de la planilla
             btn_enviar = page.locator("button:has-text('Enviar Declaración'), button:has-text('Aceptar')")
             await btn_enviar.first.click()
-            await asyncio.sleep(5)
+            await self._pausa(5)
 
             # 2. Manejo de Pago si aplica
             if banco:
@@ -881,7 +1730,7 @@ class SIIScraper:
 
             # 3. Confirmación Final
             await self.log("Esperando confirmación de recepción...")
-            await page.wait_for_selector("text=Declaración Recibida", timeout=30000)
+            await page.wait_for_selector("text=Declaración Recibida", timeout=self._plazo_ms(30000))
             
             # 4. Captura de Folio
             folio = await page.evaluate("""() => {
@@ -892,22 +1741,25 @@ class SIIScraper:
             fecha = await page.evaluate("() => new Date().toLocaleString()")
             
             await self.log(f"✅ ¡Éxito! Folio capturado: {folio}")
-            await page.screenshot(path=f"comprobante_f29_{folio}.png")
+            # El comprobante se guarda siempre, independiente de la política de artefactos
+            screenshot_path = await artefactos.capturar(page, self.job_id, f"comprobante_f29_{folio}", obligatorio=True)
             
             return {
                 "folio": folio,
                 "fecha": fecha,
-                "screenshot": f"comprobante_f29_{folio}.png"
+                "screenshot": screenshot_path
             }
         except Exception as e:
             await self.log(f"Error en el envío: {e}", "error")
+            await artefactos.capturar(page, self.job_id, "error_envio_f29", fallo=True)
             return False
 
     async def check_pending_rcv(self, mes=None, anio=None):
         """
         Navega al Registro de Compras y Ventas (RCV) para detectar facturas pendientes.
+        Usa su propia pestaña ("rcv") para no mover la principal, que queda en el F29.
         """
-        page = await self._ensure_session()
+        page = await self.pestana("rcv")
         hoy = datetime.now()
         
         # Normalizar mes y año
@@ -920,27 +1772,20 @@ class SIIScraper:
 
         try:
             await self.log(f"Cruzando datos con el RCV para {mes_str}/{anio_str} (Buscando facturas sin acuse)...")
-            await page.goto("https://www4.sii.cl/consdcvinternetui/#/index", wait_until="networkidle")
-            
-            await page.wait_for_selector("#periodoMes", timeout=10000)
-            
-            # Seleccionar Año y Mes
-            selects = page.locator("select")
-            await selects.nth(2).select_option(label=anio_str)
-            await page.select_option("#periodoMes", value=mes_str)
-            
-            # Click en Consultar
-            await page.locator("button:has-text('Consultar')").click()
-            await asyncio.sleep(3)
-            await page.wait_for_load_state("networkidle")
+            await self._esperar(
+                "rcv.abrir",
+                lambda t: page.goto("https://www4.sii.cl/consdcvinternetui/#/index", wait_until="networkidle", timeout=t),
+                30000
+            )
+            await self._consultar_periodo_rcv(page, anio_str, mes_str)
 
             # Click en la pestaña 'Pendiente' (Facturas que no han dado acuse)
             # El selector puede variar, probamos con texto y href
             tab_pendiente = page.locator("a:has-text('Pendiente')").or_(page.locator("a[href*='pendiente']"))
             if await tab_pendiente.count() > 0:
                 await tab_pendiente.first.click()
-                await asyncio.sleep(2)
-                await page.wait_for_load_state("networkidle")
+                await self._pausa(2)
+                await self._esperar("rcv.pendientes", lambda t: page.wait_for_load_state("networkidle", timeout=t), 30000)
                 
                 # Extraer facturas pendientes
                 pendientes = await page.evaluate("""() => {
@@ -977,6 +1822,8 @@ class SIIScraper:
                 await self.log("No se encontró la sección de facturas pendientes (esto suele significar que no hay).")
                 return {"total_pendientes": 0, "iva_pendiente": 0}
 
+        except (CredencialesInvalidas, PlazoAgotado):
+            raise
         except Exception as e:
             await self.log(f"Error revisando RCV: {e}", "error")
             return None
@@ -1,39 +1,38 @@
 import asyncio
 from playwright.async_api import async_playwright
-from scraper import SIIScraper
+from scraper import SIIScraper, PlazoAgotado
+from rcv_modelo import ResumenRCV, JS_CELDAS_TABLA_RCV, agregar
+from historial import historial
+from sii_http import CredencialesInvalidas
 from datetime import datetime, timedelta, timezone
 
+def ultimos_12_periodos(hoy):
+    """Lista de {"mes": "MM", "anio": "AAAA"} desde el mes actual hacia atrás."""
+    periodos = []
+    for i in range(12):
+        # Restar i meses a la fecha actual
+        mes = hoy.month - i
+        anio = hoy.year
+        while mes <= 0:
+            mes += 12
+            anio -= 1
+        periodos.append({"mes": str(mes).zfill(2), "anio": str(anio)})
+    return periodos
+
 class SIIScraperAnual(SIIScraper):
-    async def get_rcv_ultimos_12_meses(self, headless: bool = True):
-        """Extrae los últimos 12 meses de RCV desde la fecha actual y los une en un solo JSON."""
+    async def iterar_rcv_ultimos_12_meses(self, headless: bool = True):
+        """
+        Genera el RCV de cada uno de los últimos 12 meses apenas se extrae:
+        {"periodo", "compras": ResumenRCV, "ventas": ResumenRCV} o {"periodo", "error"}.
+        Un error de login o de navegación inicial se propaga como excepción.
+        """
         async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=headless)
-            context = await browser.new_context(
-                viewport={'width': 1366, 'height': 768},
-                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-            )
+            browser = await self._lanzar_navegador(p, headless)
+            context = await self._nuevo_contexto(browser, "iterar_rcv_ultimos_12_meses")
             page = await context.new_page()
 
             # Generar lista de los últimos 12 meses
-            hoy = datetime.datetime.now()
-            periodos = []
-            for i in range(12):
-                # Restar i meses a la fecha actual
-                fecha_busqueda = hoy - datetime.timedelta(days=i*30) 
-                # Ajuste más preciso para meses
-                mes = hoy.month - i
-                anio = hoy.year
-                while mes <= 0:
-                    mes += 12
-                    anio -= 1
-                periodos.append({"mes": str(mes).zfill(2), "anio": str(anio)})
-
-            consolidado = {
-                "rut": self.rut,
-                "fecha_extraccion": hoy.isoformat(),
-                "periodos_extraidos": len(periodos),
-                "data": []
-            }
+            periodos = ultimos_12_periodos(datetime.now())
 
             try:
                 # 1. Login centralizado
@@ -47,99 +46,88 @@ class SIIScraperAnual(SIIScraper):
                 for p_idx, periodo in enumerate(periodos):
                     mes_str = periodo["mes"]
                     anio_str = periodo["anio"]
-                    
+
                     await self.log(f"({p_idx+1}/12) Procesando: {mes_str}/{anio_str}...")
-                    
+
                     try:
-                        await page.wait_for_selector("#periodoMes", timeout=10000)
-                        
-                        # Seleccionar Año (3er select)
-                        selects = page.locator("select")
-                        await selects.nth(2).select_option(label=anio_str)
-                        
-                        # Seleccionar Mes
-                        await page.select_option("#periodoMes", value=mes_str)
-                        
-                        # Click en Consultar
-                        btn_consultar = page.locator("button:has-text('Consultar')")
-                        await btn_consultar.click()
-                        
-                        # Esperar a que la tabla se actualice
-                        await asyncio.sleep(2)
-                        await page.wait_for_load_state("networkidle")
+                        # Seleccionar Año/Mes, Consultar y esperar a que la tabla se actualice
+                        await self._consultar_periodo_rcv(page, anio_str, mes_str)
 
                         # --- EXTRACCIÓN DE COMPRAS ---
                         await self.log(f"Extrayendo Compras {mes_str}/{anio_str}...")
                         await page.click("a[href='#compra/']")
-                        await asyncio.sleep(1)
+                        await self._pausa(1)
                         await page.wait_for_load_state("networkidle")
-                        
-                        compras = await page.evaluate("""() => {
-                            const rows = Array.from(document.querySelectorAll('table tbody tr'));
-                            return rows.map(row => {
-                                const cols = row.querySelectorAll('td');
-                                if (cols.length >= 6) {
-                                    return {
-                                        tipo_doc: cols[0].innerText.trim(),
-                                        cantidad: cols[1].innerText.trim(),
-                                        neto: cols[3].innerText.trim(),
-                                        iva: cols[4].innerText.trim(),
-                                        total: cols[cols.length - 1].innerText.trim()
-                                    };
-                                }
-                                return null;
-                            }).filter(r => r !== null);
-                        }""")
-                        
+
+                        celdas = await page.evaluate(JS_CELDAS_TABLA_RCV)
+                        compras = ResumenRCV.desde_celdas(celdas, rut=self.rut, periodo=f"{anio_str}-{mes_str}", operacion="compra")
+
                         # --- EXTRACCIÓN DE VENTAS ---
                         await self.log(f"Extrayendo Ventas {mes_str}/{anio_str}...")
                         await page.click("a[href='#venta/']")
-                        await asyncio.sleep(1)
+                        await self._pausa(1)
                         await page.wait_for_load_state("networkidle")
-                        
-                        ventas = await page.evaluate("""() => {
-                            const rows = Array.from(document.querySelectorAll('table tbody tr'));
-                            return rows.map(row => {
-                                const cols = row.querySelectorAll('td');
-                                if (cols.length >= 6) {
-                                    return {
-                                        tipo_doc: cols[0].innerText.trim(),
-                                        cantidad: cols[1].innerText.trim(),
-                                        neto: cols[3].innerText.trim(),
-                                        iva: cols[4].innerText.trim(),
-                                        total: cols[cols.length - 1].innerText.trim()
-                                    };
-                                }
-                                return null;
-                            }).filter(r => r !== null);
-                        }""")
-                        
-                        consolidado["data"].append({
-                            "periodo": f"{anio_str}-{mes_str}",
-                            "compras": compras,
-                            "ventas": ventas
-                        })
+
+                        celdas = await page.evaluate(JS_CELDAS_TABLA_RCV)
+                        ventas = ResumenRCV.desde_celdas(celdas, rut=self.rut, periodo=f"{anio_str}-{mes_str}", operacion="venta")
+
+                        resultado = {"periodo": f"{anio_str}-{mes_str}", "compras": compras, "ventas": ventas}
+                        historial.guardar_rcv(compras, fuente="rcv_anual")
+                        historial.guardar_rcv(ventas, fuente="rcv_anual")
                         await self.log(f"✅ {mes_str}/{anio_str} completado.")
 
+                    except (CredencialesInvalidas, PlazoAgotado):
+                        # Sin plazo los meses restantes fallarían al instante: se corta con 504
+                        raise
                     except Exception as e:
-                        consolidado["data"].append({
-                            "periodo": f"{anio_str}-{mes_str}",
-                            "error": str(e)
-                        })
+                        resultado = {"periodo": f"{anio_str}-{mes_str}", "error": str(e)}
                         await self.log(f"⚠️ Error en {mes_str}/{anio_str}: {e}", "error")
 
-                return consolidado
+                    yield resultado
 
-            except Exception as e:
-                print(f"[{self.rut}] ❌ Error crítico en consolidación: {str(e)}")
-                return None
             finally:
-                if headless:
-                    await browser.close()
-                else:
+                if not headless:
                     # Si no es headless, dejamos un momento para ver antes de cerrar
                     await asyncio.sleep(5)
-                    await browser.close()
+                await context.close()
+                await browser.close()
+
+    async def get_rcv_ultimos_12_meses(self, headless: bool = True):
+        """Extrae los últimos 12 meses de RCV desde la fecha actual y los une en un solo JSON."""
+        hoy = datetime.now()
+        consolidado = {
+            "rut": self.rut,
+            "fecha_extraccion": hoy.isoformat(),
+            "periodos_extraidos": len(ultimos_12_periodos(hoy)),
+            "data": []
+        }
+        resumenes = []
+
+        try:
+            async for item in self.iterar_rcv_ultimos_12_meses(headless):
+                if "error" in item:
+                    consolidado["data"].append(item)
+                    continue
+                resumenes += [item["compras"], item["ventas"]]
+                consolidado["data"].append({
+                    "periodo": item["periodo"],
+                    "compras": item["compras"].to_filas(legado=True),
+                    "ventas": item["ventas"].to_filas(legado=True)
+                })
+
+            # Totales anuales agregados una sola vez sobre las columnas ya tipadas
+            consolidado["totales"] = {
+                "compras": agregar([r for r in resumenes if r.operacion == "compra"], por="tipo_documento"),
+                "ventas": agregar([r for r in resumenes if r.operacion == "venta"], por="tipo_documento"),
+                "por_periodo": agregar(resumenes, por="periodo")
+            }
+            return consolidado
+
+        except (CredencialesInvalidas, PlazoAgotado):
+            raise
+        except Exception as e:
+            print(f"[{self.rut}] ❌ Error crítico en consolidación: {str(e)}")
+            return None
 
 if __name__ == "__main__":
     # Test rápido si se ejecuta directamente
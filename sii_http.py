@@ -0,0 +1,254 @@
+import hashlib
+import os
+import time
+from urllib.parse import urljoin
+
+import httpx
+import lxml.html
+
+from rcv_modelo import a_entero
+from salud import salud_sii
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+URL_BHE_RECIBIDAS = "https://proxy.sii.cl/cgi_rtc/RTC/RTCP_BHE_CONS_RECIBIDAS.cgi"
+
+# Cookies autenticadas por RUT: { rut: (timestamp, [cookies de Playwright]) }
+COOKIES_CACHE = {}
+COOKIES_TTL_S = float(os.getenv("SII_COOKIES_TTL_S", "900"))
+
+
+class SesionExpirada(Exception):
+    """El SII redirigió al login: las cookies ya no sirven."""
+
+
+class CredencialesInvalidas(Exception):
+    """El SII rechazó el RUT/clave (o la clave está bloqueada)."""
+
+
+# Intentos de login rechazados: { hash(rut, clave): (timestamp, mensaje) }. Evita que los
+# reintentos de un cliente lancen navegadores y acerquen la cuenta a un bloqueo en el SII.
+RECHAZOS_CACHE = {}
+RECHAZOS_TTL_S = float(os.getenv("SII_LOGIN_NEGATIVO_TTL_S", "600"))
+_SAL_RECHAZOS = os.urandom(16)
+
+
+def _clave_rechazo(rut: str, clave: str) -> str:
+    # Hash con sal del proceso: la clave nunca queda en memoria en texto plano
+    rut = rut.replace(".", "").replace("-", "").upper()
+    return hashlib.sha256(_SAL_RECHAZOS + f"{rut}:{clave}".encode()).hexdigest()
+
+
+def registrar_rechazo(rut: str, clave: str, mensaje: str):
+    ahora = time.time()
+    # Se podan los vencidos al escribir: si no, solo salían al volver a consultar la misma clave
+    for vencida in [k for k, (t, _) in RECHAZOS_CACHE.items() if ahora - t > RECHAZOS_TTL_S]:
+        del RECHAZOS_CACHE[vencida]
+    RECHAZOS_CACHE[_clave_rechazo(rut, clave)] = (ahora, mensaje)
+
+
+def verificar_no_rechazado(rut: str, clave: str):
+    """Lanza CredencialesInvalidas si este RUT/clave fue rechazado hace menos de RECHAZOS_TTL_S."""
+    clave_cache = _clave_rechazo(rut, clave)
+    entrada = RECHAZOS_CACHE.get(clave_cache)
+    if not entrada:
+        return
+    if time.time() - entrada[0] > RECHAZOS_TTL_S:
+        RECHAZOS_CACHE.pop(clave_cache, None)
+        return
+    raise CredencialesInvalidas(f"{entrada[1]} (rechazo reciente, no se reintenta)")
+
+
+def guardar_cookies(rut: str, cookies: list):
+    COOKIES_CACHE[rut] = (time.time(), cookies)
+
+
+def cookies_vigentes(rut: str):
+    entrada = COOKIES_CACHE.get(rut)
+    if not entrada or time.time() - entrada[0] > COOKIES_TTL_S:
+        COOKIES_CACHE.pop(rut, None)
+        return None
+    return entrada[1]
+
+
+def invalidar_cookies(rut: str):
+    COOKIES_CACHE.pop(rut, None)
+
+
+class ClienteSIIHttp:
+    """
+    Cliente httpx para páginas CGI del SII que no necesitan JavaScript. Reutiliza las
+    cookies de una sesión autenticada en el navegador y envía los formularios directo.
+    """
+
+    def __init__(self, cookies: list, timeout: float = 15.0):
+        jar = httpx.Cookies()
+        for c in cookies:
+            jar.set(c["name"], c["value"], domain=c.get("domain", "").lstrip("."), path=c.get("path", "/"))
+        self.client = httpx.AsyncClient(
+            cookies=jar,
+            headers={"User-Agent": USER_AGENT},
+            follow_redirects=True,
+            timeout=timeout
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+
+    def _verificar(self, response):
+        if "AUT2000" in str(response.url) or "IngresoRutClave" in str(response.url):
+            raise SesionExpirada(str(response.url))
+        response.raise_for_status()
+        return response
+
+    async def get(self, url: str) -> str:
+        return self._verificar(await self._solicitar("GET", url)).text
+
+    async def _solicitar(self, metodo: str, url: str, **kwargs):
+        """Solicitud HTTP que además informa su resultado y latencia a la salud del host."""
+        inicio = time.monotonic()
+        try:
+            response = await self.client.request(metodo, url, **kwargs)
+        except httpx.TransportError:
+            salud_sii.registrar(url, False, time.monotonic() - inicio)
+            raise
+        salud_sii.registrar(url, response.status_code < 500, time.monotonic() - inicio)
+        return response
+
+    async def _enviar(self, form, url: str, datos: dict) -> str:
+        action = urljoin(url, form.action or url)
+        if (form.method or "GET").upper() == "POST":
+            response = await self._solicitar("POST", action, data=datos)
+        else:
+            response = await self._solicitar("GET", action, params=datos)
+        return self._verificar(response).text
+
+    async def enviar_formulario(self, url: str, selects_por_label: dict = None, campos: dict = None, boton: str = None) -> str:
+        """
+        Abre el formulario de 'url', conserva sus campos ocultos y valores por defecto,
+        elige las opciones de los <select> por su texto visible y lo envía a su action
+        (incluyendo el botón 'boton' si tiene name, como lo haría el navegador).
+        """
+        html = await self.get(url)
+        tree = lxml.html.fromstring(html)
+        forms = tree.forms
+        if not forms:
+            raise ValueError(f"No se encontró formulario en {url}")
+        form = forms[0]
+
+        datos = {k: v for k, v in form.form_values()}
+        for nombre, label in (selects_por_label or {}).items():
+            select = form.inputs[nombre]
+            opcion = next((o for o in select.iter("option") if o.text_content().strip() == str(label)), None)
+            if opcion is None:
+                raise ValueError(f"Opción '{label}' no existe en select '{nombre}'")
+            datos[nombre] = opcion.get("value", opcion.text_content().strip())
+        if boton:
+            submit = next((i for i in form.iter("input") if i.get("type", "").lower() == "submit" and i.get("value") == boton), None)
+            if submit is not None and submit.get("name"):
+                datos[submit.get("name")] = boton
+        datos.update(campos or {})
+        return await self._enviar(form, url, datos)
+
+    async def pagina_siguiente(self, html: str, url: str):
+        """
+        HTML de la página siguiente de un listado CGI, siguiendo un enlace 'Siguiente'/'>>'
+        o enviando el formulario con el botón 'Siguiente'. None si es la última página.
+        """
+        tree = lxml.html.fromstring(html)
+        for a in tree.iter("a"):
+            texto = a.text_content().strip()
+            href = a.get("href", "")
+            if (texto in (">>", ">") or "siguiente" in texto.lower()) and href and not href.startswith(("javascript", "#")):
+                return await self.get(urljoin(url, href))
+        for form in tree.forms:
+            boton = next((i for i in form.iter("input")
+                          if i.get("type", "").lower() == "submit" and "siguiente" in (i.get("value") or "").lower()), None)
+            if boton is not None:
+                datos = {k: v for k, v in form.form_values()}
+                if boton.get("name"):
+                    datos[boton.get("name")] = boton.get("value")
+                return await self._enviar(form, url, datos)
+        return None
+
+
+def extraer_total_retencion(html: str) -> int:
+    """Busca la celda 'Total Retención' (o 'Retención') y lee la celda siguiente."""
+    tree = lxml.html.fromstring(html)
+    celdas = list(tree.iter("td", "th"))
+    target = next((c for c in celdas if "Total Retención" in c.text_content()), None)
+    if target is None:
+        target = next((c for c in celdas if "Retención" in c.text_content()), None)
+    if target is None or target.getnext() is None:
+        return 0
+    return a_entero(target.getnext().text_content())
+
+
+# --- BOLETAS DE HONORARIOS RECIBIDAS (filas tipadas) ---
+
+COLUMNAS_BHE = ("periodo", "numero", "estado", "fecha", "rut_emisor", "nombre_emisor",
+                "monto_bruto", "retencion", "monto_liquido")
+MONTOS_BHE = ("monto_bruto", "retencion", "monto_liquido")
+
+# Fragmento del encabezado de la tabla del SII -> columna (se prueba en este orden)
+_ENCABEZADOS_BHE = (
+    ("bruto", "monto_bruto"),
+    ("retenido", "retencion"),
+    ("retenc", "retencion"),
+    ("pagado", "monto_liquido"),
+    ("líquido", "monto_liquido"),
+    ("liquido", "monto_liquido"),
+    ("estado", "estado"),
+    ("fecha", "fecha"),
+    ("nombre", "nombre_emisor"),
+    ("rut", "rut_emisor"),
+    ("n°", "numero"),
+    ("nro", "numero"),
+    ("boleta", "numero"),
+)
+
+
+def _columna_bhe(encabezado: str):
+    texto = encabezado.lower()
+    return next((col for fragmento, col in _ENCABEZADOS_BHE if fragmento in texto), None)
+
+
+def extraer_boletas_bhe(html: str, periodo: str) -> list:
+    """
+    Filas tipadas de la tabla de boletas recibidas: busca la tabla cuyo encabezado
+    reconoce montos, y convierte cada fila (los montos a int). Omite filas de totales.
+    """
+    tree = lxml.html.fromstring(html)
+    for tabla in tree.iter("table"):
+        filas = [tr for tr in tabla.iter("tr") if tr.getparent() is tabla or tr.getparent().getparent() is tabla]
+        for i, tr in enumerate(filas):
+            columnas = [_columna_bhe(c.text_content()) for c in tr if c.tag in ("th", "td")]
+            if not any(c in MONTOS_BHE for c in columnas) or sum(c is not None for c in columnas) < 3:
+                continue
+            boletas = []
+            for fila in filas[i + 1:]:
+                celdas = [c.text_content().strip() for c in fila if c.tag == "td"]
+                if len(celdas) < len(columnas) or any("total" in c.lower() for c in celdas[:2]):
+                    continue
+                boleta = {col: None for col in COLUMNAS_BHE}
+                boleta["periodo"] = periodo
+                for col, valor in zip(columnas, celdas):
+                    if col and boleta[col] is None:
+                        boleta[col] = a_entero(valor) if col in MONTOS_BHE else valor
+                boletas.append(boleta)
+            return boletas
+    return []
+
+
+def total_mes_bhe(periodo: str, boletas: list, html: str = None) -> dict:
+    """Totales del mes (sin boletas anuladas); sin filas se usa la celda 'Total Retención' de la página."""
+    vigentes = [b for b in boletas if "anul" not in (b["estado"] or "").lower()]
+    total = {"periodo": periodo, "boletas": len(vigentes)}
+    for col in MONTOS_BHE:
+        total[col] = sum(b[col] or 0 for b in vigentes)
+    if not boletas and html:
+        total["retencion"] = extraer_total_retencion(html)
+    return total
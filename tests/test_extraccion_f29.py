@@ -0,0 +1,45 @@
+from extraccion_f29 import extraer_codigos_html, limpiar_valor, url_frame
+
+URL = "https://www4.sii.cl/propuestaf29ui/index.html?rut=1#/formulario"
+
+
+def test_limpiar_valor_y_url_frame():
+    assert limpiar_valor("$ 1.234.567") == 1234567
+    assert limpiar_valor("") is None
+    assert url_frame(URL) == "https://www4.sii.cl/propuestaf29ui/index.html"
+
+
+def test_estrategia_input():
+    html = '<html><body><input id="valCode538" value="1.500.000"></body></html>'
+    assert extraer_codigos_html(URL, html, ["538"]) == {
+        "538": {"valor": 1500000, "frame": url_frame(URL), "estrategia": "input"}
+    }
+
+
+def test_estrategia_label_toma_el_elemento_mas_interno():
+    # El div externo también contiene "[504]" en su texto; debe ganar la celda que lo rotula
+    html = """
+    <html><body><div id="formulario">
+      <table>
+        <tr><td><span>[504]</span> Remanente</td><td>28.500</td></tr>
+        <tr><td><span>[77]</span> Remanente siguiente</td><td>12.000</td></tr>
+      </table>
+    </div></body></html>
+    """
+    encontrados = extraer_codigos_html(URL, html, ["504", "77"])
+    assert encontrados["504"]["valor"] == 28500
+    assert encontrados["504"]["estrategia"] == "label"
+    assert encontrados["77"]["valor"] == 12000
+
+
+def test_estrategia_label_con_input_en_la_fila():
+    html = '<html><body><table><tr><td>[91] Total a pagar</td><td><input value="5.000"></td></tr></table></body></html>'
+    assert extraer_codigos_html(URL, html, ["91"])["91"] == {
+        "valor": 5000, "frame": url_frame(URL), "estrategia": "label"
+    }
+
+
+def test_codigo_ausente_y_html_invalido():
+    html = "<html><body><table><tr><td>[91]</td><td>1.000</td></tr></table></body></html>"
+    assert "538" not in extraer_codigos_html(URL, html, ["91", "538"])
+    assert extraer_codigos_html(URL, "", ["91"]) == {}
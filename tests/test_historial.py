@@ -0,0 +1,62 @@
+import pytest
+
+from historial import (F29, HistorialSII, periodo_clave, periodo_desde_texto, periodo_en_texto,
+                       rango_periodos)
+from rcv_modelo import ResumenRCV
+
+
+def test_periodo_clave():
+    assert periodo_clave("2025", "Marzo") == "2025-03"
+    assert periodo_clave("2025", "marzo") == "2025-03"
+    assert periodo_clave("2025", "03") == "2025-03"
+    assert periodo_clave(2025, 12) == "2025-12"
+    assert periodo_clave("2025", "13") is None
+    assert periodo_clave("2025", "Marzoo") is None
+    assert periodo_clave(None, "Marzo") is None
+
+
+def test_periodo_desde_texto():
+    assert periodo_desde_texto("Periodo Tributario: Marzo de 2025") == "2025-03"
+    assert periodo_desde_texto("Periodo 03/2025") == "2025-03"
+    assert periodo_desde_texto("sin periodo") is None
+
+
+@pytest.mark.parametrize("texto", ["Marzo 2025", "marzo de 2025", "03/2025", "03 - 2025", "2025-03", "202503"])
+def test_periodo_en_texto_reconoce_formatos(texto):
+    assert periodo_en_texto(f"Formulario 29 — {texto}", "2025-03")
+
+
+@pytest.mark.parametrize("texto", ["Febrero 2025", "Marzo 2024", "13/2025", "", None])
+def test_periodo_en_texto_rechaza_otros_periodos(texto):
+    assert not periodo_en_texto(texto, "2025-03")
+
+
+def test_rango_periodos_cruza_el_anio():
+    assert rango_periodos("2024-11", "2025-02") == [
+        ("2024", "Noviembre"), ("2024", "Diciembre"), ("2025", "Enero"), ("2025", "Febrero")
+    ]
+    assert rango_periodos("2025-03", "2025-02") == []
+    with pytest.raises(ValueError):
+        rango_periodos("2025-00", "2025-02")
+
+
+def test_historial_guarda_reemplaza_e_invalida(tmp_path):
+    h = HistorialSII(str(tmp_path / "historial.db"))
+    h.guardar_f29("76.123.456-7", "2025-03", {"91": "1000"})
+    h.guardar_f29("761234567", "2025-03", {"91": "2000"}, fuente="prueba")
+    assert h.f29("76123456-7", "2025-03") == {"91": "2000"}
+    assert h.obtener("76123456-7", "2025-03", F29)["fuente"] == "prueba"
+    assert h.f29("76123456-7", "2025-03", propuesta=True) is None
+    assert h.periodos("76123456-7", F29) == ["2025-03"]
+
+    h.invalidar("76123456-7", "2025-03", F29)
+    assert h.f29("76123456-7", "2025-03") is None
+
+
+def test_historial_rcv_ida_y_vuelta(tmp_path):
+    h = HistorialSII(str(tmp_path / "historial.db"))
+    resumen = ResumenRCV.desde_celdas([["Factura (33)", "2", "0", "1.000", "190", "1.190"]],
+                                      rut="76123456-7", periodo="2025-03", operacion="venta")
+    h.guardar_rcv(resumen)
+    assert h.rcv("76123456-7", "2025-03", "venta").to_dict() == resumen.to_dict()
+    assert h.rcv("76123456-7", "2025-03", "compra") is None
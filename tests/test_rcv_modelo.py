@@ -0,0 +1,93 @@
+from rcv_modelo import (ResumenRCV, a_decimal, a_entero, agregar, filas_periodo_rcv,
+                        iterar_detalle_csv, stream_csv, stream_ndjson)
+
+
+def _resumen(periodo="2025-03", operacion="compra"):
+    celdas = [
+        ["Factura Electrónica (33)", "3", "0", "1.000.000", "190.000", "x", "1.190.000"],
+        ["Nota de Crédito (61)", "1", "0", "-100.000", "-19.000", "x", "-119.000"],
+    ]
+    return ResumenRCV.desde_celdas(celdas, rut="76.123.456-7", periodo=periodo, operacion=operacion)
+
+
+def test_a_entero_montos_del_sii():
+    assert a_entero("1.234.567") == 1234567
+    assert a_entero("$ -3.000") == -3000
+    assert a_entero("") == 0
+    assert a_entero("-") == 0
+    assert a_entero(42) == 42
+
+
+def test_a_decimal_tasas():
+    assert a_decimal("19,5") == 19.5
+    assert a_decimal("1.234,5") == 1234.5
+    assert a_decimal("10") == 10.0
+    assert a_decimal("") is None
+
+
+def test_resumen_desde_celdas_usa_ultima_columna_como_total():
+    resumen = _resumen()
+    assert len(resumen) == 2
+    assert resumen.tipo_documento[0] == "Factura Electrónica (33)"
+    assert list(resumen.monto_total) == [1190000, -119000]
+    assert resumen.total("iva_recuperable") == 171000
+    assert resumen.totales()["total_documentos"] == 4
+
+
+def test_resumen_to_dict_ida_y_vuelta():
+    resumen = _resumen()
+    copia = ResumenRCV.desde_dict(resumen.to_dict())
+    assert copia.to_dict() == resumen.to_dict()
+
+
+def test_to_filas_legado_conserva_claves_antiguas():
+    fila = _resumen().to_filas(legado=True)[0]
+    assert fila["tipo_documento"] == fila["tipo_doc"] == "Factura Electrónica (33)"
+    assert fila["cantidad"] == fila["total_documentos"] == 3
+    assert fila["neto"] == 1000000
+    assert fila["iva"] == 190000
+    assert fila["total"] == 1190000
+    assert "tipo_doc" not in _resumen().to_filas()[0]
+
+
+def test_agregar_por_periodo_y_tipo():
+    marzo, abril = _resumen("2025-03"), _resumen("2025-04")
+    por_periodo = agregar([marzo, abril], por="periodo")
+    assert por_periodo["2025-03"]["monto_neto"] == 900000
+    assert set(por_periodo) == {"2025-03", "2025-04"}
+    por_tipo = agregar([marzo, abril], por="tipo_documento")
+    assert por_tipo["Nota de Crédito (61)"]["total_documentos"] == 2
+
+
+def test_iterar_detalle_csv_tipa_columnas(tmp_path):
+    path = tmp_path / "detalle.csv"
+    path.write_text(
+        "Nro;Tipo Doc;RUT Proveedor;Folio;Monto Neto;Tasa Impuesto\n"
+        "1;33;76123456-7;1001;1.000;19,5\n"
+        ";;;;;\n"
+        "2;61;76123456-7;1002;-500;\n",
+        encoding="latin-1",
+    )
+    filas = list(iterar_detalle_csv(str(path)))
+    assert len(filas) == 2
+    assert filas[0] == {"nro": 1, "tipo_doc": 33, "rut_proveedor": "76123456-7", "folio": 1001,
+                        "monto_neto": 1000, "tasa_impuesto": 19.5}
+    assert filas[1]["monto_neto"] == -500
+    assert filas[1]["tasa_impuesto"] is None
+
+
+def test_stream_csv_y_ndjson():
+    filas = [{"a": 1, "b": "x"}, {"a": 2, "b": "y"}]
+    assert "".join(stream_csv(filas)).splitlines() == ["a,b", "1,x", "2,y"]
+    assert list(stream_ndjson(filas[:1])) == ['{"a": 1, "b": "x"}\n']
+
+
+def test_filas_periodo_rcv():
+    item = {"periodo": "2025-03", "compras": _resumen(), "ventas": _resumen(operacion="venta")}
+    filas = list(filas_periodo_rcv(item))
+    assert len(filas) == 4
+    assert {f["operacion"] for f in filas} == {"compra", "venta"}
+    assert all(f["periodo"] == "2025-03" for f in filas)
+    assert list(filas_periodo_rcv({"periodo": "2025-04", "error": "timeout"})) == [
+        {"periodo": "2025-04", "error": "timeout"}
+    ]
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+import recursos
+from recursos import MemoriaInsuficiente, PresupuestoMemoria
+
+
+@pytest.fixture
+def dos_navegadores(monkeypatch):
+    """Cupo de dos navegadores, uno reservado para la clase interactiva, sin límite de memoria."""
+    monkeypatch.setattr(recursos, "MAX_NAVEGADORES", 2)
+    monkeypatch.setattr(recursos, "RESERVA_INTERACTIVA_NAVEGADORES", 1)
+    monkeypatch.setattr(recursos, "MEMORY_BUDGET_MB", 0)
+    monkeypatch.setattr(recursos, "MEMORY_POLICY", "queue")
+    monkeypatch.setattr(recursos, "MEMORY_QUEUE_TIMEOUT_S", 5)
+
+
+async def _admitir(memoria, job_id, clase, admitidos):
+    await memoria.reservar(job_id, clase)
+    admitidos.append(job_id)
+
+
+async def _esperar_cola(memoria, n):
+    while len(memoria.cola) < n:
+        await asyncio.sleep(0)
+
+
+def test_cola_atiende_por_prioridad_y_llegada(dos_navegadores):
+    async def escenario():
+        memoria = PresupuestoMemoria()
+        admitidos = []
+        await _admitir(memoria, "api-1", "api", admitidos)
+
+        tareas = []
+        for job_id, clase in (("batch-1", "batch"), ("api-2", "api"), ("batch-2", "batch")):
+            tareas.append(asyncio.create_task(_admitir(memoria, job_id, clase, admitidos)))
+            await _esperar_cola(memoria, len(tareas))
+        # La interactiva usa la capacidad reservada aunque haya cola
+        await _admitir(memoria, "live-1", "interactiva", admitidos)
+        assert memoria.stats_por_clase["interactiva"]["adelantos"] == 3
+
+        for job_id in ("api-1", "live-1", "api-2", "batch-1"):
+            await memoria.liberar(job_id)
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tareas)
+        return admitidos, memoria
+
+    admitidos, memoria = asyncio.run(escenario())
+    assert admitidos == ["api-1", "live-1", "api-2", "batch-1", "batch-2"]
+    assert memoria.cola == []
+    assert memoria.resumen()["por_clase"]["batch"]["encoladas"] == 2
+
+
+def test_politica_refuse_rechaza_sin_encolar(dos_navegadores, monkeypatch):
+    monkeypatch.setattr(recursos, "MEMORY_POLICY", "refuse")
+
+    async def escenario():
+        memoria = PresupuestoMemoria()
+        await memoria.reservar("api-1", "api")
+        with pytest.raises(MemoriaInsuficiente):
+            await memoria.reservar("api-2", "api")
+        await memoria.reservar("live-1", "interactiva")
+        return memoria
+
+    memoria = asyncio.run(escenario())
+    assert memoria.stats["rechazadas"] == 1
+    assert set(memoria.sesiones) == {"api-1", "live-1"}
+
+
+def test_cola_agota_su_espera(dos_navegadores, monkeypatch):
+    monkeypatch.setattr(recursos, "MEMORY_QUEUE_TIMEOUT_S", 0.05)
+
+    async def escenario():
+        memoria = PresupuestoMemoria()
+        await memoria.reservar("api-1", "api")
+        with pytest.raises(MemoriaInsuficiente):
+            await memoria.reservar("batch-1", "batch")
+        return memoria
+
+    memoria = asyncio.run(escenario())
+    assert memoria.cola == []
+    assert memoria.stats_por_clase["batch"]["rechazadas"] == 1
+
+
+def test_clase_desconocida_cuenta_como_api(dos_navegadores):
+    async def escenario():
+        memoria = PresupuestoMemoria()
+        await memoria.reservar("x", "urgente")
+        return memoria
+
+    assert asyncio.run(escenario()).sesiones["x"]["clase"] == "api"
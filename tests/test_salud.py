@@ -0,0 +1,127 @@
+import pytest
+
+import salud
+from salud import Circuito, CircuitoAbierto, SaludSII, TiemposPasos, percentil
+
+
+class Reloj:
+    """time.monotonic controlable para recorrer los estados del circuito sin esperar."""
+
+    def __init__(self):
+        self.ahora = 1000.0
+
+    def __call__(self):
+        return self.ahora
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = Reloj()
+    monkeypatch.setattr(salud.time, "monotonic", reloj)
+    return reloj
+
+
+def test_percentil():
+    assert percentil([], 50) is None
+    assert percentil([3, 1, 2], 50) == 2
+    assert percentil(range(1, 101), 99) == 99
+    assert percentil([5], 99) == 5
+
+
+def test_circuito_se_abre_tras_fallos_seguidos(reloj):
+    c = Circuito("sii", fallos_max=3, abierto_s=60)
+    for _ in range(2):
+        c.verificar()
+        c.fallo()
+    c.verificar()
+    c.exito()  # un éxito reinicia la cuenta
+    for _ in range(3):
+        c.verificar()
+        c.fallo()
+    assert c.estado == "abierto"
+    with pytest.raises(CircuitoAbierto) as error:
+        c.verificar()
+    assert error.value.reintentar_en == pytest.approx(60)
+    assert c.resumen()["rechazadas"] == 1
+
+
+def test_circuito_semiabierto_deja_pasar_una_sola_prueba(reloj):
+    c = Circuito("sii", fallos_max=1, abierto_s=60)
+    c.fallo()
+    reloj.ahora += 61
+    c.verificar()  # la prueba
+    assert c.estado == "semiabierto"
+    with pytest.raises(CircuitoAbierto):
+        c.verificar()
+    c.exito()
+    assert c.estado == "cerrado"
+    c.verificar()
+
+
+def test_circuito_semiabierto_vuelve_a_abrirse_si_la_prueba_falla(reloj):
+    c = Circuito("sii", fallos_max=1, abierto_s=60)
+    c.fallo()
+    reloj.ahora += 61
+    c.verificar()
+    c.fallo()
+    assert c.estado == "abierto"
+    assert c.resumen()["aperturas"] == 2
+
+
+def test_circuito_prueba_sin_respuesta_permite_otra(reloj):
+    c = Circuito("sii", fallos_max=1, abierto_s=60)
+    c.fallo()
+    reloj.ahora += 61
+    c.verificar()
+    reloj.ahora += 61
+    c.verificar()  # la prueba anterior nunca informó
+
+
+def test_circuito_respuesta_lenta_cuenta_como_fallo(reloj):
+    c = Circuito("sii", fallos_max=2, abierto_s=60, lento_s=5)
+    c.exito(6)
+    c.exito(7)
+    assert c.estado == "abierto"
+    assert c.resumen()["lentas"] == 2
+    assert c.resumen()["latencia_p50_s"] == 6
+
+
+def test_salud_sii_registra_solo_hosts_del_sii(reloj):
+    s = SaludSII()
+    s.registrar("https://example.com/x", False)
+    assert s.resumen() == {}
+    s.registrar("https://www4.sii.cl/consdcvinternetui/", True, 0.5)
+    assert s.resumen()["www4.sii.cl"]["exitos"] == 1
+    s.verificar("www4.sii.cl", "zeusr.sii.cl")
+
+
+def test_tiempos_pasos_usa_tope_hasta_tener_muestras(monkeypatch):
+    monkeypatch.setattr(salud, "PASO_MUESTRAS_MIN", 5)
+    t = TiemposPasos()
+    for _ in range(4):
+        t.registrar("rcv.abrir", 4.0)
+    assert t.timeout_ms("rcv.abrir", 30000) == 30000
+    t.registrar("rcv.abrir", 4.0)
+    # p99 (4 s) × margen 1,5
+    assert t.timeout_ms("rcv.abrir", 30000) == 6000
+
+
+def test_tiempos_pasos_acota_el_timeout(monkeypatch):
+    monkeypatch.setattr(salud, "PASO_MUESTRAS_MIN", 1)
+    t = TiemposPasos()
+    t.registrar("rapido", 0.1)
+    t.registrar("lento", 500)
+    assert t.timeout_ms("rapido", 30000) == salud.PASO_TIMEOUT_MIN_MS
+    assert t.timeout_ms("lento", 30000) == salud.PASO_TIMEOUT_MAX_MS
+
+
+def test_tiempos_pasos_agotados_y_esperas_opcionales():
+    t = TiemposPasos()
+    t.registrar("carpeta.modal", 10.0, agotado=True, muestra=False)
+    t.registrar("carpeta.abrir", 30.0, agotado=True)
+    t.timeout_ms("carpeta.abrir", 30000)
+    resumen = t.resumen()
+    assert resumen["carpeta.modal"]["agotados"] == 1
+    assert resumen["carpeta.modal"]["muestras"] == 0
+    assert resumen["carpeta.abrir"]["muestras"] == 1
+    assert resumen["carpeta.abrir"]["timeout_ms"] == 30000
@@ -0,0 +1,77 @@
+import pytest
+
+import sii_http
+from sii_http import (CredencialesInvalidas, extraer_boletas_bhe, extraer_total_retencion,
+                      registrar_rechazo, total_mes_bhe, verificar_no_rechazado)
+
+HTML_BHE = """
+<html><body>
+<table>
+  <tr><td>Consulta de boletas recibidas</td></tr>
+</table>
+<table>
+  <tr>
+    <th>N° Boleta</th><th>Estado</th><th>Fecha</th><th>Rut Emisor</th><th>Nombre o Razón Social</th>
+    <th>Honorario Bruto</th><th>Retenido</th><th>Pagado</th>
+  </tr>
+  <tr>
+    <td>101</td><td>VIGENTE</td><td>05/03/2025</td><td>12.345.678-9</td><td>Juan Pérez</td>
+    <td>$ 100.000</td><td>$ 13.750</td><td>$ 86.250</td>
+  </tr>
+  <tr>
+    <td>102</td><td>ANULADA</td><td>07/03/2025</td><td>12.345.678-9</td><td>Juan Pérez</td>
+    <td>$ 50.000</td><td>$ 6.875</td><td>$ 43.125</td>
+  </tr>
+  <tr>
+    <td>Totales</td><td></td><td></td><td></td><td></td>
+    <td>$ 150.000</td><td>$ 20.625</td><td>$ 129.375</td>
+  </tr>
+</table>
+</body></html>
+"""
+
+
+def test_extraer_boletas_bhe_tipa_filas_y_omite_totales():
+    boletas = extraer_boletas_bhe(HTML_BHE, "2025-03")
+    assert len(boletas) == 2
+    primera = boletas[0]
+    assert primera["periodo"] == "2025-03"
+    assert primera["numero"] == "101"
+    assert primera["estado"] == "VIGENTE"
+    assert primera["rut_emisor"] == "12.345.678-9"
+    assert primera["nombre_emisor"] == "Juan Pérez"
+    assert (primera["monto_bruto"], primera["retencion"], primera["monto_liquido"]) == (100000, 13750, 86250)
+
+
+def test_extraer_boletas_bhe_sin_tabla_de_montos():
+    assert extraer_boletas_bhe("<table><tr><td>Sin boletas</td></tr></table>", "2025-03") == []
+
+
+def test_total_mes_bhe_excluye_anuladas():
+    total = total_mes_bhe("2025-03", extraer_boletas_bhe(HTML_BHE, "2025-03"))
+    assert total == {"periodo": "2025-03", "boletas": 1, "monto_bruto": 100000,
+                     "retencion": 13750, "monto_liquido": 86250}
+
+
+def test_total_mes_bhe_sin_filas_usa_total_de_la_pagina():
+    html = "<table><tr><td>Total Retención</td><td>$ 27.500</td></tr></table>"
+    assert extraer_total_retencion(html) == 27500
+    assert total_mes_bhe("2025-03", [], html)["retencion"] == 27500
+
+
+def test_rechazo_reciente_bloquea_y_vence(monkeypatch):
+    monkeypatch.setattr(sii_http, "RECHAZOS_CACHE", {})
+    registrar_rechazo("12.345.678-9", "mala", "Clave incorrecta")
+    with pytest.raises(CredencialesInvalidas):
+        verificar_no_rechazado("12345678-9", "mala")
+    verificar_no_rechazado("12345678-9", "otra")
+
+    monkeypatch.setattr(sii_http, "RECHAZOS_TTL_S", -1)
+    verificar_no_rechazado("12345678-9", "mala")
+
+
+def test_registrar_rechazo_poda_vencidos(monkeypatch):
+    monkeypatch.setattr(sii_http, "RECHAZOS_CACHE", {"vieja": (0.0, "Clave incorrecta")})
+    registrar_rechazo("11.111.111-1", "x", "Clave incorrecta")
+    assert "vieja" not in sii_http.RECHAZOS_CACHE
+    assert len(sii_http.RECHAZOS_CACHE) == 1